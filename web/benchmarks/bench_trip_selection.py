@@ -0,0 +1,147 @@
+"""
+Microbenchmark of the active trip selection in write_trip_updates.
+
+Compares the previous scan, which built a TripRecord and up to two StopDistance ORM objects for every
+trip_update entity, with select_active_trips, which keeps one __slots__ candidate per vehicle.
+No database is needed.
+
+Usage (from web/): python -m benchmarks.bench_trip_selection [--trips 5000] [--stops 30] [--vehicles 1500]
+"""
+import argparse
+import random
+from time import perf_counter
+
+from flask import Flask
+from google.transit import gtfs_realtime_pb2
+
+app = Flask(__name__)
+app.config.update(LOGGING_ENABLED=False, SQLALCHEMY_DATABASE_URI='sqlite://')
+with app.app_context():
+    from flaskr.extensions import db
+    from flaskr.gtfs_update import select_active_trips
+    from flaskr.models import TripRecord, StopDistance
+
+    db.init_app(app)
+
+
+def build_feed(trips: int, stops: int, vehicles: int, timestamp: int):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    feed.header.timestamp = timestamp
+    for i in range(trips):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        entity.trip_update.trip.trip_id = str(100000 + i)
+        entity.trip_update.vehicle.id = str(i % vehicles)
+        start = timestamp + random.randint(-3600, 3600)
+        for s in range(stops):
+            stop = entity.trip_update.stop_time_update.add()
+            stop.stop_sequence = s
+            stop.stop_id = str(1000 + s)
+            stop.arrival.time = start + s * 90
+    return feed
+
+
+def legacy_select_active_trips(entities, timestamp, gtfs_id_dict):
+    """The candidate scan as it was before select_active_trips, kept here for comparison"""
+    records = {}
+    for entity in entities:
+        if not entity.trip_update.HasField('vehicle') or not entity.trip_update.vehicle.id:
+            continue
+        vehicle_id = gtfs_id_dict[int(entity.trip_update.vehicle.id)]
+        record = TripRecord()
+        record.vehicle_id = vehicle_id
+        record.trip_id = entity.trip_update.trip.trip_id
+        if vehicle_id not in records:
+            records.update({vehicle_id: []})
+        records[vehicle_id].append({'record': record, 'next_stop': None, 'prev_stop': None})
+        next_stop_id = None
+        prev_stop_id = None
+        next_stop_time = float('+inf')
+        prev_stop_time = float('-inf')
+        for stop in entity.trip_update.stop_time_update:
+            if stop.HasField('schedule_relationship'):
+                if stop.schedule_relationship != StopDistance.SCHEDULED:
+                    continue
+            arrival_timestamp = stop.arrival.time
+            time_diff = arrival_timestamp - timestamp
+            if 0 < time_diff < next_stop_time:
+                next_stop_id = stop.stop_id
+                next_stop_time = time_diff
+            elif 0 >= time_diff > prev_stop_time:
+                prev_stop_id = stop.stop_id
+                prev_stop_time = time_diff
+        if not next_stop_id and not prev_stop_id:
+            records[vehicle_id].pop()
+            record.vehicle_id = None
+        if next_stop_id is not None:
+            next_stop = StopDistance()
+            next_stop.time_till_arrive = next_stop_time
+            next_stop.stop_id = next_stop_id
+            records[vehicle_id][-1]['next_stop'] = next_stop
+        if prev_stop_id is not None:
+            prev_stop = StopDistance()
+            prev_stop.time_till_arrive = prev_stop_time
+            prev_stop.stop_id = prev_stop_id
+            records[vehicle_id][-1]['prev_stop'] = prev_stop
+
+    active_trips = {}
+    for vehicle_id in records:
+        curr_arrive_time = float('+inf')
+        curr_record = None
+        for trip in records[vehicle_id]:
+            next_stop = trip.get('next_stop', None)
+            prev_stop = trip.get('prev_stop', None)
+            if next_stop is not None:
+                arrive_time = next_stop.time_till_arrive
+            elif prev_stop is not None:
+                arrive_time = prev_stop.time_till_arrive
+            else:
+                continue
+            if (0 < arrive_time < curr_arrive_time) \
+                    or (curr_arrive_time <= 0 < arrive_time) \
+                    or (curr_arrive_time < arrive_time <= 0):
+                curr_arrive_time = arrive_time
+                curr_record = trip['record']
+        if curr_record:
+            active_trips[vehicle_id] = curr_record
+    return active_trips
+
+
+def best_of(repeat: int, function, *args):
+    best = float('+inf')
+    result = None
+    for _ in range(repeat):
+        time_start = perf_counter()
+        result = function(*args)
+        best = min(best, perf_counter() - time_start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trips', type=int, default=5000, help='trip_update entities in the feed')
+    parser.add_argument('--stops', type=int, default=30, help='stop_time_updates per trip')
+    parser.add_argument('--vehicles', type=int, default=1500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    timestamp = 1700000000
+    feed = build_feed(args.trips, args.stops, args.vehicles, timestamp)
+    entities = list(feed.entity)
+    gtfs_id_dict = {gtfs_id: gtfs_id + 1 for gtfs_id in range(args.vehicles)}
+
+    with app.app_context():
+        legacy_time, legacy_trips = best_of(args.repeat, legacy_select_active_trips, entities, timestamp, gtfs_id_dict)
+        new_time, new_trips = best_of(args.repeat, select_active_trips, entities, timestamp, gtfs_id_dict)
+
+    assert {v: r.trip_id for v, r in legacy_trips.items()} == {v: t.trip_id for v, t in new_trips.items()}
+    print(f'{args.trips} trip updates x {args.stops} stops, {args.vehicles} vehicles, best of {args.repeat}')
+    print(f'legacy ORM scan:     {legacy_time * 1000:8.1f} ms  {legacy_time / args.trips * 1e6:6.1f} us/entity')
+    print(f'select_active_trips: {new_time * 1000:8.1f} ms  {new_time / args.trips * 1e6:6.1f} us/entity')
+    print(f'speedup: {legacy_time / new_time:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
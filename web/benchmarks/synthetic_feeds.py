@@ -0,0 +1,195 @@
+"""
+Synthetic GTFS-realtime feeds for benchmarks.
+
+SyntheticFeed builds vehicle_positions and trip_updates FeedMessages for a clock time. Vehicles drive in circles,
+each runs a sequence of trips of `stops` stops, and trip_updates carry the trips in progress and the next ones.
+A fraction of the trips (cancel_rate) is published as CANCELED. Everything is derived from the seed and the time,
+so the same arguments give the same feeds.
+
+FeedServer serves any number of SyntheticFeeds over HTTP on localhost:
+    /<feed index>/vehicle_positions
+    /<feed index>/trip_updates
+Payloads are built by publish(timestamp) before a cycle, so serving a request is only a copy,
+and carry an ETag so feeds that were not published again answer 304.
+"""
+import math
+import random
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.transit import gtfs_realtime_pb2
+
+from flaskr.feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+
+OCCUPANCY_STATUSES = [gtfs_realtime_pb2.VehiclePosition.EMPTY,
+                      gtfs_realtime_pb2.VehiclePosition.MANY_SEATS_AVAILABLE,
+                      gtfs_realtime_pb2.VehiclePosition.FEW_SEATS_AVAILABLE,
+                      gtfs_realtime_pb2.VehiclePosition.STANDING_ROOM_ONLY]
+
+
+class SyntheticFeed:
+    def __init__(self, name: str, vehicles: int = 500, trips: int = 3, stops: int = 30, stop_interval: int = 90,
+                 cancel_rate: float = 0.02, seed: int = 0):
+        """
+        :param vehicles: vehicles in the feed
+        :param trips: trips per vehicle in trip_updates, the one in progress and the next ones
+        :param stops: stops per trip
+        :param stop_interval: seconds between stops
+        :param cancel_rate: fraction of trips published as canceled
+        """
+        self.name = name
+        self.vehicles = vehicles
+        self.trips = trips
+        self.stops = stops
+        self.stop_interval = stop_interval
+        self.cancel_rate = cancel_rate
+        rng = random.Random(f'{seed}-{name}')
+        self.trip_duration = stops * stop_interval
+        # per vehicle: (phase in seconds, center lat, center lon, radius in degrees)
+        self._vehicles = [(rng.randrange(self.trip_duration),
+                           40.6 + rng.random() * 0.3, -74.1 + rng.random() * 0.3, 0.005 + rng.random() * 0.02)
+                          for _ in range(vehicles)]
+
+    def trip_id(self, vehicle: int, trip_index: int):
+        return f'{self.name}-{vehicle}-{trip_index}'
+
+    def is_canceled(self, trip_id: str):
+        return zlib.crc32(trip_id.encode()) % 10000 < self.cancel_rate * 10000
+
+    def _current_trip(self, vehicle: int, timestamp: int):
+        """
+        :return: index of the vehicle's trip in progress, its start time
+        """
+        phase = self._vehicles[vehicle][0]
+        trip_index = (timestamp - phase) // self.trip_duration
+        return trip_index, phase + trip_index * self.trip_duration
+
+    @staticmethod
+    def _header(timestamp: int):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = '2.0'
+        feed.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+        feed.header.timestamp = timestamp
+        return feed
+
+    def vehicle_positions(self, timestamp: int):
+        feed = self._header(timestamp)
+        for vehicle, (phase, lat, lon, radius) in enumerate(self._vehicles):
+            trip_index, _ = self._current_trip(vehicle, timestamp)
+            angle = 2 * math.pi * ((timestamp - phase) % self.trip_duration) / self.trip_duration
+            entity = feed.entity.add()
+            entity.id = str(vehicle)
+            position = entity.vehicle
+            position.vehicle.id = str(vehicle)
+            position.trip.trip_id = self.trip_id(vehicle, trip_index)
+            position.position.latitude = lat + radius * math.sin(angle)
+            position.position.longitude = lon + radius * math.cos(angle)
+            position.occupancy_status = OCCUPANCY_STATUSES[(vehicle + trip_index) % len(OCCUPANCY_STATUSES)]
+            position.timestamp = timestamp - (vehicle % 30)
+        return feed
+
+    def trip_updates(self, timestamp: int):
+        feed = self._header(timestamp)
+        for vehicle in range(self.vehicles):
+            current_index, current_start = self._current_trip(vehicle, timestamp)
+            for i in range(self.trips):
+                trip_id = self.trip_id(vehicle, current_index + i)
+                entity = feed.entity.add()
+                entity.id = trip_id
+                trip_update = entity.trip_update
+                trip_update.trip.trip_id = trip_id
+                if self.is_canceled(trip_id):
+                    trip_update.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.CANCELED
+                    continue
+                trip_update.vehicle.id = str(vehicle)
+                trip_update.timestamp = timestamp
+                start = current_start + i * self.trip_duration
+                for s in range(self.stops):
+                    arrival = start + s * self.stop_interval
+                    if arrival < timestamp - self.stop_interval:
+                        continue  # stops already passed are dropped, like most agencies do
+                    stop = trip_update.stop_time_update.add()
+                    stop.stop_sequence = s + 1
+                    stop.stop_id = str(1000 + s)
+                    stop.arrival.time = arrival
+        return feed
+
+
+class FeedServer:
+    """
+    Serve SyntheticFeeds on localhost from a background thread
+    """
+
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self._payloads = {}  # (feed index, kind): (etag, bytes)
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                payload = server.payload(self.path)
+                if payload is None:
+                    self.send_error(404)
+                    return
+                etag, body = payload
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-protobuf')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def url(self, feed_index: int, kind: str):
+        return f'{self.base_url}/{feed_index}/{kind}'
+
+    def payload(self, path: str):
+        parts = path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].isdigit():
+            return None
+        with self._lock:
+            return self._payloads.get((int(parts[0]), parts[1]), None)
+
+    def publish(self, timestamp: int, feed_indexes=None):
+        """
+        Build the payloads of the feeds for timestamp
+        :param feed_indexes: feeds to publish, all if None. The others keep serving their previous payload
+        :return: total bytes published
+        """
+        size = 0
+        for feed_index in feed_indexes if feed_indexes is not None else range(len(self.feeds)):
+            feed = self.feeds[feed_index]
+            for kind, build in ((VEHICLE_POSITIONS, feed.vehicle_positions), (TRIP_UPDATES, feed.trip_updates)):
+                body = build(timestamp).SerializeToString()
+                size += len(body)
+                with self._lock:
+                    self._payloads[(feed_index, kind)] = (f'"{timestamp}"', body)
+        return size
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -9,7 +9,8 @@ class ProductionConfig:
     SECRET_KEY = os.getenv("SECRET_KEY")
     DEBUG = False
     TESTING = False
-    SCHEDULER_ENABLE = True
+    # ingest from the web process, off when a standalone worker (worker.py) ingests
+    SCHEDULER_ENABLE = os.getenv("SCHEDULER_ENABLE", "true").lower() in ("1", "true", "yes")
     pg_user = os.getenv("POSTGRES_USER")
     pg_pass = os.getenv("POSTGRES_PASSWORD")
     pg_db = os.getenv("POSTGRES_DB")
@@ -25,13 +26,66 @@ class ProductionConfig:
     SCHEDULER_EXECUTORS = {
         "default": {'type': 'threadpool', 'max_workers': 1}
     }
+    # feed update pipeline: number of fetcher, parser and db writer threads and the size of the queues between them
+    FEED_UPDATE_MAX_WORKERS = int(os.getenv("FEED_UPDATE_MAX_WORKERS", 8))
+    FEED_PARSE_WORKERS = int(os.getenv("FEED_PARSE_WORKERS", 1))
+    FEED_WRITE_WORKERS = int(os.getenv("FEED_WRITE_WORKERS", 4))
+    FEED_QUEUE_SIZE = int(os.getenv("FEED_QUEUE_SIZE", 8))
+    # seconds a feed server may send nothing before its fetch fails
+    FEED_READ_TIMEOUT = float(os.getenv("FEED_READ_TIMEOUT", 30))
+    # insertmanyvalues_page_size: rows per multi-row INSERT, large enough for a whole feed snapshot
+    SQLALCHEMY_ENGINE_OPTIONS = {'insertmanyvalues_page_size': 5000}
+    # db pool of each web process, and of the ingestion worker (writer threads, dispatcher and lease heartbeat)
+    WEB_DB_POOL_SIZE = int(os.getenv("WEB_DB_POOL_SIZE", 5))
+    WORKER_DB_POOL_SIZE = int(os.getenv("WORKER_DB_POOL_SIZE", FEED_WRITE_WORKERS + 2))
+    # web only serves reads: no scheduler, and Postgres refuses writes on its connections
+    WEB_READ_ONLY = os.getenv("WEB_READ_ONLY", "false").lower() in ("1", "true", "yes")
+    # port of /metrics of a standalone worker (worker.py)
+    WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))
+    # raw feed snapshot archive, replayed with `flask replay <feed_id>`
+    ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() in ("1", "true", "yes")
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_SEGMENT_MINUTES = int(os.getenv("ARCHIVE_SEGMENT_MINUTES", 60))
+    # adaptive polling: each feed url is polled on the cadence learned from its header timestamps,
+    # checked every FEED_POLL_DISPATCH_SECONDS. Otherwise every feed is updated every minute
+    FEED_POLL_ADAPTIVE = os.getenv("FEED_POLL_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+    FEED_POLL_DISPATCH_SECONDS = int(os.getenv("FEED_POLL_DISPATCH_SECONDS", 5))
+    FEED_POLL_DEFAULT_SECONDS = int(os.getenv("FEED_POLL_DEFAULT_SECONDS", 60))
+    FEED_POLL_MIN_SECONDS = int(os.getenv("FEED_POLL_MIN_SECONDS", 10))
+    FEED_POLL_MAX_SECONDS = int(os.getenv("FEED_POLL_MAX_SECONDS", 600))
+    # share the feeds between any number of ingesting processes with leases, renewed every third of
+    # FEED_LEASE_SECONDS. A worker that stops renewing loses its feeds after FEED_LEASE_SECONDS
+    FEED_LEASES_ENABLED = os.getenv("FEED_LEASES_ENABLED", "false").lower() in ("1", "true", "yes")
+    FEED_LEASE_SECONDS = int(os.getenv("FEED_LEASE_SECONDS", 30))
+    # vehicle_position, trip_record and stop_distance are partitioned by day, partitions are created this many
+    # days ahead. Records are kept RETENTION_DAYS days (forever if unset) unless a feed sets its retention_days
+    PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", 7))
+    RETENTION_DAYS = int(os.getenv("RETENTION_DAYS")) if os.getenv("RETENTION_DAYS") else None
+    # latest position and trip of every vehicle, published by ingestion for the recent endpoints: 'memory' (only
+    # this process), 'file' (LATEST_STATE_DIR shared by the worker and web processes of a host, tmpfs) or 'none'
+    LATEST_STATE_STORE = os.getenv("LATEST_STATE_STORE", "memory")
+    LATEST_STATE_DIR = os.getenv("LATEST_STATE_DIR", "/dev/shm/gtfs-latest-state")
+    # responses of the read API reused until their feed's next ingest cycle, in each web process
+    API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", 1024))
+    API_CACHE_MAX_BYTES = int(os.getenv("API_CACHE_MAX_BYTES", 64 * 2 ** 20))
+    # exports of feed days (/api/export, `flask export`), cached here once a day is closed
+    EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+    # server-sent events of /api/vehicle_positions/stream: the latest state is checked every SSE_POLL_SECONDS,
+    # a keepalive is sent after SSE_KEEPALIVE_SECONDS without event. Each subscriber holds a thread of a gthread web
+    # process: by default a quarter of the WEB_THREADS gunicorn threads, the others answer the other requests.
+    # The gevent stream service (stream.py) holds subscribers in greenlets, it sets thousands
+    SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", 1))
+    SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+    SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", 16))
+    SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", int(os.getenv("WEB_THREADS", 32)) // 4))
 
 
 class DebugConfig:
     SECRET_KEY = os.getenv("SECRET_KEY")
     DEBUG = True
     TESTING = True
-    SCHEDULER_ENABLE = True
+    # ingest from the web process, off when a standalone worker (worker.py) ingests
+    SCHEDULER_ENABLE = os.getenv("SCHEDULER_ENABLE", "true").lower() in ("1", "true", "yes")
     pg_user = os.getenv("POSTGRES_USER")
     pg_pass = os.getenv("POSTGRES_PASSWORD")
     pg_db = os.getenv("POSTGRES_DB")
@@ -46,6 +100,58 @@ class DebugConfig:
     SCHEDULER_EXECUTORS = {
         "default": {'type': 'threadpool', 'max_workers': 1}
     }
+    # feed update pipeline: number of fetcher, parser and db writer threads and the size of the queues between them
+    FEED_UPDATE_MAX_WORKERS = int(os.getenv("FEED_UPDATE_MAX_WORKERS", 8))
+    FEED_PARSE_WORKERS = int(os.getenv("FEED_PARSE_WORKERS", 1))
+    FEED_WRITE_WORKERS = int(os.getenv("FEED_WRITE_WORKERS", 4))
+    FEED_QUEUE_SIZE = int(os.getenv("FEED_QUEUE_SIZE", 8))
+    # seconds a feed server may send nothing before its fetch fails
+    FEED_READ_TIMEOUT = float(os.getenv("FEED_READ_TIMEOUT", 30))
+    # insertmanyvalues_page_size: rows per multi-row INSERT, large enough for a whole feed snapshot
+    SQLALCHEMY_ENGINE_OPTIONS = {'insertmanyvalues_page_size': 5000}
+    # db pool of each web process, and of the ingestion worker (writer threads, dispatcher and lease heartbeat)
+    WEB_DB_POOL_SIZE = int(os.getenv("WEB_DB_POOL_SIZE", 5))
+    WORKER_DB_POOL_SIZE = int(os.getenv("WORKER_DB_POOL_SIZE", FEED_WRITE_WORKERS + 2))
+    # web only serves reads: no scheduler, and Postgres refuses writes on its connections
+    WEB_READ_ONLY = os.getenv("WEB_READ_ONLY", "false").lower() in ("1", "true", "yes")
+    # port of /metrics of a standalone worker (worker.py)
+    WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))
+    # raw feed snapshot archive, replayed with `flask replay <feed_id>`
+    ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() in ("1", "true", "yes")
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_SEGMENT_MINUTES = int(os.getenv("ARCHIVE_SEGMENT_MINUTES", 60))
+    # adaptive polling: each feed url is polled on the cadence learned from its header timestamps,
+    # checked every FEED_POLL_DISPATCH_SECONDS. Otherwise every feed is updated every minute
+    FEED_POLL_ADAPTIVE = os.getenv("FEED_POLL_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+    FEED_POLL_DISPATCH_SECONDS = int(os.getenv("FEED_POLL_DISPATCH_SECONDS", 5))
+    FEED_POLL_DEFAULT_SECONDS = int(os.getenv("FEED_POLL_DEFAULT_SECONDS", 60))
+    FEED_POLL_MIN_SECONDS = int(os.getenv("FEED_POLL_MIN_SECONDS", 10))
+    FEED_POLL_MAX_SECONDS = int(os.getenv("FEED_POLL_MAX_SECONDS", 600))
+    # share the feeds between any number of ingesting processes with leases, renewed every third of
+    # FEED_LEASE_SECONDS. A worker that stops renewing loses its feeds after FEED_LEASE_SECONDS
+    FEED_LEASES_ENABLED = os.getenv("FEED_LEASES_ENABLED", "false").lower() in ("1", "true", "yes")
+    FEED_LEASE_SECONDS = int(os.getenv("FEED_LEASE_SECONDS", 30))
+    # vehicle_position, trip_record and stop_distance are partitioned by day, partitions are created this many
+    # days ahead. Records are kept RETENTION_DAYS days (forever if unset) unless a feed sets its retention_days
+    PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", 7))
+    RETENTION_DAYS = int(os.getenv("RETENTION_DAYS")) if os.getenv("RETENTION_DAYS") else None
+    # latest position and trip of every vehicle, published by ingestion for the recent endpoints: 'memory' (only
+    # this process), 'file' (LATEST_STATE_DIR shared by the worker and web processes of a host, tmpfs) or 'none'
+    LATEST_STATE_STORE = os.getenv("LATEST_STATE_STORE", "memory")
+    LATEST_STATE_DIR = os.getenv("LATEST_STATE_DIR", "/dev/shm/gtfs-latest-state")
+    # responses of the read API reused until their feed's next ingest cycle, in each web process
+    API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", 1024))
+    API_CACHE_MAX_BYTES = int(os.getenv("API_CACHE_MAX_BYTES", 64 * 2 ** 20))
+    # exports of feed days (/api/export, `flask export`), cached here once a day is closed
+    EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+    # server-sent events of /api/vehicle_positions/stream: the latest state is checked every SSE_POLL_SECONDS,
+    # a keepalive is sent after SSE_KEEPALIVE_SECONDS without event. Each subscriber holds a thread of a gthread web
+    # process: by default a quarter of the WEB_THREADS gunicorn threads, the others answer the other requests.
+    # The gevent stream service (stream.py) holds subscribers in greenlets, it sets thousands
+    SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", 1))
+    SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+    SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", 16))
+    SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", int(os.getenv("WEB_THREADS", 32)) // 4))
 
 
 class TestingConfig:
@@ -67,3 +173,55 @@ class TestingConfig:
     SCHEDULER_EXECUTORS = {
         "default": {'type': 'threadpool', 'max_workers': 1}
     }
+    # feed update pipeline: number of fetcher, parser and db writer threads and the size of the queues between them
+    FEED_UPDATE_MAX_WORKERS = int(os.getenv("FEED_UPDATE_MAX_WORKERS", 8))
+    FEED_PARSE_WORKERS = int(os.getenv("FEED_PARSE_WORKERS", 1))
+    FEED_WRITE_WORKERS = int(os.getenv("FEED_WRITE_WORKERS", 4))
+    FEED_QUEUE_SIZE = int(os.getenv("FEED_QUEUE_SIZE", 8))
+    # seconds a feed server may send nothing before its fetch fails
+    FEED_READ_TIMEOUT = float(os.getenv("FEED_READ_TIMEOUT", 30))
+    # insertmanyvalues_page_size: rows per multi-row INSERT, large enough for a whole feed snapshot
+    SQLALCHEMY_ENGINE_OPTIONS = {'insertmanyvalues_page_size': 5000}
+    # db pool of each web process, and of the ingestion worker (writer threads, dispatcher and lease heartbeat)
+    WEB_DB_POOL_SIZE = int(os.getenv("WEB_DB_POOL_SIZE", 5))
+    WORKER_DB_POOL_SIZE = int(os.getenv("WORKER_DB_POOL_SIZE", FEED_WRITE_WORKERS + 2))
+    # web only serves reads: no scheduler, and Postgres refuses writes on its connections
+    WEB_READ_ONLY = os.getenv("WEB_READ_ONLY", "false").lower() in ("1", "true", "yes")
+    # port of /metrics of a standalone worker (worker.py)
+    WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))
+    # raw feed snapshot archive, replayed with `flask replay <feed_id>`
+    ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() in ("1", "true", "yes")
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_SEGMENT_MINUTES = int(os.getenv("ARCHIVE_SEGMENT_MINUTES", 60))
+    # adaptive polling: each feed url is polled on the cadence learned from its header timestamps,
+    # checked every FEED_POLL_DISPATCH_SECONDS. Otherwise every feed is updated every minute
+    FEED_POLL_ADAPTIVE = os.getenv("FEED_POLL_ADAPTIVE", "false").lower() in ("1", "true", "yes")
+    FEED_POLL_DISPATCH_SECONDS = int(os.getenv("FEED_POLL_DISPATCH_SECONDS", 5))
+    FEED_POLL_DEFAULT_SECONDS = int(os.getenv("FEED_POLL_DEFAULT_SECONDS", 60))
+    FEED_POLL_MIN_SECONDS = int(os.getenv("FEED_POLL_MIN_SECONDS", 10))
+    FEED_POLL_MAX_SECONDS = int(os.getenv("FEED_POLL_MAX_SECONDS", 600))
+    # share the feeds between any number of ingesting processes with leases, renewed every third of
+    # FEED_LEASE_SECONDS. A worker that stops renewing loses its feeds after FEED_LEASE_SECONDS
+    FEED_LEASES_ENABLED = os.getenv("FEED_LEASES_ENABLED", "false").lower() in ("1", "true", "yes")
+    FEED_LEASE_SECONDS = int(os.getenv("FEED_LEASE_SECONDS", 30))
+    # vehicle_position, trip_record and stop_distance are partitioned by day, partitions are created this many
+    # days ahead. Records are kept RETENTION_DAYS days (forever if unset) unless a feed sets its retention_days
+    PARTITION_DAYS_AHEAD = int(os.getenv("PARTITION_DAYS_AHEAD", 7))
+    RETENTION_DAYS = int(os.getenv("RETENTION_DAYS")) if os.getenv("RETENTION_DAYS") else None
+    # latest position and trip of every vehicle, published by ingestion for the recent endpoints: 'memory' (only
+    # this process), 'file' (LATEST_STATE_DIR shared by the worker and web processes of a host, tmpfs) or 'none'
+    LATEST_STATE_STORE = os.getenv("LATEST_STATE_STORE", "memory")
+    LATEST_STATE_DIR = os.getenv("LATEST_STATE_DIR", "/dev/shm/gtfs-latest-state")
+    # responses of the read API reused until their feed's next ingest cycle, in each web process
+    API_CACHE_SIZE = int(os.getenv("API_CACHE_SIZE", 1024))
+    API_CACHE_MAX_BYTES = int(os.getenv("API_CACHE_MAX_BYTES", 64 * 2 ** 20))
+    # exports of feed days (/api/export, `flask export`), cached here once a day is closed
+    EXPORT_DIR = os.getenv("EXPORT_DIR", "exports")
+    # server-sent events of /api/vehicle_positions/stream: the latest state is checked every SSE_POLL_SECONDS,
+    # a keepalive is sent after SSE_KEEPALIVE_SECONDS without event. Each subscriber holds a thread of a gthread web
+    # process: by default a quarter of the WEB_THREADS gunicorn threads, the others answer the other requests.
+    # The gevent stream service (stream.py) holds subscribers in greenlets, it sets thousands
+    SSE_POLL_SECONDS = float(os.getenv("SSE_POLL_SECONDS", 1))
+    SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
+    SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", 16))
+    SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", int(os.getenv("WEB_THREADS", 32)) // 4))
@@ -1,7 +1,10 @@
 from flaskr.models import *
 from flaskr import create_app
 from config import TestingConfig
+from flaskr.partitions import maintain_partitions
 
 app = create_app(TestingConfig)
 with app.app_context():
     db.create_all()
+    # day partitions of vehicle_position, trip_record and stop_distance
+    maintain_partitions(days_ahead=app.config.get('PARTITION_DAYS_AHEAD', 7))
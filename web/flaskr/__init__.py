@@ -9,10 +9,25 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger(__name__)
 
 
+def configure_engine(app, pool_size: int, read_only: bool = False):
+    """
+    Set the db pool size of this process, read only connections are refused writes by Postgres
+    """
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    options['pool_size'] = pool_size
+    if read_only:
+        options['connect_args'] = {'options': '-c default_transaction_read_only=on'}
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
 def create_app(config='config.TestingConfig'):
     app = Flask(__name__)
     app.config.from_object(config)
     print(f'created app with config: {config}')
+    read_only = app.config.get('WEB_READ_ONLY', False)
+    ingest = app.config.get('SCHEDULER_ENABLE', False) and not read_only
+    configure_engine(app, app.config.get('WEB_DB_POOL_SIZE', 5)
+                     + (app.config.get('WORKER_DB_POOL_SIZE', 6) if ingest else 0), read_only)
     db.init_app(app)
     migrate.init_app(app, db)
     scheduler.init_app(app)
@@ -29,13 +44,21 @@ def create_app(config='config.TestingConfig'):
         return os.environ.get("WERKZEUG_RUN_MAIN") == "true"
 
     with app.app_context():
+        from .latest_state import latest_state
+        latest_state.init_app(app, ingest=ingest)
+        from .response_cache import response_cache
+        response_cache.init_app(app)
+        from .subscriptions import feed_watcher
+        feed_watcher.init_app(app)
+
         if is_debug_mode() and not is_werkzeug_reloader_process():
             pass
         else:
-            if app.config.get('SCHEDULER_ENABLE', False):
+            if ingest:
                 # scheduler.remove_all_jobs()
                 print('SCHEDULER START')
-                from . import tasks  # noqa: F401
+                from . import tasks
+                tasks.init_jobs(app)
                 scheduler.start()
                 print()
 
@@ -49,4 +72,39 @@ def create_app(config='config.TestingConfig'):
         from . import api
         app.register_blueprint(api.bp)
 
+        if ingest:
+            # only the ingesting process has feed update metrics to serve
+            from . import metrics
+            app.register_blueprint(metrics.bp)
+
+        from . import commands
+        commands.init_app(app)
+
+        return app
+
+
+def create_worker(config='config.ProductionConfig'):
+    """
+    App of a standalone ingestion process: the scheduler and /metrics, without the web blueprints
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    print(f'created worker with config: {config}')
+    configure_engine(app, app.config.get('WORKER_DB_POOL_SIZE', 6))
+    db.init_app(app)
+    scheduler.init_app(app)
+
+    with app.app_context():
+        from .latest_state import latest_state
+        latest_state.init_app(app)
+
+        from . import tasks
+        tasks.init_jobs(app)
+
+        from . import metrics
+        app.register_blueprint(metrics.bp)
+
+        from . import commands
+        commands.init_app(app)
+
         return app
@@ -1,13 +1,19 @@
+import os
 from datetime import date, datetime
 from pprint import pprint
 
-from flask import Blueprint, request, jsonify
-from sqlalchemy import func, and_
+from flask import Blueprint, Response, current_app, request, jsonify, send_file
 
+from .export import get_export, EXTENSIONS, CSV, PARQUET
 from .extensions import db
-from .models import Vehicles, Feed, VehiclePosition, TripRecord, StopDistance, LatestRecords
-from .queries import get_vehicle_ids, vehicle_ids_to_gtfs_ids_mapped
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+from .feed_message import build_feed_message
+from .latest_state import latest_state, load_feed_state
+from .models import Vehicles, Feed, VehiclePosition, TripRecord, LatestRecords, TripSegment
+from .queries import get_vehicle_ids
 from .request_utils import check_get_args, check_json_post_args, FEED_ID, COMPANY_NAME, GTFS_ID, DAY, TRIP_IDS
+from .response_cache import feed_versioned
+from .subscriptions import feed_watcher
 
 bp = Blueprint('api', __name__)
 
@@ -57,6 +63,7 @@ def get_feed_data():
 
 
 @bp.route('/api/vehicles', methods=['GET'])
+@feed_versioned
 def get_vehicles_gtfs_ids():
     """"
     Usage: /api/vehicles/feed_id=<id>
@@ -76,6 +83,7 @@ def get_vehicles_gtfs_ids():
 
 
 @bp.route('/api/vehicle_positions', methods=['GET'])
+@feed_versioned
 def get_positions():
     """"
     Usage: /api/positions/feed_id=<id>&gtfs_id=<id>&day=<day>
@@ -104,10 +112,8 @@ def get_positions():
     return jsonify({'data': data}), 200
 
 
-"SLOW"
-
-
 @bp.route('/api/vehicle_positions/recent', methods=['GET'])
+@feed_versioned
 def get_recent_positions():
     """"
     Usage: /api/positions/recent?feed_id=<id>&gtfs_id=<id>&day=<day>
@@ -118,11 +124,15 @@ def get_recent_positions():
     if error:
         return jsonify(error), 400
     feed_id = request.args.get(FEED_ID, type=int)
+    state = latest_state.get(feed_id)
+    if state is not None:
+        return jsonify({'data': state['positions']}), 200
     vehicles = get_vehicle_ids(feed_id)
     query = db.session.query(VehiclePosition) \
         .filter(VehiclePosition.vehicle_id.in_(vehicles)) \
         .join(LatestRecords,
-              VehiclePosition.id == LatestRecords.vehicle_position_id)
+              (VehiclePosition.id == LatestRecords.vehicle_position_id)
+              & (VehiclePosition.day == LatestRecords.vehicle_position_day))
     positions = query.all()
     data = {}
     for p in positions:
@@ -131,6 +141,7 @@ def get_recent_positions():
 
 
 @bp.route('/api/vehicle_position/recent', methods=['GET'])
+@feed_versioned
 def get_recent_position():
     """"
     Usage: /api/position/recent?feed_id=<id>&gtfs_id=<id>&day=<day>
@@ -143,6 +154,9 @@ def get_recent_position():
         return jsonify(error), 400
     feed_id = request.args.get(FEED_ID, type=int)
     gtfs_id = request.args.get(GTFS_ID, type=int)
+    state = latest_state.get(feed_id)
+    if state is not None and str(gtfs_id) in state['positions']:
+        return jsonify({'data': state['positions'][str(gtfs_id)]}), 200
     vehicle = db.session.query(Vehicles).filter_by(feed_id=feed_id, vehicle_gtfs_id=gtfs_id).first()
     if not vehicle:
         return jsonify({'success': False, 'message': f'vehicle does not exist'}), 404
@@ -154,6 +168,7 @@ def get_recent_position():
 
 
 @bp.route('/api/trip_update/trip_ids', methods=['GET'])
+@feed_versioned
 def get_trip_ids():
     """"
     Usage: /api/trip_ids/feed_id=<id>&day=<day>
@@ -177,6 +192,7 @@ def get_trip_ids():
 
 
 @bp.route('/api/trip_update/stops', methods=['GET'])
+@feed_versioned
 def get_stops():
     """"
     Usage: /api/trip_update/stops/feed_id=<id>&gtfs_id=<id>&day=<day>
@@ -239,20 +255,18 @@ def get_trip_vehicles_segments():
     trip_ids = request.json.get(TRIP_IDS)
     day_iso = request.json.get(DAY)
     day = date.fromisoformat(day_iso)
-    vehicle_ids = vehicle_ids_to_gtfs_ids_mapped(feed_id)
     data = list()
-    trip_data = db.session.query(TripRecord.trip_id, TripRecord.vehicle_id,
-                                 func.min(TripRecord.timestamp).label("first_timestamp"),
-                                 func.max(TripRecord.timestamp).label("last_timestamp")) \
-        .filter(TripRecord.vehicle_id.in_(vehicle_ids.keys()),
-                TripRecord.trip_id.in_(trip_ids),
-                TripRecord.day == day) \
-        .group_by(TripRecord.trip_id, TripRecord.vehicle_id) \
-        .order_by(TripRecord.trip_id).all()
+    trip_data = db.session.query(TripSegment.trip_id, Vehicles.vehicle_gtfs_id,
+                                 TripSegment.first_timestamp, TripSegment.last_timestamp) \
+        .join(Vehicles, Vehicles.id == TripSegment.vehicle_id) \
+        .filter(TripSegment.feed_id == feed_id,
+                TripSegment.day == day,
+                TripSegment.trip_id.in_(trip_ids)) \
+        .order_by(TripSegment.trip_id, TripSegment.first_timestamp).all()
     prev_trip_id = None
     for trip in trip_data:
         trip_id = trip[0]
-        gtfs_id = vehicle_ids[trip[1]]
+        gtfs_id = trip[1]
         first_arrive_time = trip[2].isoformat()
         last_arrive_time = trip[3].isoformat()
         if prev_trip_id == trip_id:
@@ -275,3 +289,108 @@ def get_trip_vehicles_segments():
             data.append(entry)
         prev_trip_id = trip_id
     return jsonify({'data': data}), 200
+
+
+@bp.route('/api/export', methods=['GET'])
+def get_feed_day_export():
+    """"
+    Usage: /api/export?feed_id=<id>&day=<day>&table=<table>&format=<csv|parquet>
+    :param: feed_id: integer
+    :param: day: YYYY-MM-DD iso-8601 date, local to vehicle timezone
+    :param: table: vehicle_position, trip_record or stop_distance
+    :param: format: csv (gzipped, default) or parquet
+    :return: file of every row of the table for the feed on day
+    """
+    data, error = check_get_args([FEED_ID, DAY, 'table'])
+    if error:
+        return jsonify(error), 400
+    feed_id = request.args.get(FEED_ID, type=int)
+    day = date.fromisoformat(request.args.get(DAY, type=str))
+    table = request.args.get('table', type=str)
+    fmt = request.args.get('format', CSV, type=str)
+    feed = db.session.query(Feed).filter_by(id=feed_id).first()
+    if feed is None:
+        return jsonify({'success': False, 'message': f'feed id does not exist'}), 404
+    export, error = get_export(os.path.abspath(current_app.config.get('EXPORT_DIR', 'exports')), feed, day, table, fmt)
+    if error:
+        return jsonify({'success': False, 'message': error}), 400
+    path, temporary = export
+    if temporary:
+        # the export of an open day is removed right away, it is read from its open file
+        file = open(path, 'rb')
+        os.unlink(path)
+    else:
+        file = path
+    return send_file(file, as_attachment=True,
+                     download_name=f'{feed_id}-{day.isoformat()}-{table}.{EXTENSIONS[fmt]}',
+                     mimetype='application/vnd.apache.parquet' if fmt == PARQUET else 'application/gzip')
+
+
+@bp.route('/api/gtfs_rt', methods=['GET'])
+@feed_versioned
+def get_gtfs_rt():
+    """"
+    Usage: /api/gtfs_rt?feed_id=<id>&kind=<vehicle_positions|trip_updates>
+    :param: feed_id: integer
+    :param: kind: only vehicle_positions or trip_updates entities, both if missing
+    :return: GTFS-realtime FeedMessage (protobuf) of the vehicles and active trips of the feed's last snapshots
+    """
+    data, error = check_get_args([FEED_ID])
+    if error:
+        return jsonify(error), 400
+    feed_id = request.args.get(FEED_ID, type=int)
+    kind = request.args.get('kind', None, type=str)
+    if kind not in (None, VEHICLE_POSITIONS, TRIP_UPDATES):
+        return jsonify({'success': False, 'message': f'kind must be {VEHICLE_POSITIONS} or {TRIP_UPDATES}'}), 400
+    if db.session.query(Feed.id).filter_by(id=feed_id).first() is None:
+        return jsonify({'success': False, 'message': f'feed id does not exist'}), 404
+    # encoded once per feed version by feed_versioned, also when it is built from latest_records without a shared state
+    state = latest_state.get(feed_id) or load_feed_state(feed_id)
+    message = build_feed_message(state, (kind,) if kind else (VEHICLE_POSITIONS, TRIP_UPDATES))
+    return Response(message.SerializeToString(), status=200, mimetype='application/x-protobuf')
+
+
+@bp.route('/api/vehicle_positions/stream', methods=['GET'])
+def stream_positions():
+    """"
+    Usage: /api/vehicle_positions/stream?feed_id=<id>&gtfs_ids=<id1,id2>
+    :param: feed_id: integer
+    :param: gtfs_ids: comma separated gtfs_ids to follow, every vehicle of the feed if missing
+    :return: server-sent events: a snapshot of the latest positions and trips by gtfs_id, then after each ingest
+    cycle an update of the vehicles whose position or trip changed
+    """
+    data, error = check_get_args([FEED_ID])
+    if error:
+        return jsonify(error), 400
+    feed_id = request.args.get(FEED_ID, type=int)
+    gtfs_ids = request.args.get('gtfs_ids', '', type=str)
+    try:
+        gtfs_ids = {str(int(gtfs_id)) for gtfs_id in gtfs_ids.split(',')} if gtfs_ids else None
+    except ValueError:
+        return jsonify({'success': False, 'message': f'gtfs_ids must be comma separated integers'}), 400
+    if not latest_state.receives_publishes:
+        # the subscriber would get its snapshot and never an update
+        return jsonify({'success': False, 'message': 'the latest state is not published to this process, '
+                                                     'set LATEST_STATE_STORE=file on the ingestion and web '
+                                                     'processes to stream updates'}), 501
+    if db.session.query(Feed.id).filter_by(id=feed_id).first() is None:
+        return jsonify({'success': False, 'message': f'feed id does not exist'}), 404
+    state = latest_state.get(feed_id) or load_feed_state(feed_id)
+    subscriber, error = feed_watcher.subscribe(feed_id, gtfs_ids, state)
+    if error:
+        # every thread left for subscribers is taken, the client polls the recent endpoints or retries later
+        return jsonify({'success': False, 'message': error}), 503, {'Retry-After': '60'}
+    keepalive_seconds = current_app.config.get('SSE_KEEPALIVE_SECONDS', 15)
+
+    # no app context while streaming, a subscriber does not hold a db connection
+    def events():
+        try:
+            while True:
+                event = subscriber.receive(keepalive_seconds)
+                # a comment keeps proxies from closing the connection and finds disconnected clients
+                yield event if event is not None else ': keepalive\n\n'
+        finally:
+            feed_watcher.unsubscribe(subscriber)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
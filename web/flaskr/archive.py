@@ -0,0 +1,133 @@
+import csv
+import gzip
+import heapq
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime
+
+from flask import current_app
+
+from .logs import add_to_error_log
+
+# record header: fetch time (unix seconds), feed header timestamp, payload length
+RECORD_HEADER = struct.Struct('>qqI')
+INDEX_FILE = 'index.csv'
+SEGMENT_FORMAT = '%Y%m%dT%H%M'
+
+_archive_lock = threading.Lock()
+
+
+class ArchivedSnapshot:
+    __slots__ = ('feed_id', 'kind', 'fetched', 'header_timestamp', 'content')
+
+    def __init__(self, feed_id, kind, fetched, header_timestamp, content):
+        self.feed_id = feed_id
+        self.kind = kind
+        self.fetched = fetched
+        self.header_timestamp = header_timestamp
+        self.content = content
+
+
+def archive_dir(app=None):
+    app = app or current_app
+    return app.config.get('ARCHIVE_DIR', 'archive')
+
+
+def segment_name(fetched: datetime, segment_minutes: int):
+    minute = (fetched.hour * 60 + fetched.minute) // segment_minutes * segment_minutes
+    start = fetched.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    return f'{start.strftime(SEGMENT_FORMAT)}.gz'
+
+
+def archive_snapshot(app, feed_id: int, kind: str, fetched: datetime, header_timestamp: int, content: bytes):
+    """
+    Append a raw FeedMessage to the feed's gzip segment for the fetch time, and add it to the feed's index.
+    Layout: ARCHIVE_DIR/<feed_id>/<kind>/<segment start>.gz, each segment is a series of gzip members,
+    one per snapshot, of RECORD_HEADER + content
+    """
+    directory = os.path.join(archive_dir(app), str(feed_id), kind)
+    segment = segment_name(fetched, app.config.get('ARCHIVE_SEGMENT_MINUTES', 60))
+    fetched_ts = int((fetched - datetime(1970, 1, 1)).total_seconds())
+    with _archive_lock:
+        os.makedirs(directory, exist_ok=True)
+        with gzip.open(os.path.join(directory, segment), 'ab') as segment_file:
+            segment_file.write(RECORD_HEADER.pack(fetched_ts, header_timestamp, len(content)))
+            segment_file.write(content)
+        with open(os.path.join(directory, INDEX_FILE), 'a', newline='') as index_file:
+            csv.writer(index_file).writerow([header_timestamp, fetched_ts, segment, len(content)])
+
+
+def read_index(app, feed_id: int, kind: str):
+    """
+    :return: list of (header_timestamp, fetched_ts, segment, size) rows of the feed's index, oldest first
+    """
+    path = os.path.join(archive_dir(app), str(feed_id), kind, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as index_file:
+        return [(int(row[0]), int(row[1]), row[2], int(row[3])) for row in csv.reader(index_file)]
+
+
+def read_segment(path: str):
+    """
+    A segment cut short, e.g. by a crash while a snapshot was appended, ends at its last complete snapshot
+    :return: generator of (fetched_ts, header_timestamp, content) in a segment
+    """
+    with gzip.open(path, 'rb') as segment_file:
+        while True:
+            try:
+                header = segment_file.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                if len(header) < RECORD_HEADER.size:
+                    raise EOFError('record header cut short')
+                fetched_ts, header_timestamp, size = RECORD_HEADER.unpack(header)
+                content = segment_file.read(size)
+                if len(content) < size:
+                    raise EOFError('snapshot cut short')
+            except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+                add_to_error_log('archive', f'{path} is truncated, read up to its last complete snapshot\n{e}')
+                return
+            yield fetched_ts, header_timestamp, content
+
+
+def archived_header_range(app, feed_id: int, kind: str, start: datetime = None, end: datetime = None):
+    """
+    :param start: only snapshots fetched at or after start (UTC)
+    :param end: only snapshots fetched before end (UTC)
+    :return: first and last header timestamps of the snapshots in the index, None if there are none
+    """
+    start_ts = int((start - datetime(1970, 1, 1)).total_seconds()) if start else None
+    end_ts = int((end - datetime(1970, 1, 1)).total_seconds()) if end else None
+    header_timestamps = [header_timestamp for header_timestamp, fetched_ts, segment, size
+                         in read_index(app, feed_id, kind)
+                         if (start_ts is None or fetched_ts >= start_ts) and (end_ts is None or fetched_ts < end_ts)]
+    if not header_timestamps:
+        return None
+    return min(header_timestamps), max(header_timestamps)
+
+
+def _kind_snapshots(app, feed_id: int, kind: str, start_ts, end_ts):
+    segments = sorted({segment for header_timestamp, fetched_ts, segment, size in read_index(app, feed_id, kind)
+                       if (start_ts is None or fetched_ts >= start_ts) and (end_ts is None or fetched_ts < end_ts)})
+    # segment names sort by time
+    for segment in segments:
+        path = os.path.join(archive_dir(app), str(feed_id), kind, segment)
+        for fetched_ts, header_timestamp, content in read_segment(path):
+            if (start_ts is None or fetched_ts >= start_ts) and (end_ts is None or fetched_ts < end_ts):
+                yield ArchivedSnapshot(feed_id, kind, datetime.utcfromtimestamp(fetched_ts), header_timestamp,
+                                       content)
+
+
+def archived_snapshots(app, feed_id: int, kinds, start: datetime = None, end: datetime = None):
+    """
+    :param start: only snapshots fetched at or after start (UTC)
+    :param end: only snapshots fetched before end (UTC)
+    :return: generator of ArchivedSnapshot of all kinds ordered by fetch time
+    """
+    start_ts = int((start - datetime(1970, 1, 1)).total_seconds()) if start else None
+    end_ts = int((end - datetime(1970, 1, 1)).total_seconds()) if end else None
+    return heapq.merge(*[_kind_snapshots(app, feed_id, kind, start_ts, end_ts) for kind in kinds],
+                       key=lambda snapshot: snapshot.fetched)
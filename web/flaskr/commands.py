@@ -0,0 +1,116 @@
+import os
+import shutil
+from time import perf_counter
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .extensions import db
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+from .models import Feed
+
+
+@click.command('replay')
+@click.argument('feed_id', type=int)
+@click.option('--kind', type=click.Choice([VEHICLE_POSITIONS, TRIP_UPDATES, 'all']), default='all',
+              help='Which feed to replay')
+@click.option('--start', type=click.DateTime(), default=None, help='Replay snapshots fetched from (UTC)')
+@click.option('--end', type=click.DateTime(), default=None, help='Replay snapshots fetched before (UTC)')
+@click.option('--force', is_flag=True, default=False,
+              help='Write snapshots already recorded again, duplicating their records')
+@with_appcontext
+def replay_command(feed_id, kind, start, end, force):
+    """
+    Write archived snapshots of a feed to the db as fast as possible, in the order they were fetched.
+    The latest records only move forward and the latest state is not published, live ingestion keeps them current.
+    Snapshots whose header timestamp already has records of the feed were ingested or replayed before, they are
+    skipped so the window can overlap them, unless force.
+    """
+    from .archive import archived_header_range, archived_snapshots
+    from .gtfs_update import get_recorded_header_timestamps, parse_feed, write_vehicle_positions, write_trip_updates
+
+    feed_data = db.session.query(Feed).filter_by(id=feed_id).first()
+    if feed_data is None:
+        raise click.ClickException(f'Feed id {feed_id} does not exist')
+    kinds = [VEHICLE_POSITIONS, TRIP_UPDATES] if kind == 'all' else [kind]
+    recorded = {}  # kind: header timestamps recorded
+    for archived_kind in kinds:
+        header_range = None if force else archived_header_range(current_app, feed_id, archived_kind, start, end)
+        recorded[archived_kind] = (get_recorded_header_timestamps(feed_id, archived_kind, *header_range)
+                                   if header_range else set())
+    snapshots = 0
+    skipped = 0
+    rows_added = 0
+    time_start = perf_counter()
+    for snapshot in archived_snapshots(current_app, feed_id, kinds, start, end):
+        if snapshot.header_timestamp in recorded[snapshot.kind]:
+            skipped += 1
+            continue
+        feed, error = parse_feed(snapshot.content)
+        if error:
+            click.echo(f'{snapshot.kind} {snapshot.fetched.isoformat()}: {error}', err=True)
+            continue
+        if snapshot.kind == VEHICLE_POSITIONS:
+            rows_added += write_vehicle_positions(feed_data, feed, snapshot.fetched, publish=False)
+        else:
+            rows_added += write_trip_updates(feed_data, feed, snapshot.fetched, publish=False)
+        snapshots += 1
+    seconds = perf_counter() - time_start
+    click.echo(f'Replayed {snapshots} snapshots, {rows_added} rows added in {seconds:.2f}s '
+               f'({snapshots / seconds if seconds else 0:.1f} snapshots/s, '
+               f'{rows_added / seconds if seconds else 0:.0f} rows/s), {skipped} already recorded skipped')
+
+
+@click.command('partitions')
+@click.option('--days-ahead', type=int, default=None, help='Create partitions up to this many days from today')
+@with_appcontext
+def partitions_command(days_ahead):
+    """
+    Create the coming day partitions and apply retention now
+    """
+    from .partitions import maintain_partitions
+
+    created, dropped, deleted = maintain_partitions(
+        days_ahead=days_ahead if days_ahead is not None else current_app.config.get('PARTITION_DAYS_AHEAD', 7),
+        default_retention_days=current_app.config.get('RETENTION_DAYS', None))
+    click.echo(f'{created} partitions created, {dropped} dropped, {deleted} expired rows deleted')
+
+
+@click.command('export')
+@click.argument('feed_id', type=int)
+@click.argument('day', type=click.DateTime(formats=['%Y-%m-%d']), metavar='DAY')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'parquet']), default='csv', help='Gzipped CSV or Parquet')
+@click.option('--table', type=click.Choice(['vehicle_position', 'trip_record', 'stop_distance', 'all']),
+              default='all', help='Which table to export')
+@click.option('--output', type=click.Path(file_okay=False), default='.', help='Directory the files are written to')
+@with_appcontext
+def export_command(feed_id, day, fmt, table, output):
+    """
+    Export the records of a feed on a day, local to the feed timezone, one file per table
+    """
+    from .export import get_export, EXPORTS, EXTENSIONS
+
+    feed = db.session.query(Feed).filter_by(id=feed_id).first()
+    if feed is None:
+        raise click.ClickException(f'Feed id {feed_id} does not exist')
+    day = day.date()
+    os.makedirs(output, exist_ok=True)
+    for name in EXPORTS if table == 'all' else [table]:
+        time_start = perf_counter()
+        export, error = get_export(os.path.abspath(current_app.config.get('EXPORT_DIR', 'exports')),
+                                   feed, day, name, fmt)
+        if error:
+            raise click.ClickException(error)
+        path, temporary = export
+        destination = os.path.join(output, f'{feed_id}-{day.isoformat()}-{name}.{EXTENSIONS[fmt]}')
+        shutil.copyfile(path, destination)
+        if temporary:
+            os.unlink(path)
+        click.echo(f'{destination}: {os.path.getsize(destination)} bytes in {perf_counter() - time_start:.2f}s')
+
+
+def init_app(app):
+    app.cli.add_command(replay_command)
+    app.cli.add_command(partitions_command)
+    app.cli.add_command(export_command)
@@ -1,5 +1,5 @@
 from flask import (
-    Blueprint, flash, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, redirect, render_template, request, url_for
 )
 
 from .extensions import db
@@ -18,6 +18,9 @@ def index():
 @bp.route('/add_company', methods=('GET', 'POST'))
 def add_company():
     if request.method == 'POST':
+        if current_app.config.get('WEB_READ_ONLY', False):
+            flash('Feeds cannot be edited while WEB_READ_ONLY is set')
+            return render_template('companies/add_company.html')
         company_name = request.form.get('company_name', None, type=str)
         timezone = request.form.get('timezone', None, type=str)
         if not company_name:
@@ -28,6 +31,10 @@ def add_company():
         service_alert_url = request.form.get('service_alert_url', None, type=str)
         position_url = request.form.get('vehicle_position_url', None, type=str)
         trip_update_url = request.form.get('trip_update_url', None, type=str)
+        suppress_stationary = request.form.get('suppress_stationary', None, type=str) is not None
+        stationary_distance = request.form.get('stationary_distance', 10.0, type=float)
+        heartbeat_minutes = request.form.get('heartbeat_minutes', 15, type=int)
+        retention_days = request.form.get('retention_days', None, type=int)
         '''for url in [position_url, trip_update_url, service_alert_url]:
             if not url:
                 continue
@@ -44,6 +51,10 @@ def add_company():
             feed.trip_update_url = trip_update_url
             feed.service_alert_url = service_alert_url
             feed.timezone = timezone if timezone else None
+            feed.suppress_stationary = suppress_stationary
+            feed.stationary_distance = stationary_distance
+            feed.heartbeat_minutes = heartbeat_minutes
+            feed.retention_days = retention_days
         else:
             # create new
             feed = Feed()
@@ -52,6 +63,10 @@ def add_company():
             feed.trip_update_url = trip_update_url if trip_update_url else None
             feed.service_alert_url = service_alert_url if service_alert_url else None
             feed.timezone = timezone if timezone else None
+            feed.suppress_stationary = suppress_stationary
+            feed.stationary_distance = stationary_distance
+            feed.heartbeat_minutes = heartbeat_minutes
+            feed.retention_days = retention_days
             db.session.add(feed)
         db.session.commit()
         print(f'Created company {company_name}')
@@ -0,0 +1,190 @@
+import gzip
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+
+import pytz
+
+from .extensions import db
+from .models import Feed
+
+try:
+    import pyarrow
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:  # Parquet exports need pyarrow
+    pyarrow = None
+
+CSV = 'csv'
+PARQUET = 'parquet'
+FORMATS = (CSV, PARQUET)
+EXTENSIONS = {CSV: 'csv.gz', PARQUET: 'parquet'}
+# a day is closed, and its exports cached, this long after its end in the feed timezone
+CLOSED_AFTER = timedelta(hours=1)
+# bytes of CSV converted per record batch, each batch is a Parquet row group
+PARQUET_BATCH_BYTES = 16 * 2 ** 20
+
+# rows of a feed on a day of each exported table, in COPY order, with their column types for Parquet.
+# Trip records of canceled trips have no vehicle, so no feed, and are not exported
+EXPORTS = {
+    'vehicle_position': (
+        'SELECT p.id, v.vehicle_gtfs_id AS gtfs_id, p.lat, p.lon, p.occupancy_status, p.time_recorded, '
+        'p.timestamp, p.last_timestamp, p.day '
+        'FROM vehicle_position p JOIN gtfs_vehicles v ON v.id = p.vehicle_id '
+        'WHERE v.feed_id = %(feed_id)s AND p.day = %(day)s ORDER BY p.timestamp, p.id',
+        (('id', 'int64'), ('gtfs_id', 'int64'), ('lat', 'float64'), ('lon', 'float64'),
+         ('occupancy_status', 'int64'), ('time_recorded', 'timestamp'), ('timestamp', 'timestamp'),
+         ('last_timestamp', 'timestamp'), ('day', 'date'))),
+    'trip_record': (
+        'SELECT t.id, v.vehicle_gtfs_id AS gtfs_id, t.trip_id, t.time_recorded, t.timestamp, t.day '
+        'FROM trip_record t JOIN gtfs_vehicles v ON v.id = t.vehicle_id '
+        'WHERE v.feed_id = %(feed_id)s AND t.day = %(day)s ORDER BY t.timestamp, t.id',
+        (('id', 'int64'), ('gtfs_id', 'int64'), ('trip_id', 'string'), ('time_recorded', 'timestamp'),
+         ('timestamp', 'timestamp'), ('day', 'date'))),
+    'stop_distance': (
+        'SELECT s.id, s.trip_record_id, s.stop_id, s.time_till_arrive, s.day '
+        'FROM stop_distance s JOIN trip_record t ON t.id = s.trip_record_id AND t.day = s.day '
+        'JOIN gtfs_vehicles v ON v.id = t.vehicle_id '
+        'WHERE v.feed_id = %(feed_id)s AND s.day = %(day)s ORDER BY s.trip_record_id, s.id',
+        (('id', 'int64'), ('trip_record_id', 'int64'), ('stop_id', 'int64'), ('time_till_arrive', 'int64'),
+         ('day', 'date'))),
+}
+
+
+def is_day_closed(feed: Feed, day: date, now: datetime = None):
+    """
+    :return: True if no more records can be written for day, local to the feed timezone
+    """
+    now = now or datetime.now(pytz.UTC)
+    local_now = now.astimezone(pytz.timezone(feed.timezone)).replace(tzinfo=None)
+    return datetime.combine(day + timedelta(days=1), datetime.min.time()) + CLOSED_AFTER <= local_now
+
+
+def export_path(directory: str, feed_id: int, day: date, table: str, fmt: str):
+    return os.path.join(directory, str(feed_id), day.isoformat(), f'{table}.{EXTENSIONS[fmt]}')
+
+
+def export_rows(feed_id: int, day: date, table: str):
+    """
+    :return: 'count:max id' of the rows of the feed on day of table, it changes when rows are added or deleted
+    """
+    query, _ = EXPORTS[table]
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute(f'SELECT count(*), max(id) FROM ({query.rsplit(" ORDER BY ", 1)[0]}) AS export',
+                       {'feed_id': feed_id, 'day': day})
+        count, max_id = cursor.fetchone()
+    finally:
+        cursor.close()
+    return f'{count}:{max_id}'
+
+
+def read_export_rows(path: str):
+    """
+    :return: export_rows of the rows in the export at path, None if unknown
+    """
+    try:
+        with open(f'{path}.rows') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_export_rows(path: str, rows: str):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(rows)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, f'{path}.rows')
+
+
+def copy_csv(feed_id: int, day: date, table: str, file):
+    """
+    Write the rows of the feed on day of table to file as CSV with a header, with COPY
+    """
+    query, _ = EXPORTS[table]
+    cursor = db.session.connection().connection.cursor()
+    try:
+        sql = cursor.mogrify(query, {'feed_id': feed_id, 'day': day}).decode()
+        cursor.copy_expert(f'COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+    finally:
+        cursor.close()
+
+
+def csv_to_parquet(csv_path: str, table: str, parquet_path: str):
+    """
+    Convert a CSV export to Parquet one record batch at a time, each batch is a row group
+    :return: number of rows
+    """
+    _, columns = EXPORTS[table]
+    types = {'int64': pyarrow.int64(), 'float64': pyarrow.float64(), 'string': pyarrow.string(),
+             'timestamp': pyarrow.timestamp('us'), 'date': pyarrow.date32()}
+    schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+    reader = pyarrow.csv.open_csv(csv_path,
+                                  read_options=pyarrow.csv.ReadOptions(block_size=PARQUET_BATCH_BYTES),
+                                  convert_options=pyarrow.csv.ConvertOptions(column_types=schema))
+    rows = 0
+    with pyarrow.parquet.ParquetWriter(parquet_path, schema, compression='zstd') as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_export(feed_id: int, day: date, table: str, fmt: str, path: str):
+    """
+    Export the rows of the feed on day of table to path, replaced atomically
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    os.close(fd)
+    csv_path = None
+    try:
+        if fmt == PARQUET:
+            fd, csv_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.csv')
+            with os.fdopen(fd, 'wb') as f:
+                copy_csv(feed_id, day, table, f)
+            csv_to_parquet(csv_path, table, tmp_path)
+        else:
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                copy_csv(feed_id, day, table, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    finally:
+        if csv_path is not None:
+            os.unlink(csv_path)
+
+
+def get_export(directory: str, feed: Feed, day: date, table: str, fmt: str):
+    """
+    Export of a table of a feed day. Exports of closed days are cached in directory with the count and max id of their
+    rows, and written again when those change (replay, retention). The exports of the current day are written to a
+    temporary file every time.
+    :return: (path, is temporary), None if OK. None, error if the export is not possible
+    """
+    if table not in EXPORTS:
+        return None, f'table must be one of {", ".join(EXPORTS)}'
+    if fmt not in FORMATS:
+        return None, f'format must be one of {", ".join(FORMATS)}'
+    if fmt == PARQUET and pyarrow is None:
+        return None, 'Parquet exports need pyarrow, install it or use format=csv'
+    if is_day_closed(feed, day):
+        path = export_path(directory, feed.id, day, table, fmt)
+        rows = export_rows(feed.id, day, table)
+        if not os.path.exists(path) or read_export_rows(path) != rows:
+            write_export(feed.id, day, table, fmt, path)
+            write_export_rows(path, rows)
+        return (path, False), None
+    fd, path = tempfile.mkstemp(prefix='gtfs-export-', suffix=f'.{EXTENSIONS[fmt]}')
+    os.close(fd)
+    try:
+        write_export(feed.id, day, table, fmt, path)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return (path, True), None
+
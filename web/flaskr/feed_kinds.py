@@ -0,0 +1,3 @@
+# kinds of feed url of a Feed, each fetched, written and published on its own
+VEHICLE_POSITIONS = 'vehicle_positions'
+TRIP_UPDATES = 'trip_updates'
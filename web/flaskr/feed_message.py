@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+
+from google.transit import gtfs_realtime_pb2
+
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+
+GTFS_REALTIME_VERSION = '2.0'
+
+
+def epoch(iso: str):
+    """
+    :param iso: naive UTC datetime in iso format, as in a latest state
+    :return: POSIX timestamp
+    """
+    return int(datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp())
+
+
+def last_cycle(records: dict, key: str, header_timestamp):
+    """
+    :param records: positions or trips of a state by gtfs_id
+    :param key: the record's timestamp of its last snapshot
+    :param header_timestamp: header timestamp of the last published snapshot, None if the state was not published
+    :return: list of (gtfs_id, record) of the vehicles of the last snapshot
+    """
+    timestamps = {gtfs_id: epoch(record[key]) for gtfs_id, record in records.items()}
+    if header_timestamp is None:
+        # loaded from LatestRecords, the last snapshot is the latest of the records
+        header_timestamp = max(timestamps.values(), default=None)
+    return [(gtfs_id, record) for gtfs_id, record in records.items() if timestamps[gtfs_id] == header_timestamp]
+
+
+def build_feed_message(state: dict, kinds=(VEHICLE_POSITIONS, TRIP_UPDATES)):
+    """
+    A full dataset GTFS-realtime feed of the vehicles of the last snapshots of a feed: one vehicle entity per
+    position, with its active trip, and one trip_update entity per active trip with its next and previous stops
+    :param kinds: VEHICLE_POSITIONS and/or TRIP_UPDATES
+    :return: FeedMessage
+    """
+    header_timestamps = state['header_timestamps']
+    message = gtfs_realtime_pb2.FeedMessage()
+    message.header.gtfs_realtime_version = GTFS_REALTIME_VERSION
+    message.header.incrementality = gtfs_realtime_pb2.FeedHeader.FULL_DATASET
+    trips = state['trips']
+    timestamps = []
+    if VEHICLE_POSITIONS in kinds:
+        for gtfs_id, position in last_cycle(state['positions'], 'last_timestamp',
+                                            header_timestamps.get(VEHICLE_POSITIONS, None)):
+            entity = message.entity.add()
+            entity.id = f'vehicle-{gtfs_id}'
+            vehicle = entity.vehicle
+            vehicle.vehicle.id = gtfs_id
+            vehicle.position.latitude = position['lat']
+            vehicle.position.longitude = position['lon']
+            vehicle.timestamp = epoch(position['last_timestamp'])
+            if position['occupancy_status'] is not None:
+                vehicle.occupancy_status = position['occupancy_status']
+            trip = trips.get(gtfs_id, None)
+            if trip is not None:
+                vehicle.trip.trip_id = trip['trip_id']
+            timestamps.append(vehicle.timestamp)
+    if TRIP_UPDATES in kinds:
+        for gtfs_id, trip in last_cycle(trips, 'timestamp', header_timestamps.get(TRIP_UPDATES, None)):
+            entity = message.entity.add()
+            entity.id = f'trip-{gtfs_id}'
+            trip_update = entity.trip_update
+            trip_update.trip.trip_id = trip['trip_id']
+            trip_update.vehicle.id = gtfs_id
+            trip_update.timestamp = epoch(trip['timestamp'])
+            # stop times are relative to the snapshot, stop_time_updates are ordered by arrival
+            for stop in sorted(trip['stops'], key=lambda s: s['time_till_arrive']):
+                stop_time_update = trip_update.stop_time_update.add()
+                stop_time_update.stop_id = str(stop['stop_id'])
+                stop_time_update.arrival.time = trip_update.timestamp + stop['time_till_arrive']
+            timestamps.append(trip_update.timestamp)
+    message.header.timestamp = max(timestamps, default=0)
+    return message
@@ -0,0 +1,30 @@
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .extensions import db
+from .models import Feed, FeedVersion
+
+
+def bump_feed_versions(feed_ids=None):
+    """
+    Increase the version of feeds in the current transaction, so it changes when their records are committed.
+    Every writer of records calls it: ingestion, replay and retention.
+    :param feed_ids: ids of the feeds, None for every feed
+    """
+    if feed_ids is None:
+        stmt = pg_insert(FeedVersion).from_select(['feed_id', 'version'], select(Feed.id, 1))
+    elif not feed_ids:
+        return
+    else:
+        # rows are locked in feed_id order so concurrent writers can't deadlock
+        stmt = pg_insert(FeedVersion).values([{'feed_id': feed_id, 'version': 1} for feed_id in sorted(feed_ids)])
+    stmt = stmt.on_conflict_do_update(index_elements=[FeedVersion.feed_id],
+                                      set_={'version': FeedVersion.version + 1})
+    db.session.execute(stmt)
+
+
+def get_feed_version(feed_id: int):
+    """
+    :return: committed version of the feed's records, 0 if they were never written
+    """
+    return db.session.execute(select(FeedVersion.version).where(FeedVersion.feed_id == feed_id)).scalar() or 0
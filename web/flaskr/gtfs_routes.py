@@ -1,16 +1,15 @@
-import json
 from datetime import datetime
 
 import pytz
 from flask import (
     Blueprint, current_app, abort, render_template, request
 )
-from sqlalchemy import func, and_
-from sqlalchemy.orm import aliased
+from sqlalchemy import and_, select
 
 from .extensions import db
-from .models import Vehicles, Feed, VehiclePosition, TripRecord
-from .queries import vehicle_ids_to_gtfs_ids_mapped
+from .models import Vehicles, Feed, VehiclePosition, TripRecord, TripSegment, StopDistance
+from .pagination import KeysetPage
+from .streaming import stream_rows, STREAM_BATCH_ROWS
 
 error_log = current_app.config.get("ERROR_LOG", None)
 bp = Blueprint('gtfs_routes', __name__)
@@ -39,55 +38,46 @@ def display_vehicle_summary(feed_id):
     trip_ids = request.form.get('trip_ids', "", type=str).replace("'", "").replace(" ", "").split(',')
     requested_day = request.form.get('date', datetime.now(pytz.timezone(feed.timezone)).date(), type=str)
     page = request.form.get('page', 1, type=int)
-    per_page = request.form.get('per_page', PER_PAGE_DEFAULT, type=int)
+    per_page = min(max(request.form.get('per_page', PER_PAGE_DEFAULT, type=int), 1), MAX_PER_PAGE)
+    # cursors of the page the user comes from, see KeysetPage
+    after = request.form.get('after', None, type=str)
+    before = request.form.get('before', None, type=str)
     if request.method == "POST":
-        first_trip = aliased(TripRecord)
-        last_trip = aliased(TripRecord)
-        vehicle_ids = vehicle_ids_to_gtfs_ids_mapped(feed_id)
-
-        first_trip_subquery = db.session.query(
-            TripRecord.vehicle_id,
-            func.min(TripRecord.timestamp).label("first_timestamp")) \
-            .filter(TripRecord.vehicle_id.in_(vehicle_ids),
-                    TripRecord.trip_id.in_(trip_ids),
-                    TripRecord.day == requested_day) \
-            .group_by(TripRecord.vehicle_id).subquery()
-
-        last_trip_subquery = db.session.query(
-            TripRecord.vehicle_id,
-            func.max(TripRecord.timestamp).label("last_timestamp")
-        ).filter(TripRecord.vehicle_id.in_(vehicle_ids),
-                 TripRecord.trip_id.in_(trip_ids),
-                 TripRecord.day == requested_day)\
-            .group_by(TripRecord.vehicle_id).subquery()
-
-        data = db.session.query(first_trip_subquery.c.vehicle_id,
-                                first_trip.trip_id,
-                                first_trip_subquery.c.first_timestamp,
-                                last_trip.trip_id,
-                                last_trip_subquery.c.last_timestamp) \
-            .join(last_trip_subquery, last_trip_subquery.c.vehicle_id == first_trip_subquery.c.vehicle_id) \
-            .join(first_trip,
-                  and_(first_trip.vehicle_id == first_trip_subquery.c.vehicle_id,
-                       first_trip.timestamp == first_trip_subquery.c.first_timestamp)) \
-            .join(last_trip,
-                  and_(last_trip.vehicle_id == last_trip_subquery.c.vehicle_id,
-                       last_trip.timestamp == last_trip_subquery.c.last_timestamp)) \
-            .order_by(first_trip_subquery.c.vehicle_id.asc()) \
-            .paginate(page=page,
-                      per_page=per_page,
-                      max_per_page=MAX_PER_PAGE,
-                      error_out=False)
+        # per vehicle, the segment of the requested trips that started first and the one that ended last
+        first_trips = db.session.query(TripSegment.vehicle_id, TripSegment.trip_id, TripSegment.first_timestamp) \
+            .filter(TripSegment.feed_id == feed_id,
+                    TripSegment.day == requested_day,
+                    TripSegment.trip_id.in_(trip_ids)) \
+            .distinct(TripSegment.vehicle_id) \
+            .order_by(TripSegment.vehicle_id, TripSegment.first_timestamp.asc()).subquery()
+
+        last_trips = db.session.query(TripSegment.vehicle_id, TripSegment.trip_id, TripSegment.last_timestamp) \
+            .filter(TripSegment.feed_id == feed_id,
+                    TripSegment.day == requested_day,
+                    TripSegment.trip_id.in_(trip_ids)) \
+            .distinct(TripSegment.vehicle_id) \
+            .order_by(TripSegment.vehicle_id, TripSegment.last_timestamp.desc()).subquery()
+
+        query = db.session.query(first_trips.c.vehicle_id,
+                                 Vehicles.vehicle_gtfs_id,
+                                 first_trips.c.trip_id,
+                                 first_trips.c.first_timestamp,
+                                 last_trips.c.trip_id,
+                                 last_trips.c.last_timestamp) \
+            .select_from(first_trips) \
+            .join(last_trips, last_trips.c.vehicle_id == first_trips.c.vehicle_id) \
+            .join(Vehicles, Vehicles.id == first_trips.c.vehicle_id)
+        data = KeysetPage(query, [first_trips.c.vehicle_id], per_page, after=after, before=before, page=page,
+                          count_key=('trip_segment', feed_id, requested_day, tuple(trip_ids)))
         if data.items:
             items = []
             for entry in data.items:
-                gtfs_id = vehicle_ids.get(entry[0], None)
                 items.append(
-                    {'gtfs_id': gtfs_id,
-                     'first_trip': entry[1],
-                     'first_trip_start': entry[2].isoformat(),
-                     'last_trip': entry[-2],
-                     'last_trip_end': entry[-1].isoformat()})
+                    {'gtfs_id': entry[1],
+                     'first_trip': entry[2],
+                     'first_trip_start': entry[3].isoformat(),
+                     'last_trip': entry[4],
+                     'last_trip_end': entry[5].isoformat()})
             data.items = items
         trip_ids_str = ','.join(trip_ids)
         return render_template('gtfs/vehicle_summary.html', feed=feed, date=requested_day, trips=trip_ids_str,
@@ -106,12 +96,15 @@ def get_vehicle_position(feed_id: int, vehicle_id: int):
         abort(404, f"Vehicle doesn't exist.")
     requested_day = request.form.get('date', datetime.now(pytz.timezone(feed.timezone)).date(), type=str)
     page = request.form.get('page', 1, type=int)
-    per_page = request.form.get('per_page', PER_PAGE_DEFAULT, type=int)
-
-    data = db.session.query(VehiclePosition) \
-        .filter_by(vehicle_id=vehicle.id, day=requested_day) \
-        .order_by(VehiclePosition.timestamp.desc()) \
-        .paginate(page=page, per_page=per_page, max_per_page=MAX_PER_PAGE, error_out=False)
+    per_page = min(max(request.form.get('per_page', PER_PAGE_DEFAULT, type=int), 1), MAX_PER_PAGE)
+    # cursors of the page the user comes from, see KeysetPage
+    after = request.form.get('after', None, type=str)
+    before = request.form.get('before', None, type=str)
+
+    query = db.session.query(VehiclePosition) \
+        .filter_by(vehicle_id=vehicle.id, day=requested_day)
+    data = KeysetPage(query, [VehiclePosition.timestamp, VehiclePosition.id], per_page, after=after, before=before,
+                      page=page, descending=True, count_key=('vehicle_position', vehicle.id, requested_day))
     for i in range(len(data.items)):
         item = data.items[i].to_dict_ui()
         data.items[i] = item
@@ -129,11 +122,14 @@ def get_vehicle_trip_updates(feed_id: id, vehicle_id: int):
         abort(404, f"Vehicle doesn't exist.")
     requested_day = request.form.get('date', datetime.now(pytz.timezone(feed.timezone)).date(), type=str)
     page = request.form.get('page', 1, type=int)
-    per_page = request.form.get('per_page', PER_PAGE_DEFAULT, type=int)
-    data = db.session.query(TripRecord) \
-        .filter(TripRecord.vehicle_id == vehicle.id, TripRecord.day == requested_day) \
-        .order_by(TripRecord.timestamp.desc()) \
-        .paginate(page=page, per_page=per_page, max_per_page=MAX_PER_PAGE, error_out=False)
+    per_page = min(max(request.form.get('per_page', PER_PAGE_DEFAULT, type=int), 1), MAX_PER_PAGE)
+    # cursors of the page the user comes from, see KeysetPage
+    after = request.form.get('after', None, type=str)
+    before = request.form.get('before', None, type=str)
+    query = db.session.query(TripRecord) \
+        .filter(TripRecord.vehicle_id == vehicle.id, TripRecord.day == requested_day)
+    data = KeysetPage(query, [TripRecord.timestamp, TripRecord.id], per_page, after=after, before=before,
+                      page=page, descending=True, count_key=('trip_record', vehicle.id, requested_day))
     for i in range(len(data.items)):
         data.items[i].stops = sorted(data.items[i].stops, key=lambda x: x.time_till_arrive, reverse=True)
     return render_template('gtfs/vehicle_trip_updates.html', feed=feed, vehicle_id=vehicle.vehicle_gtfs_id,
@@ -142,32 +138,56 @@ def get_vehicle_trip_updates(feed_id: id, vehicle_id: int):
 
 @bp.route('/<int:feed_id>/get/vehicle_position/<int:vehicle_id>/dump', methods=('GET', 'POST'))
 def get_vehicle_position_dump(feed_id: int, vehicle_id: int):
+    """
+    All the positions of a vehicle, latest first, streamed from a server-side cursor (format=ndjson for NDJSON)
+    """
     vehicle = Vehicles.query.filter_by(feed_id=feed_id, id=vehicle_id).first()
     if vehicle is None:
         abort(404, f"Vehicle doesn't exist.")
 
-    data = db.session.query(VehiclePosition).filter_by(vehicle_id=vehicle_id) \
-        .order_by(VehiclePosition.timestamp.desc()).all()
-
-    gtfs = {"vehicle": vehicle.to_dict(), "count": len(data), "data": [d.to_dict() for d in data]}
-    return json.dumps(gtfs)
+    result = db.session.execute(
+        select(VehiclePosition.lat, VehiclePosition.lon, VehiclePosition.occupancy_status,
+               VehiclePosition.time_recorded, VehiclePosition.timestamp, VehiclePosition.last_timestamp,
+               VehiclePosition.day)
+        .where(VehiclePosition.vehicle_id == vehicle_id)
+        .order_by(VehiclePosition.timestamp.desc())
+        .execution_options(yield_per=STREAM_BATCH_ROWS))
+    # rows have the columns read by to_dict, no ORM object is built
+    return stream_rows({"vehicle": vehicle.to_dict()}, (VehiclePosition.to_dict(row) for row in result))
 
 
 @bp.route('/<int:feed_id>/get/trip_updates/<int:vehicle_id>/dump', methods=('GET', 'POST'))
 def get_vehicle_trip_updates_dump(feed_id: int, vehicle_id: int):
+    """
+    All the trip records of a vehicle with their stops, latest first, streamed from a server-side cursor
+    (format=ndjson for NDJSON)
+    """
     vehicle = Vehicles.query.filter_by(feed_id=feed_id, id=vehicle_id).first()
     if vehicle is None:
         abort(404, f"Vehicle doesn't exist.")
 
-    data = []
-    trips = TripRecord.query.filter_by(vehicle_id=vehicle_id) \
-        .order_by(TripRecord.timestamp.desc()).all()
-    for trip in trips:
-        entry = {}
-        entry.update({'trip': trip.to_dict()})
-        stops_list = [stop.to_dict() for stop in trip.stops]
-        entry.update({'stops': stops_list})
-        data.append(entry)
-
-    gtfs = {"vehicle": vehicle.to_dict(), "count": len(data), "data": data}
-    return json.dumps(gtfs)
+    # one row per stop of each trip record, the rows of a trip record follow each other
+    result = db.session.execute(
+        select(TripRecord.id, TripRecord.trip_id, TripRecord.time_recorded, TripRecord.timestamp, TripRecord.day,
+               StopDistance.stop_id, StopDistance.time_till_arrive)
+        .outerjoin(StopDistance, and_(StopDistance.trip_record_id == TripRecord.id,
+                                      StopDistance.day == TripRecord.day))
+        .where(TripRecord.vehicle_id == vehicle_id)
+        .order_by(TripRecord.timestamp.desc(), TripRecord.id.desc())
+        .execution_options(yield_per=STREAM_BATCH_ROWS))
+
+    def trips():
+        trip_record_id, trip, stops = None, None, []
+        for row in result:
+            if row.id != trip_record_id:
+                if trip is not None:
+                    yield {'trip': trip, 'stops': stops}
+                trip_record_id, trip, stops = row.id, TripRecord.to_dict(row), []
+            if row.stop_id is not None:
+                stops.append({'trip_record_id': row.id,
+                              'stop_id': row.stop_id,
+                              'time_till_arrive': row.time_till_arrive})
+        if trip is not None:
+            yield {'trip': trip, 'stops': stops}
+
+    return stream_rows({"vehicle": vehicle.to_dict()}, trips())
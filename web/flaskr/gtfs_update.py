@@ -1,268 +1,509 @@
+import threading
+
 import pytz
 import requests
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from google.transit import gtfs_realtime_pb2
-from sqlalchemy import and_
+from sqlalchemy import func, insert, literal_column, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from .extensions import db, scheduler
+from .feed_versions import bump_feed_versions
+from .partitions import ensure_partitions
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+from .latest_state import latest_state, trip_state
 from .logs import add_to_error_log
-from .models import Vehicles, Feed, VehiclePosition, TripRecord, StopDistance, LatestRecords
-from .queries import gtfs_ids_to_vehicle_ids_mapped
-
-
-def add_vehicle(feed_id: int, gtfs_id: int):
-    error = None
-    if feed_id is None:
-        error = f"add_vehicle Error: cannot add vehicle. No feed id given: {feed_id}"
-    if gtfs_id is None:
-        error = f"add_vehicle Error: cannot add vehicle. No gtfs_id: {gtfs_id}"
-    if error is None:
-        # print(f"Attempt to add vehicle: feed: {feed_id} , gtfs: {gtfs_id}")
-        vehicle = db.session.query(Vehicles).filter(
-            and_(Vehicles.feed_id == feed_id, Vehicles.vehicle_gtfs_id == gtfs_id)).first()
-        if vehicle is not None:
-            print(f'add_vehicle Error: '
-                  f'vehicle already exist for feed: {feed_id}. gtfs_id: {gtfs_id}')
-            return vehicle.id, None
-        else:
-            vehicle = Vehicles()
-            vehicle.feed_id = feed_id
-            vehicle.vehicle_gtfs_id = gtfs_id
-            try:
-                db.session.add(vehicle)
-                db.session.commit()
-                return vehicle.id, None
-            except BaseException as e:
-                error = f"add_vehicle Error: {e}"
-    return None, error
-
-
-def generate_feed(url: str):
+from .models import Feed, Vehicles, VehiclePosition, TripRecord, StopDistance, LatestRecords, TripSegment
+from .stationary import stationary_filter
+from .vehicle_registry import vehicle_registry
+
+
+# state of each feed url is keyed by (feed_id, kind): feeds may share a url, one job per key runs at a time
+# one keep-alive session per feed url, reused across update cycles
+_sessions = {}
+_sessions_lock = threading.Lock()
+# key: (url, ETag, Last-Modified) of the last processed response, sent back as If-None-Match/If-Modified-Since
+_cache_validators = {}
+# key: (url, ETag, Last-Modified) of the last fetched response, not yet processed
+_pending_validators = {}
+# key: header.timestamp of the last processed snapshot
+_last_header_timestamps = {}
+
+
+def feed_key(feed_id: int, kind: str):
+    return feed_id, kind
+
+
+def get_session(key):
+    with _sessions_lock:
+        session = _sessions.get(key, None)
+        if session is None:
+            session = requests.Session()
+            session.verify = False
+            _sessions[key] = session
+        return session
+
+
+def forget_feed(feed_id: int):
+    """
+    Drop what was remembered of the snapshots of a feed, so its next snapshots are fetched and written in full
+    """
+    for key in (feed_key(feed_id, VEHICLE_POSITIONS), feed_key(feed_id, TRIP_UPDATES)):
+        _cache_validators.pop(key, None)
+        _pending_validators.pop(key, None)
+        _last_header_timestamps.pop(key, None)
+
+
+def fetch_feed(key, url: str, read_timeout: float = 30):
+    """
+    Download a feed. A server that sends nothing for read_timeout seconds fails the fetch
+    :param key: feed_key of the feed url
+    :return: content, None if OK. None, None if feed was not modified since it was last processed. None, error
+    """
     try:
-        response = requests.get(url, allow_redirects=True, verify=False, timeout=(5, None))
+        headers = {}
+        validators_url, etag, last_modified = _cache_validators.get(key, (None, None, None))
+        if validators_url == url:
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response = get_session(key).get(url, headers=headers, allow_redirects=True, timeout=(5, read_timeout))
+        if response.status_code == 304:
+            return None, None
         response.raise_for_status()
+        _pending_validators[key] = (url, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return response.content, None
+    except requests.Timeout as e:
+        error = f'fetch_feed Timeout: {e}'
+        return None, error
+    except BaseException as e:
+        error = f'fetch_feed Error: {e}'
+        return None, error
+
+
+def parse_feed(content: bytes):
+    """
+    :return: FeedMessage, None if OK. None, error
+    """
+    try:
         feed = gtfs_realtime_pb2.FeedMessage()
-        feed.ParseFromString(response.content)
+        feed.ParseFromString(content)
         return feed, None
     except BaseException as e:
-        error = f'generate_feed Error: {e}'
+        error = f'parse_feed Error: {e}'
         return None, error
 
 
+def generate_feed(key, url: str, read_timeout: float = 30):
+    """
+    Fetch and parse a feed
+    :return: feed, None if OK. None, None if feed was not modified since it was last processed. None, error
+    """
+    content, error = fetch_feed(key, url, read_timeout)
+    if content is None:
+        return None, error
+    return parse_feed(content)
+
+
+def is_feed_processed(key, feed):
+    """
+    :return: True if the snapshot has the same header timestamp as the last processed snapshot of key
+    """
+    return feed.header.timestamp != 0 and _last_header_timestamps.get(key, None) == feed.header.timestamp
+
+
+def mark_feed_processed(key, feed):
+    """
+    Remember the header timestamp and cache validators of a processed snapshot.
+    Only called once the snapshot is committed, so a failed update is fetched again in full.
+    """
+    _last_header_timestamps[key] = feed.header.timestamp
+    if key in _pending_validators:
+        _cache_validators[key] = _pending_validators.pop(key)
+
+
+def upsert_latest_records(model, day, timestamp: datetime, record_ids: dict):
+    """
+    Point each vehicle's LatestRecords row at its new record with one INSERT ... ON CONFLICT (vehicle_id) DO UPDATE.
+    Only the columns of model are set, so the position and trip update writers don't overwrite each other's records.
+    Snapshots may be written out of order (replay): a vehicle whose latest record is newer than timestamp keeps it.
+    :param model: VehiclePosition or TripRecord
+    :param day: day of the records
+    :param timestamp: header timestamp of the records
+    :param record_ids: dict of vehicle_id: record id
+    :return: number of vehicles upserted
+    """
+    if not record_ids:
+        return 0
+    if model is VehiclePosition:
+        column, day_column = LatestRecords.vehicle_position_id, LatestRecords.vehicle_position_day
+        # a stationary position is extended up to its last_timestamp
+        latest_timestamp = func.coalesce(VehiclePosition.last_timestamp, VehiclePosition.timestamp)
+    else:
+        column, day_column = LatestRecords.trip_record_id, LatestRecords.trip_record_day
+        latest_timestamp = TripRecord.timestamp
+    # rows are locked in vehicle_id order so concurrent writers can't deadlock
+    stmt = pg_insert(LatestRecords).values([{'vehicle_id': vehicle_id, column.key: record_ids[vehicle_id],
+                                             day_column.key: day} for vehicle_id in sorted(record_ids)])
+    # the conflicting row is referenced by name, the subquery of an ON CONFLICT WHERE is not correlated
+    current_id = literal_column(f'{LatestRecords.__tablename__}.{column.key}')
+    current_day = literal_column(f'{LatestRecords.__tablename__}.{day_column.key}')
+    newer = select(model.id).where(model.id == current_id, model.day == current_day, latest_timestamp > timestamp)
+    stmt = stmt.on_conflict_do_update(index_elements=[LatestRecords.vehicle_id],
+                                      set_={column.key: stmt.excluded[column.key],
+                                            day_column.key: stmt.excluded[day_column.key]},
+                                      where=~newer.exists())
+    db.session.execute(stmt)
+    return len(record_ids)
+
+
+def upsert_trip_segments(feed_id: int, day, timestamp: datetime, trip_ids: dict):
+    """
+    Extend the TripSegment of each vehicle's trip on day with a new trip record, in one INSERT ... ON CONFLICT.
+    Snapshots may be written out of order (replay), so the first and last timestamps are compared, not replaced.
+    :param trip_ids: dict of vehicle_id: trip_id
+    :return: number of segments upserted
+    """
+    if not trip_ids:
+        return 0
+    # rows are locked in primary key order so concurrent writers can't deadlock
+    rows = sorted((trip_id, vehicle_id) for vehicle_id, trip_id in trip_ids.items())
+    stmt = pg_insert(TripSegment).values([{'feed_id': feed_id, 'day': day, 'trip_id': trip_id, 'vehicle_id': vehicle_id,
+                                           'first_timestamp': timestamp, 'last_timestamp': timestamp,
+                                           'record_count': 1} for trip_id, vehicle_id in rows])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TripSegment.feed_id, TripSegment.day, TripSegment.trip_id, TripSegment.vehicle_id],
+        set_={'first_timestamp': func.least(TripSegment.first_timestamp, stmt.excluded.first_timestamp),
+              'last_timestamp': func.greatest(TripSegment.last_timestamp, stmt.excluded.last_timestamp),
+              'record_count': TripSegment.record_count + 1})
+    db.session.execute(stmt)
+    return len(rows)
+
+
 def update_vehicle_position(feed_id, time_recorded=datetime.utcnow().replace(microsecond=0)):
     with scheduler.app.app_context():
         feed_data = db.session.query(Feed).filter_by(id=feed_id).first()
         url = feed_data.vehicle_position_url
-        timezone = feed_data.timezone
+        key = feed_key(feed_id, VEHICLE_POSITIONS)
         error_source = f'{feed_data.company_name}({feed_id})'
-        feed, error = generate_feed(url)
-        if feed is None:
+        feed, error = generate_feed(key, url, scheduler.app.config.get('FEED_READ_TIMEOUT', 30))
+        if error:
             add_to_error_log('update_vehicle_position', f'Failed to retrieve feed for {error_source}\n{error}')
-            return
-        timestamp = datetime.utcfromtimestamp(feed.header.timestamp)
-        target_tz = pytz.timezone(timezone)
-        target_datetime = timestamp.astimezone(target_tz)
-        local_date = target_datetime.date()
-
-        gtfs_id_list = gtfs_ids_to_vehicle_ids_mapped(feed_id)
-        rows_added = 0
-        last_records_updated = 0
-        for entity in feed.entity:
-            error = None
-            if not entity.HasField('vehicle'):
-                continue
-            if not entity.vehicle.HasField('vehicle'):
-                error = f'{error_source}: vehicle information missing\n{entity}'
-            if not entity.vehicle.HasField('position'):
-                error = f'{error_source}: trip missing positional data\n{entity}'
-            if not entity.vehicle.vehicle.id:
-                error = f'{error_source}: vehicle id missing\n{entity}'
-            if error:
-                add_to_error_log('update_vehicle_position', f'{error_source}\n{error}')
+            return None
+        if feed is None or is_feed_processed(key, feed):
+            if feed is not None:
+                mark_feed_processed(key, feed)
+            print(f'Feed: {error_source} | positions not modified')
+            return 0
+        rows_added = write_vehicle_positions(feed_data, feed, time_recorded)
+        mark_feed_processed(key, feed)
+        return rows_added
+
+
+def write_vehicle_positions(feed_data: Feed, feed, time_recorded: datetime, publish: bool = True):
+    """
+    Add the vehicle positions of a snapshot to the db and commit
+    :param publish: publish the snapshot to the latest state, False for archived snapshots
+    :return: number of positions added
+    """
+    feed_id = feed_data.id
+    timezone = feed_data.timezone
+    error_source = f'{feed_data.company_name}({feed_id})'
+    timestamp = datetime.utcfromtimestamp(feed.header.timestamp)
+    target_tz = pytz.timezone(timezone)
+    target_datetime = timestamp.astimezone(target_tz)
+    local_date = target_datetime.date()
+    ensure_partitions(local_date)
+
+    vehicle_entities = []
+    for entity in feed.entity:
+        error = None
+        if not entity.HasField('vehicle'):
+            continue
+        if not entity.vehicle.HasField('vehicle'):
+            error = f'{error_source}: vehicle information missing\n{entity}'
+        if not entity.vehicle.HasField('position'):
+            error = f'{error_source}: trip missing positional data\n{entity}'
+        if not entity.vehicle.vehicle.id:
+            error = f'{error_source}: vehicle id missing\n{entity}'
+        if error:
+            add_to_error_log('update_vehicle_position', f'{error_source}\n{error}')
+            continue
+        vehicle_entities.append((int(entity.vehicle.vehicle.id), entity))
+
+    # new vehicles in the snapshot are registered in one batch
+    gtfs_id_list, error = vehicle_registry.get_vehicle_ids(feed_id, {gtfs_id for gtfs_id, _ in vehicle_entities})
+    if error:
+        add_to_error_log('update_vehicle_position', f'{error_source}\n{error}')
+    positions = []
+    for gtfs_id, entity in vehicle_entities:
+        vehicle_id = gtfs_id_list.get(gtfs_id, None)
+        if vehicle_id is None:
+            continue
+        occupancy_status = entity.vehicle.occupancy_status
+        positions.append({'vehicle_id': int(vehicle_id),
+                          'lat': float(entity.vehicle.position.latitude),
+                          'lon': float(entity.vehicle.position.longitude),
+                          'occupancy_status': occupancy_status if occupancy_status is not None else None,
+                          'timestamp': timestamp,
+                          'time_recorded': time_recorded,
+                          'day': local_date})
+
+    snapshot_vehicle_ids = [position['vehicle_id'] for position in positions]
+    stationary_ids = []
+    if feed_data.suppress_stationary:
+        # vehicles that have not moved extend their last written position instead of adding a row
+        positions, stationary_ids = stationary_filter.split(feed_data, positions)
+        if stationary_ids:
+            db.session.execute(update(VehiclePosition)
+                               .where(VehiclePosition.id.in_(stationary_ids), VehiclePosition.day == local_date)
+                               .values(last_timestamp=func.greatest(VehiclePosition.last_timestamp, timestamp))
+                               .execution_options(synchronize_session=False))
+
+    # insert the whole snapshot in one multi-row INSERT ... RETURNING, then link the ids to the latest records
+    position_ids = {}  # vehicle_id: vehicle_position_id
+    if positions:
+        result = db.session.execute(
+            insert(VehiclePosition).returning(VehiclePosition.id, VehiclePosition.vehicle_id,
+                                              sort_by_parameter_order=True),
+            positions)
+        position_ids = {row.vehicle_id: row.id for row in result}
+    rows_added = len(positions)
+    last_records_updated = upsert_latest_records(VehiclePosition, local_date, timestamp, position_ids)
+    print(f'Feed: {error_source} | {rows_added} positions added | {len(stationary_ids)} stationary')
+    print(f'Last Records updated: {last_records_updated}')
+    bump_feed_versions([feed_id])
+    db.session.commit()
+    if feed_data.suppress_stationary:
+        stationary_filter.update(feed_id, positions, position_ids)
+    if not publish:
+        return rows_added
+    gtfs_ids = {vehicle_id: gtfs_id for gtfs_id, vehicle_id in gtfs_id_list.items()}
+    latest_state.publish_positions(feed_id, feed.header.timestamp,
+                                   {gtfs_ids[position['vehicle_id']]: position for position in positions},
+                                   {gtfs_ids[vehicle_id]: timestamp for vehicle_id in snapshot_vehicle_ids
+                                    if vehicle_id not in position_ids})
+    return rows_added
+
+
+class TripCandidate:
+    """
+    A trip and its next and previous stops, kept only while it is the best active trip candidate of a vehicle,
+    so no ORM objects are built for the trips that are not persisted
+    """
+    __slots__ = ('trip_id', 'next_stop_id', 'next_stop_time', 'prev_stop_id', 'prev_stop_time', 'arrive_time')
+
+    def __init__(self, trip_id, next_stop_id, next_stop_time, prev_stop_id, prev_stop_time, arrive_time):
+        self.trip_id = trip_id
+        self.next_stop_id = next_stop_id
+        self.next_stop_time = next_stop_time
+        self.prev_stop_id = prev_stop_id
+        self.prev_stop_time = prev_stop_time
+        self.arrive_time = arrive_time
+
+
+def select_active_trips(entities, timestamp: int, gtfs_id_dict: dict):
+    """
+    For each vehicle, find the next stop (first arrival after timestamp) and previous stop (last arrival at or
+    before timestamp) of each of its trips, and pick the trip whose next stop, or else previous stop, is closest
+    to timestamp
+    :param entities: trip_update entities that are not canceled
+    :param timestamp: feed header timestamp
+    :param gtfs_id_dict: dict of gtfs_id: vehicle_id
+    :return: dict of vehicle_id: TripCandidate
+    """
+    scheduled = StopDistance.SCHEDULED
+    active_trips = {}
+    for entity in entities:
+        trip_update = entity.trip_update
+        if not trip_update.HasField('vehicle') or not trip_update.vehicle.id:
+            continue
+        vehicle_id = gtfs_id_dict.get(int(trip_update.vehicle.id), None)
+        if vehicle_id is None:
+            # vehicle could not be registered
+            continue
+        # STOP TIME
+        next_stop_id = None
+        prev_stop_id = None
+        next_stop_time = float('+inf')  # by time
+        prev_stop_time = float('-inf')
+        for stop in trip_update.stop_time_update:
+            if stop.schedule_relationship != scheduled:
+                # stop is either skipped or no_data
                 continue
-            gtfs_id = int(entity.vehicle.vehicle.id)
-            if gtfs_id not in gtfs_id_list:
-                vehicle_id, error = add_vehicle(feed_id, gtfs_id)
-                if vehicle_id is None:
-                    add_to_error_log('update_vehicle_position', f'{error}\n{entity}')
-                    continue
-                gtfs_id_list.update({gtfs_id: vehicle_id})
-            else:
-                vehicle_id = gtfs_id_list[gtfs_id]
-
-            pos = VehiclePosition()
-            pos.vehicle_id = int(vehicle_id)
-            pos.lat = float(entity.vehicle.position.latitude)
-            pos.lon = float(entity.vehicle.position.longitude)
-            occupancy_status = entity.vehicle.occupancy_status
-            pos.occupancy_status = occupancy_status if occupancy_status is not None else None
-            pos.timestamp = timestamp
-            pos.time_recorded = time_recorded
-            pos.day = local_date
-            db.session.add(pos)
-            rows_added += 1
-            db.session.flush()
-
-            # update latest record
-            exists = db.session.query(LatestRecords).filter(LatestRecords.vehicle_id == vehicle_id).first()
-            if exists is not None:
-                exists.vehicle_position_id = pos.id
-                last_records_updated += 1
-            else:
-                exists = LatestRecords()
-                exists.vehicle_id = vehicle_id
-                exists.vehicle_position_id = pos.id
-                db.session.add(exists)
-        print(f'Feed: {error_source} | {rows_added} positions added')
-        print(f'Last Records updated: {last_records_updated}')
-        db.session.commit()
+            time_diff = stop.arrival.time - timestamp
+            if 0 < time_diff < next_stop_time:
+                next_stop_id = stop.stop_id
+                next_stop_time = time_diff
+            elif 0 >= time_diff > prev_stop_time:
+                prev_stop_id = stop.stop_id
+                prev_stop_time = time_diff
+        if not next_stop_id and not prev_stop_id:
+            # TODO ask if to treat this case as a canceled trip
+            continue
+        arrive_time = next_stop_time if next_stop_id is not None else prev_stop_time
+        curr = active_trips.get(vehicle_id, None)
+        curr_arrive_time = curr.arrive_time if curr is not None else float('+inf')
+        # get trip with has its arrive_time closest to 0
+        if (0 < arrive_time < curr_arrive_time) \
+                or (curr_arrive_time <= 0 < arrive_time) \
+                or (curr_arrive_time < arrive_time <= 0):
+            active_trips[vehicle_id] = TripCandidate(trip_update.trip.trip_id, next_stop_id, next_stop_time,
+                                                     prev_stop_id, prev_stop_time, arrive_time)
+    return active_trips
+
+
+def is_trip_canceled(entity):
+    return entity.trip_update.trip.HasField('schedule_relationship') and \
+        entity.trip_update.trip.schedule_relationship == TripRecord.CANCELED
+
+
+def get_recorded_header_timestamps(feed_id: int, kind: str, first_timestamp: int, last_timestamp: int):
+    """
+    :return: set of the header timestamps between first_timestamp and last_timestamp included of the snapshots of a
+    feed that added records, for replay to skip them
+    """
+    model = VehiclePosition if kind == VEHICLE_POSITIONS else TripRecord
+    first, last = datetime.utcfromtimestamp(first_timestamp), datetime.utcfromtimestamp(last_timestamp)
+    # days are local to the feed, a day on each side covers every timezone
+    rows = db.session.execute(
+        select(model.timestamp).distinct()
+        .join(Vehicles, Vehicles.id == model.vehicle_id)
+        .where(Vehicles.feed_id == feed_id,
+               model.day.between((first - timedelta(days=1)).date(), (last + timedelta(days=1)).date()),
+               model.timestamp.between(first, last))).all()
+    return {int((row.timestamp - datetime(1970, 1, 1)).total_seconds()) for row in rows}
+
+
+def get_recorded_canceled_trip_ids(day, trip_ids):
+    """
+    :return: set of the trip_ids that already have a canceled TripRecord on day
+    """
+    if not trip_ids:
+        return set()
+    rows = db.session.execute(
+        select(TripRecord.trip_id)
+        .where(TripRecord.vehicle_id.is_(None), TripRecord.day == day, TripRecord.trip_id.in_(trip_ids))).all()
+    return {row.trip_id for row in rows}
 
 
 def update_trip_updates(feed_id, time_recorded=datetime.utcnow().replace(microsecond=0)):
     with scheduler.app.app_context():
         feed_data = db.session.query(Feed).filter_by(id=feed_id).first()
         url = feed_data.trip_update_url
-        timezone = feed_data.timezone
+        key = feed_key(feed_id, TRIP_UPDATES)
         error_source = f'{feed_data.company_name}({feed_id})'
-        feed, error = generate_feed(url)
-        if feed is None:
+        feed, error = generate_feed(key, url, scheduler.app.config.get('FEED_READ_TIMEOUT', 30))
+        if error:
             add_to_error_log('update_vehicle_position', f'Failed to retrieve feed for {error_source}\n{error}')
-            return
-        timestamp = feed.header.timestamp
-        timestamp_dt = datetime.utcfromtimestamp(timestamp)
-        target_tz = pytz.timezone(timezone)
-        target_datetime = timestamp_dt.replace(tzinfo=pytz.UTC).astimezone(target_tz)
-        local_date = target_datetime.date()
-
-        gtfs_id_dict = gtfs_ids_to_vehicle_ids_mapped(feed_id)
-        records = {}  # format v_id : [{record 1 : TripRecord, next_stop: StopDistance , prev_stop: StopDistance}, record 2, ...]
-        # for each vehicle, compile each of its trips and its corresponding stops, then find the current active trip and add it to db
-        for entity in feed.entity:
-            # Get ID
-            if not entity.HasField('trip_update'):
-                continue
-            if not entity.trip_update.HasField('trip'):
-                add_to_error_log('update_trip_updates', f'{error_source}: no trip information found\n {entity}')
-                continue
-            if entity.trip_update.trip.HasField('schedule_relationship') and \
-                    entity.trip_update.trip.schedule_relationship == TripRecord.CANCELED:
-                # trip canceled, check if record for canceled trip already exists
-                record = db.session.query(TripRecord).filter_by(vehicle_id=None,
-                                                                trip_id=entity.trip_update.trip.trip_id,
-                                                                day=local_date).first()
-                if record is not None:
-                    continue
-                vehicle_id = None
-            else:
-                if not entity.trip_update.HasField('vehicle') or not entity.trip_update.vehicle.id:
-                    continue
-                gtfs_id = int(entity.trip_update.vehicle.id)
-                if gtfs_id not in gtfs_id_dict:
-                    vehicle_id, error = add_vehicle(feed_id, gtfs_id)
-                    if vehicle_id is None:
-                        add_to_error_log('update_trip_update', f'{error_source}: {error}\n{entity}')
-                        continue
-                    gtfs_id_dict.update({gtfs_id: vehicle_id})
-                vehicle_id = gtfs_id_dict[gtfs_id]
-
-            # CREATE TRIP RECORD
-            record = TripRecord()
-            record.vehicle_id = vehicle_id
-            record.trip_id = entity.trip_update.trip.trip_id
-            record.timestamp = timestamp_dt
-            record.time_recorded = time_recorded
-            record.day = local_date
-            if vehicle_id is None:
-                db.session.add(record)
+            return None
+        if feed is None or is_feed_processed(key, feed):
+            if feed is not None:
+                mark_feed_processed(key, feed)
+            print(f'Feed: {error_source} | trip updates not modified')
+            return 0
+        num_rows_added = write_trip_updates(feed_data, feed, time_recorded)
+        mark_feed_processed(key, feed)
+        return num_rows_added
+
+
+def write_trip_updates(feed_data: Feed, feed, time_recorded: datetime, publish: bool = True):
+    """
+    Add the active trip and its stops for each vehicle in a snapshot, and canceled trips, to the db and commit
+    :param publish: publish the snapshot to the latest state, False for archived snapshots
+    :return: number of trips and stops added
+    """
+    feed_id = feed_data.id
+    timezone = feed_data.timezone
+    error_source = f'{feed_data.company_name}({feed_id})'
+    timestamp = feed.header.timestamp
+    timestamp_dt = datetime.utcfromtimestamp(timestamp)
+    target_tz = pytz.timezone(timezone)
+    target_datetime = timestamp_dt.replace(tzinfo=pytz.UTC).astimezone(target_tz)
+    local_date = target_datetime.date()
+    ensure_partitions(local_date)
+
+    # new vehicles in the snapshot are registered in one batch
+    gtfs_ids = {int(entity.trip_update.vehicle.id) for entity in feed.entity
+                if entity.HasField('trip_update') and entity.trip_update.vehicle.id
+                and not is_trip_canceled(entity)}
+    gtfs_id_dict, error = vehicle_registry.get_vehicle_ids(feed_id, gtfs_ids)
+    if error:
+        add_to_error_log('update_trip_updates', f'{error_source}\n{error}')
+    # canceled trips already recorded today are found with one query for the whole snapshot
+    canceled_trip_ids = {entity.trip_update.trip.trip_id for entity in feed.entity
+                         if entity.HasField('trip_update') and is_trip_canceled(entity)}
+    recorded_canceled_trip_ids = get_recorded_canceled_trip_ids(local_date, canceled_trip_ids)
+    canceled_records = []
+    trip_entities = []
+    for entity in feed.entity:
+        # Get ID
+        if not entity.HasField('trip_update'):
+            continue
+        if not entity.trip_update.HasField('trip'):
+            add_to_error_log('update_trip_updates', f'{error_source}: no trip information found\n {entity}')
+            continue
+        if is_trip_canceled(entity):
+            # trip canceled, check if record for canceled trip already exists
+            trip_id = entity.trip_update.trip.trip_id
+            if trip_id in recorded_canceled_trip_ids:
                 continue
-            if vehicle_id not in records:
-                records.update({vehicle_id: []})
-            records[vehicle_id].append({'record': record, 'next_stop': None, 'prev_stop': None})
-            # get record's stops
-            # STOP TIME
-            next_stop_id = None
-            prev_stop_id = None
-            next_stop_time = float('+inf')  # by time
-            prev_stop_time = float('-inf')
-            for stop in entity.trip_update.stop_time_update:
-                if stop.HasField('schedule_relationship'):
-                    if stop.schedule_relationship != StopDistance.SCHEDULED:
-                        # stop is either skipped or no_data
-                        continue
-                arrival_timestamp = stop.arrival.time
-                time_diff = arrival_timestamp - timestamp
-                if 0 < time_diff < next_stop_time:
-                    next_stop_id = stop.stop_id
-                    next_stop_time = time_diff
-                elif 0 >= time_diff > prev_stop_time:
-                    prev_stop_id = stop.stop_id
-                    prev_stop_time = time_diff
-            if not next_stop_id and not prev_stop_id:
-                # TODO ask if to treat this case as a canceled trip
-                records[vehicle_id].pop()
-                record.vehicle_id = None
-                # db.session.add(record)
-            if next_stop_id is not None:
-                next_stop = StopDistance()
-                next_stop.time_till_arrive = next_stop_time
-                next_stop.stop_id = next_stop_id
-                records[vehicle_id][-1]['next_stop'] = next_stop
-            if prev_stop_id is not None:
-                prev_stop = StopDistance()
-                prev_stop.time_till_arrive = prev_stop_time
-                prev_stop.stop_id = prev_stop_id
-                records[vehicle_id][-1]['prev_stop'] = prev_stop
-
-        # get active trip and
-        # update the trip_record_id in each stop
-        num_rows_added = 0
-        for vehicle_id in records:
-            curr_arrive_time = float('+inf')
-            curr_record = None
-            curr_next_stop = None
-            curr_prev_stop = None
-            for trip in records[vehicle_id]:
-                record = trip.get('record')
-                next_stop = trip.get('next_stop', None)
-                prev_stop = trip.get('prev_stop', None)
-                if next_stop is not None:
-                    arrive_time = next_stop.time_till_arrive
-                elif prev_stop is not None:
-                    arrive_time = prev_stop.time_till_arrive
-                else:
-                    add_to_error_log('update_trip_updates', f'{error_source}: gtfs {gtfs_id} has no stops')
-                    continue
-                # get trip with has its arrive_time closest to 0
-                if (0 < arrive_time < curr_arrive_time) \
-                        or (curr_arrive_time <= 0 < arrive_time) \
-                        or (curr_arrive_time < arrive_time <= 0):
-                    curr_arrive_time = arrive_time
-                    curr_record = record
-                    curr_next_stop = next_stop
-                    curr_prev_stop = prev_stop
-            if curr_record:
-                db.session.add(curr_record)
-                num_rows_added += 1
-                db.session.flush()
-                if curr_next_stop:
-                    curr_next_stop.trip_record_id = curr_record.id
-                    db.session.add(curr_next_stop)
-                    num_rows_added += 1
-
-                if curr_prev_stop:
-                    curr_prev_stop.trip_record_id = curr_record.id
-                    db.session.add(curr_prev_stop)
-                    num_rows_added += 1
-                #update latest record
-                exists = db.session.query(LatestRecords).filter(LatestRecords.vehicle_id == vehicle_id).first()
-                if exists is not None:
-                    exists.trip_record_id = curr_record.id
-                else:
-                    exists = LatestRecords()
-                    exists.vehicle_id = vehicle_id
-                    exists.trip_record_id = curr_record.id
-                    db.session.add(exists)
-
-        print(f'Feed: {feed_id} | {num_rows_added} trips/stops added')
-        db.session.commit()
+            recorded_canceled_trip_ids.add(trip_id)
+            canceled_records.append({'vehicle_id': None,
+                                     'trip_id': trip_id,
+                                     'timestamp': timestamp_dt,
+                                     'time_recorded': time_recorded,
+                                     'day': local_date})
+            continue
+        trip_entities.append(entity)
+
+    # get active trip of each vehicle, then add it and its stops
+    active_trips = select_active_trips(trip_entities, timestamp, gtfs_id_dict)
+    trip_record_ids = {}  # vehicle_id: trip_record_id
+    if active_trips:
+        vehicle_ids = sorted(active_trips)
+        result = db.session.execute(
+            insert(TripRecord).returning(TripRecord.id, TripRecord.vehicle_id, sort_by_parameter_order=True),
+            [{'vehicle_id': vehicle_id,
+              'trip_id': active_trips[vehicle_id].trip_id,
+              'timestamp': timestamp_dt,
+              'time_recorded': time_recorded,
+              'day': local_date} for vehicle_id in vehicle_ids])
+        trip_record_ids = {row.vehicle_id: row.id for row in result}
+    stops = []
+    for vehicle_id, trip in active_trips.items():
+        if trip.next_stop_id is not None:
+            stops.append({'trip_record_id': trip_record_ids[vehicle_id],
+                          'day': local_date,
+                          'stop_id': trip.next_stop_id,
+                          'time_till_arrive': trip.next_stop_time})
+        if trip.prev_stop_id is not None:
+            stops.append({'trip_record_id': trip_record_ids[vehicle_id],
+                          'day': local_date,
+                          'stop_id': trip.prev_stop_id,
+                          'time_till_arrive': trip.prev_stop_time})
+    if stops:
+        db.session.execute(insert(StopDistance), stops)
+    num_rows_added = len(trip_record_ids) + len(stops)
+
+    upsert_latest_records(TripRecord, local_date, timestamp_dt, trip_record_ids)
+    upsert_trip_segments(feed_id, local_date, timestamp_dt,
+                         {vehicle_id: trip.trip_id for vehicle_id, trip in active_trips.items()})
+    if canceled_records:
+        db.session.execute(insert(TripRecord), canceled_records)
+    print(f'Feed: {feed_id} | {num_rows_added} trips/stops added | {len(canceled_records)} canceled trips added')
+    bump_feed_versions([feed_id])
+    db.session.commit()
+    if not publish:
+        return num_rows_added
+    vehicle_gtfs_ids = {vehicle_id: gtfs_id for gtfs_id, vehicle_id in gtfs_id_dict.items()}
+    latest_state.publish_trips(feed_id, timestamp, {
+        vehicle_gtfs_ids[vehicle_id]: trip_state(trip.trip_id, timestamp_dt, time_recorded, local_date,
+                                                 [(stop_id, stop_time) for stop_id, stop_time in
+                                                  ((trip.next_stop_id, trip.next_stop_time),
+                                                   (trip.prev_stop_id, trip.prev_stop_time))
+                                                  if stop_id is not None])
+        for vehicle_id, trip in active_trips.items()})
+    return num_rows_added
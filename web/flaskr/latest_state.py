@@ -0,0 +1,237 @@
+import json
+import os
+import tempfile
+import threading
+from time import time
+
+from sqlalchemy import select
+
+from .extensions import db
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+from .logs import add_to_error_log
+from .models import Vehicles, VehiclePosition, TripRecord, LatestRecords
+
+def position_state(position: dict):
+    """
+    :param position: vehicle_position row dict, as written by write_vehicle_positions
+    :return: the position as VehiclePosition.to_dict() of its row
+    """
+    return {'lat': position['lat'],
+            'lon': position['lon'],
+            'occupancy_status': position['occupancy_status'],
+            'time_recorded': position['time_recorded'].isoformat(),
+            'timestamp': position['timestamp'].isoformat(),
+            'last_timestamp': position['timestamp'].isoformat(),
+            'day': str(position['day'])}
+
+
+def trip_state(trip_id: str, timestamp, time_recorded, day, stops: list):
+    """
+    :param stops: list of (stop_id, time_till_arrive)
+    :return: the active trip of a vehicle as TripRecord.to_dict() of its row, with its stops
+    """
+    return {'trip_id': trip_id,
+            'time_recorded': time_recorded.isoformat(),
+            'timestamp': timestamp.isoformat(),
+            'day': str(day),
+            'stops': [{'stop_id': int(stop_id), 'time_till_arrive': time_till_arrive}
+                      for stop_id, time_till_arrive in stops]}
+
+
+def load_feed_state(feed_id: int):
+    """
+    Build the state of a feed from LatestRecords, for a process that has not published it yet
+    :return: state dict
+    """
+    positions = {}
+    rows = db.session.execute(
+        select(Vehicles.vehicle_gtfs_id, VehiclePosition)
+        .join(LatestRecords, LatestRecords.vehicle_id == Vehicles.id)
+        .join(VehiclePosition, (VehiclePosition.id == LatestRecords.vehicle_position_id)
+              & (VehiclePosition.day == LatestRecords.vehicle_position_day))
+        .where(Vehicles.feed_id == feed_id)).all()
+    for gtfs_id, position in rows:
+        positions[str(gtfs_id)] = position.to_dict()
+    trips = {}
+    rows = db.session.execute(
+        select(Vehicles.vehicle_gtfs_id, TripRecord)
+        .join(LatestRecords, LatestRecords.vehicle_id == Vehicles.id)
+        .join(TripRecord, (TripRecord.id == LatestRecords.trip_record_id)
+              & (TripRecord.day == LatestRecords.trip_record_day))
+        .where(Vehicles.feed_id == feed_id)).unique().all()
+    for gtfs_id, trip in rows:
+        trips[str(gtfs_id)] = trip_state(trip.trip_id, trip.timestamp, trip.time_recorded, trip.day,
+                                         [(stop.stop_id, stop.time_till_arrive) for stop in trip.stops])
+    return {'feed_id': feed_id, 'version': 0, 'header_timestamps': {}, 'positions': positions, 'trips': trips}
+
+
+class MemoryStore:
+    """
+    States of the feeds ingested by this process, for a web app that ingests itself
+    """
+
+    def __init__(self):
+        self._states = {}
+
+    def get(self, feed_id: int):
+        return self._states.get(feed_id, None)
+
+    def put(self, state: dict):
+        self._states[state['feed_id']] = state
+
+
+class FileStore:
+    """
+    One JSON file per feed in a directory shared by the ingestion and web processes of a host, e.g. on tmpfs
+    (/dev/shm). Files are replaced atomically; readers parse a file again only when it changed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._cache = {}  # feed_id: (stat key, state)
+        self._lock = threading.Lock()
+
+    def _path(self, feed_id: int):
+        return os.path.join(self.directory, f'{feed_id}.json')
+
+    def get(self, feed_id: int):
+        path = self._path(feed_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._cache.get(feed_id, None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            state = json.loads(f.read())
+        with self._lock:
+            self._cache[feed_id] = (key, state)
+        return state
+
+    def put(self, state: dict):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            os.fchmod(fd, 0o644)  # readable by web processes of other users
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(tmp_path, self._path(state['feed_id']))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        stat = os.stat(self._path(state['feed_id']))
+        with self._lock:
+            self._cache[state['feed_id']] = ((stat.st_ino, stat.st_mtime_ns, stat.st_size), state)
+
+
+class LatestState:
+    """
+    Latest position and active trip of every vehicle of each feed, published by ingestion after each committed
+    snapshot so the recent endpoints answer without querying Postgres.
+    A state is a dict: feed_id, version (increases with every publish), header_timestamps by kind, positions and
+    trips by gtfs_id (str). Published states are never modified, a publish replaces the feed's state.
+    The first publish of a feed in a process starts from LatestRecords, vehicles missing from a snapshot keep their
+    last position and trip.
+    """
+
+    def __init__(self):
+        self.store = MemoryStore()
+        self.receives_publishes = True  # the store sees the publishes of the ingesting process
+        self._states = {}  # feed_id: last state published by this process
+        self._feed_locks = {}  # feed_id: Lock, publishes of a feed merge into its last state one at a time
+        self._lock = threading.Lock()  # guards _feed_locks
+
+    def init_app(self, app, ingest: bool = True):
+        """
+        LATEST_STATE_STORE: 'memory' (default, only seen by this process), 'file' (in LATEST_STATE_DIR) or 'none'
+        :param ingest: this process ingests and publishes the states
+        """
+        backend = app.config.get('LATEST_STATE_STORE', 'memory')
+        if backend == 'file':
+            self.store = FileStore(app.config.get('LATEST_STATE_DIR', '/dev/shm/gtfs-latest-state'))
+        elif backend == 'none':
+            self.store = None
+        else:
+            self.store = MemoryStore()
+        # a memory store of a process that does not ingest is never published to
+        self.receives_publishes = backend == 'file' or (backend != 'none' and ingest)
+        self._states = {}
+
+    def get(self, feed_id: int):
+        """
+        :return: state dict of the feed, None if it was not published
+        """
+        if self.store is None:
+            return None
+        try:
+            return self.store.get(feed_id)
+        except BaseException as e:
+            add_to_error_log('latest state', f'Cannot read the state of feed {feed_id}\n{e}')
+            return None
+
+    def forget_feed(self, feed_id: int):
+        """
+        Drop the last state published of a feed, the next publish starts again from LatestRecords
+        """
+        with self._lock:
+            feed_lock = self._feed_locks.setdefault(feed_id, threading.Lock())
+        with feed_lock:
+            self._states.pop(feed_id, None)
+
+    def _publish(self, feed_id: int, kind: str, header_timestamp: int, update):
+        """
+        :param update: function(state) setting the new positions or trips of the copy of the last state
+        """
+        if self.store is None:
+            return
+        with self._lock:
+            feed_lock = self._feed_locks.setdefault(feed_id, threading.Lock())
+        try:
+            # the db and store are only used under the feed's lock, publishes of other feeds go on meanwhile
+            with feed_lock:
+                previous = self._states.get(feed_id, None)
+                if previous is None:
+                    previous = load_feed_state(feed_id)
+                state = dict(previous)
+                state['version'] = max(previous['version'] + 1, int(time() * 1000))
+                state['header_timestamps'] = dict(previous['header_timestamps'], **{kind: header_timestamp})
+                update(state)
+                self.store.put(state)
+                self._states[feed_id] = state
+        except BaseException as e:
+            add_to_error_log('latest state', f'Cannot publish {kind} of feed {feed_id}\n{e}')
+
+    def publish_positions(self, feed_id: int, header_timestamp: int, positions: dict, stationary: dict):
+        """
+        :param positions: dict of gtfs_id: position row dict written
+        :param stationary: dict of gtfs_id: timestamp of the vehicles still at their last written position
+        """
+        def update(state):
+            merged = dict(state['positions'])
+            for gtfs_id, position in positions.items():
+                merged[str(gtfs_id)] = position_state(position)
+            for gtfs_id, timestamp in stationary.items():
+                last = merged.get(str(gtfs_id), None)
+                if last is not None:
+                    merged[str(gtfs_id)] = dict(last, last_timestamp=timestamp.isoformat())
+            state['positions'] = merged
+
+        self._publish(feed_id, VEHICLE_POSITIONS, header_timestamp, update)
+
+    def publish_trips(self, feed_id: int, header_timestamp: int, trips: dict):
+        """
+        :param trips: dict of gtfs_id: trip_state dict
+        """
+        def update(state):
+            merged = dict(state['trips'])
+            for gtfs_id, trip in trips.items():
+                merged[str(gtfs_id)] = trip
+            state['trips'] = merged
+
+        self._publish(feed_id, TRIP_UPDATES, header_timestamp, update)
+
+
+latest_state = LatestState()
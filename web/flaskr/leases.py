@@ -0,0 +1,179 @@
+import atexit
+import math
+import os
+import random
+import socket
+import threading
+import uuid
+from datetime import timedelta
+from time import monotonic
+
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .extensions import db
+from .gtfs_update import forget_feed
+from .latest_state import latest_state
+from .logs import add_to_error_log
+from .models import Feed, FeedLease, IngestWorker
+from .stationary import stationary_filter
+
+
+def forget_feeds(feed_ids):
+    """
+    Drop what this process remembers of feeds whose lease it lost or claimed: another worker may have written them
+    meanwhile, so their last snapshots, stationary positions and latest state are read again from the db
+    """
+    for feed_id in feed_ids:
+        forget_feed(feed_id)
+        stationary_filter.forget_feed(feed_id)
+        latest_state.forget_feed(feed_id)
+
+
+class LeaseManager:
+    """
+    Shares the feeds between ingestion processes with a lease table. A heartbeat thread registers the process in
+    ingest_worker, renews its leases, releases the ones over its fair share (feeds / live workers) and claims
+    feeds that are not leased or whose lease expired. Times are the db's, so hosts do not need synced clocks.
+    Feeds being ingested are never released, so a feed is ingested by one process at a time.
+    """
+
+    def __init__(self):
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.lease_seconds = 30
+        self.active = False
+        self._owned = set()
+        self._in_flight = {}  # feed_id: jobs of the feed being ingested
+        self._valid_until = 0.0  # leases may have been taken over after this if heartbeats fail
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, app):
+        """
+        Start the heartbeat thread, claims the first leases before returning
+        """
+        self.lease_seconds = app.config.get('FEED_LEASE_SECONDS', 30)
+        self.active = True
+        with app.app_context():
+            self.heartbeat()
+        self._thread = threading.Thread(target=self._run, args=(app,), name='feed-leases', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop, app)
+
+    def _run(self, app):
+        with app.app_context():
+            while not self._stopped.wait(self.lease_seconds / 3):
+                self.heartbeat()
+
+    def stop(self, app):
+        """
+        Release every lease so other workers take the feeds over without waiting for them to expire
+        """
+        self._stopped.set()
+        with app.app_context():
+            try:
+                db.session.execute(delete(FeedLease).where(FeedLease.worker_id == self.worker_id))
+                db.session.execute(delete(IngestWorker).where(IngestWorker.worker_id == self.worker_id))
+                db.session.commit()
+            except BaseException as e:
+                db.session.rollback()
+                print(f'LeaseManager Error: cannot release leases of {self.worker_id}: {e}')
+        with self._lock:
+            released = self._owned
+            self._owned = set()
+        forget_feeds(released)
+
+    def heartbeat(self):
+        try:
+            time_start = monotonic()
+            with self._lock:
+                # after a lapse every lease may have been taken over and given back meanwhile
+                previous = set(self._owned) if time_start < self._valid_until else set()
+            owned = self._heartbeat()
+            with self._lock:
+                self._owned = owned
+                self._valid_until = time_start + self.lease_seconds
+            forget_feeds(previous ^ owned)
+        except BaseException as e:
+            db.session.rollback()
+            add_to_error_log('feed leases', f'Heartbeat of {self.worker_id} failed\n{e}')
+        finally:
+            db.session.remove()
+
+    def _heartbeat(self):
+        """
+        :return: set of feed ids leased by this worker
+        """
+        now = db.session.scalar(select(func.now()))
+        ttl = timedelta(seconds=self.lease_seconds)
+        stmt = pg_insert(IngestWorker).values(worker_id=self.worker_id, heartbeat_at=now)
+        db.session.execute(stmt.on_conflict_do_update(index_elements=[IngestWorker.worker_id],
+                                                      set_={'heartbeat_at': now}))
+        db.session.execute(delete(IngestWorker).where(IngestWorker.heartbeat_at < now - ttl))
+        workers = db.session.scalar(select(func.count()).select_from(IngestWorker))
+        feed_ids = db.session.scalars(select(Feed.id)).all()
+        share = math.ceil(len(feed_ids) / max(workers, 1))
+
+        held = set(db.session.scalars(
+            update(FeedLease).where(FeedLease.worker_id == self.worker_id).values(expires_at=now + ttl)
+            .returning(FeedLease.feed_id)).all())
+        with self._lock:
+            release = sorted(held.difference(self._in_flight))[:max(len(held) - share, 0)]
+            self._owned.difference_update(release)
+        if release:
+            db.session.execute(delete(FeedLease).where(FeedLease.worker_id == self.worker_id,
+                                                       FeedLease.feed_id.in_(release)))
+            held.difference_update(release)
+
+        if len(held) < share:
+            free = db.session.scalars(
+                select(Feed.id).outerjoin(FeedLease, FeedLease.feed_id == Feed.id)
+                .where(or_(FeedLease.feed_id.is_(None), FeedLease.expires_at < now))).all()
+            # workers starting together would all claim the lowest ids first
+            claim = random.sample(free, min(len(free), share - len(held)))
+            if claim:
+                stmt = pg_insert(FeedLease).values([{'feed_id': feed_id, 'worker_id': self.worker_id,
+                                                     'expires_at': now + ttl} for feed_id in sorted(claim)])
+                stmt = stmt.on_conflict_do_update(index_elements=[FeedLease.feed_id],
+                                                  set_={'worker_id': stmt.excluded.worker_id,
+                                                        'expires_at': stmt.excluded.expires_at},
+                                                  where=FeedLease.expires_at < now)
+                held.update(db.session.scalars(stmt.returning(FeedLease.feed_id)).all())
+        db.session.commit()
+        return held
+
+    def owned(self):
+        """
+        :return: set of the feed ids leased by this worker
+        """
+        with self._lock:
+            if monotonic() >= self._valid_until:
+                return set()
+            return set(self._owned)
+
+    def acquire(self, feed_ids):
+        """
+        Mark the leased feeds among feed_ids as being ingested, so they are not released until done()
+        :return: list of the feed ids leased by this worker
+        """
+        with self._lock:
+            if monotonic() >= self._valid_until:
+                return []
+            acquired = [feed_id for feed_id in feed_ids if feed_id in self._owned]
+            for feed_id in acquired:
+                self._in_flight[feed_id] = self._in_flight.get(feed_id, 0) + 1
+        return acquired
+
+    def done(self, feed_ids):
+        """
+        End one acquire() of each feed, a feed acquired several times stays in flight until each is done
+        """
+        with self._lock:
+            for feed_id in feed_ids:
+                count = self._in_flight.pop(feed_id, 0) - 1
+                if count > 0:
+                    self._in_flight[feed_id] = count
+
+
+lease_manager = LeaseManager()
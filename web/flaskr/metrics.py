@@ -0,0 +1,248 @@
+import threading
+import time
+from time import perf_counter
+
+from flask import Blueprint, Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+bp = Blueprint('metrics', __name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+ENTITIES_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('+inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric with a fixed set of label names, one series per label values
+    """
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._series = {}  # label values: value
+        self._lock = threading.Lock()
+
+    def _samples(self):
+        with self._lock:
+            return [(f'{self.name}{_format_labels(self.label_names, labels)}', value)
+                    for labels, value in sorted(self._series.items())]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name} {_format_value(value)}' for name, value in self._samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] = self._series.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._series[labels] = value
+
+    def remove(self, *labels):
+        with self._lock:
+            self._series.pop(labels, None)
+
+
+class AgeGauge(Gauge):
+    """
+    Gauge set to a unix timestamp, rendered as the seconds elapsed since that timestamp at scrape time
+    """
+
+    def _samples(self):
+        now = time.time()
+        return [(name, max(now - timestamp, 0.0)) for name, timestamp in super()._samples()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('+inf'),)
+
+    def observe(self, *labels, value):
+        with self._lock:
+            series = self._series.get(labels, None)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count)
+                            in self._series.items())
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = _format_labels(self.label_names, labels, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, labels)} {count}')
+        return '\n'.join(lines)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+class CommitTimer:
+    """
+    Total time the current thread spent in Session.commit since the last take(), measured with session events
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        event.listen(Session, 'before_commit', self._before_commit)
+        event.listen(Session, 'after_commit', self._after_commit)
+
+    def _before_commit(self, session):
+        self._local.start = perf_counter()
+
+    def _after_commit(self, session):
+        self._local.total = getattr(self._local, 'total', 0.0) + perf_counter() - self._local.start
+
+    def take(self):
+        total = getattr(self._local, 'total', 0.0)
+        self._local.total = 0.0
+        return total
+
+
+FEED_LABELS = ('feed_id', 'company', 'kind')
+
+registry = Registry()
+fetch_seconds = registry.register(Histogram(
+    'gtfs_feed_fetch_seconds', 'Time to download a feed', FEED_LABELS))
+payload_bytes = registry.register(Histogram(
+    'gtfs_feed_payload_bytes', 'Size of downloaded feed payloads', FEED_LABELS, buckets=BYTES_BUCKETS))
+parse_seconds = registry.register(Histogram(
+    'gtfs_feed_parse_seconds', 'Time to parse a feed payload', FEED_LABELS))
+entities = registry.register(Histogram(
+    'gtfs_feed_entities', 'Entities in a parsed feed snapshot', FEED_LABELS, buckets=ENTITIES_BUCKETS))
+write_seconds = registry.register(Histogram(
+    'gtfs_feed_write_seconds', 'Time to write a feed snapshot to the db, commit included', FEED_LABELS))
+commit_seconds = registry.register(Histogram(
+    'gtfs_feed_commit_seconds', 'Time spent committing a feed snapshot', FEED_LABELS))
+rows_written = registry.register(Counter(
+    'gtfs_feed_rows_written_total', 'Rows written for a feed', FEED_LABELS))
+snapshots = registry.register(Counter(
+    'gtfs_feed_snapshots_total', 'Feed snapshots by result: written, not_modified, unchanged or error',
+    FEED_LABELS + ('result',)))
+header_age = registry.register(AgeGauge(
+    'gtfs_feed_staleness_seconds', 'Seconds since the header timestamp of the last snapshot of a feed',
+    FEED_LABELS))
+cycle_seconds = registry.register(Histogram(
+    'gtfs_update_cycle_seconds', 'Wall time of a feed update cycle', buckets=SECONDS_BUCKETS))
+cycle_end = registry.register(Gauge(
+    'gtfs_update_cycle_end_timestamp_seconds', 'Unix time the last feed update cycle finished'))
+commit_timer = CommitTimer()
+
+
+def job_result(job):
+    """
+    :return: written, not_modified, unchanged or error
+    """
+    if job.error:
+        return 'error'
+    if 'write' in job.timings:
+        return 'written'
+    if 'parse' in job.timings:
+        return 'unchanged'
+    return 'not_modified'
+
+
+def record_jobs(jobs):
+    """
+    Record the metrics of finished FeedJobs
+    """
+    for job in jobs:
+        labels = (job.feed_id, job.feed_data.company_name, job.kind)
+        if 'fetch' in job.timings:
+            fetch_seconds.observe(*labels, value=job.timings['fetch'])
+        if job.payload_bytes is not None:
+            payload_bytes.observe(*labels, value=job.payload_bytes)
+        if 'parse' in job.timings:
+            parse_seconds.observe(*labels, value=job.timings['parse'])
+        if job.entities is not None:
+            entities.observe(*labels, value=job.entities)
+        if 'write' in job.timings:
+            write_seconds.observe(*labels, value=job.timings['write'])
+            commit_seconds.observe(*labels, value=job.timings.get('commit', 0.0))
+        if job.rows_added:
+            rows_written.inc(*labels, amount=job.rows_added)
+        if job.header_timestamp:
+            header_age.set(*labels, value=job.header_timestamp)
+        snapshots.inc(*labels, job_result(job))
+
+
+def record_cycle(jobs, seconds: float):
+    """
+    Record the metrics of the finished FeedJobs of an update cycle
+    """
+    record_jobs(jobs)
+    cycle_seconds.observe(value=seconds)
+    cycle_end.set(value=time.time())
+
+
+def record_polled_job(job):
+    """
+    Record the metrics of a FeedJob finished by the adaptive poller, which has no cycles: the cycle end is the time
+    the last job finished
+    """
+    record_jobs([job])
+    cycle_end.set(value=time.time())
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Usage: /metrics
+    :return: feed update metrics in Prometheus text format
+    """
+    return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -30,6 +30,13 @@ class Feed(db.Model):
     vehicle_position_url = db.Column(db.String(), nullable=True)
     trip_update_url = db.Column(db.String(), nullable=True)
     service_alert_url = db.Column(db.String(), nullable=True)
+    # stationary vehicles: skip positions that moved less than stationary_distance meters with the same
+    # occupancy status, but still write a position every heartbeat_minutes
+    suppress_stationary = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    stationary_distance = db.Column(db.Float, nullable=False, default=10.0, server_default='10')
+    heartbeat_minutes = db.Column(db.Integer, nullable=False, default=15, server_default='15')
+    # days of records kept, RETENTION_DAYS if None
+    retention_days = db.Column(db.Integer, nullable=True)
 
     def to_dict(self):
         return {'id': self.id,
@@ -37,11 +44,16 @@ class Feed(db.Model):
                 'timezone': self.timezone,
                 'trip_update_url': self.trip_update_url,
                 'vehicle_position_url': self.vehicle_position_url,
-                'service_alert_url': self.service_alert_url}
+                'service_alert_url': self.service_alert_url,
+                'suppress_stationary': self.suppress_stationary,
+                'stationary_distance': self.stationary_distance,
+                'heartbeat_minutes': self.heartbeat_minutes,
+                'retention_days': self.retention_days}
 
 
 class Vehicles(db.Model):
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (db.UniqueConstraint('feed_id', 'vehicle_gtfs_id', name='gtfs_vehicles_feed_id_vehicle_gtfs_id_key'),
+                      {'extend_existing': True})
     __tablename__ = 'gtfs_vehicles'
     id = db.Column(db.Integer, primary_key=True)
     feed_id = db.Column(db.Integer, db.ForeignKey('gtfs_feeds.id'), nullable=False)
@@ -56,18 +68,25 @@ class Vehicles(db.Model):
 
 
 class VehiclePosition(db.Model):
-    __table_args__ = {'extend_existing': True}
+    # partitioned by day, the primary key of a partitioned table must include its partition key.
+    # A partition is one day, so the day filter of a query picks the partition and indexes do not need day.
+    # Positions of a vehicle by timestamp; rows are appended in time order, BRIN indexes for time ranges
+    __table_args__ = (db.Index('ix_vehicle_position_vehicle_id_timestamp', 'vehicle_id', 'timestamp'),
+                      db.Index('ix_vehicle_position_time_recorded_brin', 'time_recorded', postgresql_using='brin'),
+                      db.Index('ix_vehicle_position_timestamp_brin', 'timestamp', postgresql_using='brin'),
+                      {'extend_existing': True, 'postgresql_partition_by': 'RANGE (day)'})
     __tablename__ = 'vehicle_position'
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     vehicle_id = db.Column(db.Integer, db.ForeignKey("gtfs_vehicles.id"), nullable=False)
     lat = db.Column(db.Float, nullable=False)
     lon = db.Column(db.Float, nullable=False)
     occupancy_status = db.Column(db.Integer, nullable=True, default=None)
     time_recorded = db.Column(db.DateTime, nullable=False,
-                              default=(datetime.utcnow()).replace(microsecond=0),
-                              index=True)
-    timestamp = db.Column(db.DateTime, nullable=False, index=True)
-    day = db.Column(db.Date, nullable=False, index=True)
+                              default=(datetime.utcnow()).replace(microsecond=0))
+    timestamp = db.Column(db.DateTime, nullable=False)
+    day = db.Column(db.Date, primary_key=True)
+    # last timestamp the vehicle reported this position, set when stationary positions are suppressed
+    last_timestamp = db.Column(db.DateTime, nullable=True)
 
     def to_dict(self):
         return {'lat': self.lat,
@@ -75,6 +94,7 @@ class VehiclePosition(db.Model):
                 'occupancy_status': self.occupancy_status,
                 'time_recorded': self.time_recorded.isoformat(),
                 'timestamp': self.timestamp.isoformat(),
+                'last_timestamp': (self.last_timestamp or self.timestamp).isoformat(),
                 'day': str(self.day)
                 }
 
@@ -84,22 +104,35 @@ class VehiclePosition(db.Model):
                 'occupancy_status': OccupancyStatus(self.occupancy_status).name,
                 'time_recorded': self.time_recorded.isoformat(),
                 'timestamp': self.timestamp.isoformat(),
+                'last_timestamp': (self.last_timestamp or self.timestamp).isoformat(),
                 'day': str(self.day)
                 }
 
 
 class TripRecord(db.Model):
-    __table_args__ = {'extend_existing': True}
+    # canceled trips have no vehicle and are looked up by day and trip_id.
+    # Trips of a vehicle by timestamp, covering trip_id for the trip ids of a day and the first / last trip joins;
+    # first and last timestamps of trips by trip_id and vehicle for the segments and the summary page
+    __table_args__ = (db.Index('ix_trip_record_canceled_day_trip_id', 'day', 'trip_id',
+                               postgresql_where=db.text('vehicle_id IS NULL')),
+                      db.Index('ix_trip_record_vehicle_id_timestamp', 'vehicle_id', 'timestamp',
+                               postgresql_include=['trip_id']),
+                      db.Index('ix_trip_record_trip_id_vehicle_id_timestamp', 'trip_id', 'vehicle_id', 'timestamp'),
+                      db.Index('ix_trip_record_time_recorded_brin', 'time_recorded', postgresql_using='brin'),
+                      db.Index('ix_trip_record_timestamp_brin', 'timestamp', postgresql_using='brin'),
+                      {'extend_existing': True, 'postgresql_partition_by': 'RANGE (day)'})
     __tablename__ = 'trip_record'
-    id = db.Column(db.Integer, primary_key=True)  # trip_record_id
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)  # trip_record_id
     vehicle_id = db.Column(db.Integer, db.ForeignKey("gtfs_vehicles.id"), nullable=True)
     trip_id = db.Column(db.String(), nullable=False)
     time_recorded = db.Column(db.DateTime, nullable=False,
-                              default=(datetime.utcnow()).replace(microsecond=0),
-                              index=True)
-    timestamp = db.Column(db.DateTime, nullable=False, index=True)
-    day = db.Column(db.Date, nullable=False, index=True)
-    stops = db.relationship('StopDistance', backref='trip', lazy='joined')
+                              default=(datetime.utcnow()).replace(microsecond=0))
+    timestamp = db.Column(db.DateTime, nullable=False)
+    day = db.Column(db.Date, primary_key=True)
+    # no foreign key between partitioned tables, the day of the stops is the day of their trip record
+    stops = db.relationship('StopDistance', backref='trip', lazy='joined',
+                            primaryjoin='and_(TripRecord.id == foreign(StopDistance.trip_record_id), '
+                                        'TripRecord.day == foreign(StopDistance.day))')
 
     # scheduled relationship
     SCHEDULED = 0
@@ -115,10 +148,11 @@ class TripRecord(db.Model):
 
 
 class StopDistance(db.Model):
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = {'extend_existing': True, 'postgresql_partition_by': 'RANGE (day)'}
     __tablename__ = 'stop_distance'
-    id = db.Column(db.Integer, primary_key=True)
-    trip_record_id = db.Column(db.Integer, db.ForeignKey("trip_record.id"), nullable=False)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    trip_record_id = db.Column(db.Integer, nullable=False, index=True)
+    day = db.Column(db.Date, primary_key=True)  # day of the trip record
     stop_id = db.Column(db.Integer, nullable=False)
     time_till_arrive = db.Column(db.Integer, nullable=False)
 
@@ -138,5 +172,46 @@ class LatestRecords(db.Model):
     __tablename__ = 'latest_records'
     id = db.Column(db.Integer, primary_key=True)
     vehicle_id = db.Column(db.Integer, db.ForeignKey("gtfs_vehicles.id"), unique=True, nullable=False)
-    vehicle_position_id = db.Column(db.Integer, db.ForeignKey("vehicle_position.id"), nullable=True)
-    trip_record_id = db.Column(db.Integer, db.ForeignKey("trip_record.id"), nullable=True)
+    # no foreign keys, vehicle_position and trip_record are partitioned and their old days are dropped
+    vehicle_position_id = db.Column(db.Integer, nullable=True)
+    vehicle_position_day = db.Column(db.Date, nullable=True)
+    trip_record_id = db.Column(db.Integer, nullable=True)
+    trip_record_day = db.Column(db.Date, nullable=True)
+
+
+class TripSegment(db.Model):
+    # rollup of the trip records of a vehicle on a trip on a day, updated by write_trip_updates with every record
+    __table_args__ = {'extend_existing': True}
+    __tablename__ = 'trip_segment'
+    feed_id = db.Column(db.Integer, db.ForeignKey('gtfs_feeds.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    trip_id = db.Column(db.String(), primary_key=True)
+    vehicle_id = db.Column(db.Integer, db.ForeignKey('gtfs_vehicles.id'), primary_key=True)
+    first_timestamp = db.Column(db.DateTime, nullable=False)
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    record_count = db.Column(db.Integer, nullable=False)
+
+
+class FeedVersion(db.Model):
+    # increased in the transaction of every write or deletion of a feed's records, versions the cached API responses
+    __table_args__ = {'extend_existing': True}
+    __tablename__ = 'feed_version'
+    feed_id = db.Column(db.Integer, db.ForeignKey('gtfs_feeds.id', ondelete='CASCADE'), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+class IngestWorker(db.Model):
+    # ingestion processes sharing the feeds through FeedLease
+    __table_args__ = {'extend_existing': True}
+    __tablename__ = 'ingest_worker'
+    worker_id = db.Column(db.String(), primary_key=True)
+    heartbeat_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+
+class FeedLease(db.Model):
+    # the worker ingesting a feed, until expires_at unless renewed
+    __table_args__ = {'extend_existing': True}
+    __tablename__ = 'feed_lease'
+    feed_id = db.Column(db.Integer, db.ForeignKey('gtfs_feeds.id', ondelete='CASCADE'), primary_key=True)
+    worker_id = db.Column(db.String(), nullable=False, index=True)
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
@@ -0,0 +1,124 @@
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from time import monotonic
+
+from sqlalchemy import tuple_, func, select
+
+# seconds a total is reused for, rows keep being added to today's pages
+COUNT_CACHE_SECONDS = 60
+COUNT_CACHE_SIZE = 1024
+CURSOR_SEPARATOR = ','
+
+_counts = OrderedDict()  # key: (expires, count)
+_counts_lock = threading.Lock()
+
+
+def cached_count(key, query):
+    """
+    Count the rows of a query, reusing the count of the same key for COUNT_CACHE_SECONDS
+    :param key: hashable identifying the query and its filters
+    :return: number of rows
+    """
+    now = monotonic()
+    with _counts_lock:
+        cached = _counts.get(key, None)
+        if cached is not None and cached[0] > now:
+            _counts.move_to_end(key)
+            return cached[1]
+    count = query.session.scalar(select(func.count()).select_from(query.order_by(None).subquery()))
+    with _counts_lock:
+        _counts[key] = (now + COUNT_CACHE_SECONDS, count)
+        _counts.move_to_end(key)
+        while len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return count
+
+
+def encode_cursor(values):
+    return CURSOR_SEPARATOR.join(value.isoformat() if isinstance(value, (date, datetime)) else str(value)
+                                 for value in values)
+
+
+def decode_cursor(cursor: str, columns):
+    """
+    :return: tuple of the key values in cursor, None if cursor is empty or does not match columns
+    """
+    if not cursor:
+        return None
+    parts = cursor.split(CURSOR_SEPARATOR)
+    if len(parts) != len(columns):
+        return None
+    values = []
+    try:
+        for part, column in zip(parts, columns):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                values.append(datetime.fromisoformat(part))
+            elif python_type is date:
+                values.append(date.fromisoformat(part))
+            else:
+                values.append(python_type(part))
+    except (ValueError, NotImplementedError):
+        return None
+    return tuple(values)
+
+
+class KeysetPage:
+    """
+    A page of a query ordered by a unique key, fetched after (or before) the key of the last (or first) row of the
+    page the user comes from instead of with OFFSET, so every page costs the same whatever its number.
+    The total is counted once and cached for COUNT_CACHE_SECONDS, so the number of pages is approximate.
+    Has the attributes of a Flask-SQLAlchemy Pagination used by the templates: items, page, per_page, total, pages,
+    has_prev and has_next, plus prev_cursor and next_cursor to request the neighbouring pages.
+    """
+
+    def __init__(self, query, key_columns, per_page: int, after: str = None, before: str = None, page: int = 1,
+                 descending: bool = False, count_key=None):
+        """
+        :param query: query without ORDER BY and LIMIT
+        :param key_columns: columns of a unique key, the first one should lead an index used by the query
+        :param after: cursor of the last row of the previous page, to get the next page
+        :param before: cursor of the first row of the next page, to get the previous page
+        :param page: number of the page, only displayed
+        :param descending: pages go from the highest key to the lowest
+        :param count_key: key of the total in the count cache, the total is not counted if None
+        """
+        self.per_page = per_page
+        self.page = max(page, 1)
+        self.total = cached_count(count_key, query) if count_key is not None else None
+        key = tuple_(*key_columns) if len(key_columns) > 1 else key_columns[0]
+        after_values = decode_cursor(after, key_columns)
+        before_values = decode_cursor(before, key_columns) if after_values is None else None
+        backwards = before_values is not None
+        if after_values is None and before_values is None:
+            self.page = 1
+            order_desc = descending
+        else:
+            values = after_values or before_values
+            cursor = tuple_(*values) if len(values) > 1 else values[0]
+            # fetch going down the key: next page of a descending order, previous page of an ascending one
+            down = descending != backwards
+            query = query.filter(key < cursor if down else key > cursor)
+            # bound on the first key column alone, a row comparison can't use an index on (filter, first column)
+            query = query.filter(key_columns[0] <= values[0] if down else key_columns[0] >= values[0])
+            order_desc = down
+        order = [column.desc() if order_desc else column.asc() for column in key_columns]
+        rows = query.order_by(*order).limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+            self.has_prev = more
+            self.has_next = True
+            if not more:
+                self.page = 1
+        else:
+            self.has_prev = after_values is not None
+            self.has_next = more
+        keys = [column.key for column in key_columns]
+        self.prev_cursor = encode_cursor([getattr(rows[0], k) for k in keys]) if rows else None
+        self.next_cursor = encode_cursor([getattr(rows[-1], k) for k in keys]) if rows else None
+        self.items = rows
+        # the cached total may be behind the rows
+        self.pages = max(-(-self.total // per_page), self.page) if self.total is not None else None
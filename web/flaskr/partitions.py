@@ -0,0 +1,203 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from .extensions import db
+from .feed_versions import bump_feed_versions
+from .logs import add_to_error_log
+from .models import Feed
+
+# children first: stop_distance rows are found through their trip_record
+PARTITIONED_TABLES = ('stop_distance', 'trip_record', 'vehicle_position')
+PARTITION_FORMAT = '%Y%m%d'
+# serializes partition maintenance between workers
+ADVISORY_LOCK_ID = 74630001
+# a drop waits at most DROP_LOCK_TIMEOUT for its locks so queries do not queue behind it, and is retried
+DROP_LOCK_TIMEOUT = '5s'
+DROP_ATTEMPTS = 3
+DROP_RETRY_SECONDS = 10
+LOCK_NOT_AVAILABLE = '55P03'
+
+# days whose partitions this process created or found, cleared by maintenance since it may drop them
+_known_days = set()
+_known_days_lock = threading.Lock()
+
+
+def partition_name(table: str, day: date):
+    return f'{table}_{day.strftime(PARTITION_FORMAT)}'
+
+
+def existing_partitions(table: str):
+    """
+    :return: dict of day: partition name of the day partitions of table
+    """
+    rows = db.session.execute(text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON pg_inherits.inhparent = parent.oid '
+        'JOIN pg_class child ON pg_inherits.inhrelid = child.oid '
+        'WHERE parent.relname = :table'), {'table': table}).scalars().all()
+    partitions = {}
+    for name in rows:
+        try:
+            partitions[datetime.strptime(name[len(table) + 1:], PARTITION_FORMAT).date()] = name
+        except ValueError:
+            continue  # not a day partition
+    return partitions
+
+
+def create_partitions(first_day: date, last_day: date):
+    """
+    Create the missing day partitions of every partitioned table from first_day to last_day included
+    :return: number of partitions created
+    """
+    created = 0
+    for table in PARTITIONED_TABLES:
+        existing = existing_partitions(table)
+        day = first_day
+        while day <= last_day:
+            if day not in existing:
+                db.session.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {partition_name(table, day)} PARTITION OF {table} '
+                    f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"))
+                created += 1
+            day += timedelta(days=1)
+    return created
+
+
+def ensure_partitions(day: date):
+    """
+    Create the partitions of day if they are missing, for snapshots of days outside the maintained range: a header
+    timestamp of 0, a publisher clock off by days, or an old archive replayed. Commits the session.
+    """
+    with _known_days_lock:
+        if day in _known_days:
+            return
+    db.session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+    created = create_partitions(day, day)
+    db.session.commit()
+    if created:
+        print(f'Partitions: {created} created for {day.isoformat()}')
+    with _known_days_lock:
+        _known_days.add(day)
+
+
+def retention_horizons(default_days):
+    """
+    :param default_days: days kept for feeds without retention_days, None to keep forever
+    :return: dict of feed_id: days kept (None: forever)
+    """
+    return {feed_id: retention_days if retention_days is not None else default_days
+            for feed_id, retention_days in db.session.query(Feed.id, Feed.retention_days).all()}
+
+
+def has_feed_rows(partition: str, vehicle_ids: str, feed_id: int):
+    """
+    :return: True if a partition of vehicle_position or trip_record has rows of the feed, one probe per vehicle
+    """
+    return db.session.execute(text(
+        f'SELECT EXISTS (SELECT 1 FROM {partition} WHERE vehicle_id IN ({vehicle_ids}))'),
+        {'feed_id': feed_id}).scalar()
+
+
+def drop_partition(table: str, name: str):
+    """
+    Detach then drop a partition in its own transaction. Both take an ACCESS EXCLUSIVE lock: waiting for it behind a
+    long dump or export would block every query on the table, so the wait is limited to DROP_LOCK_TIMEOUT and the drop
+    retried DROP_ATTEMPTS times. The version of every feed is increased with it. Commits the session.
+    :return: True if dropped, False if its locks were not available, it is then dropped by the next maintenance
+    """
+    for attempt in range(DROP_ATTEMPTS):
+        if attempt:
+            time.sleep(DROP_RETRY_SECONDS)
+        try:
+            db.session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+            if name not in existing_partitions(table).values():
+                db.session.commit()
+                return False  # dropped by another worker
+            db.session.execute(text(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'"))
+            db.session.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name}'))
+            db.session.execute(text(f'DROP TABLE {name}'))
+            bump_feed_versions()
+            db.session.commit()
+            return True
+        except OperationalError as e:
+            db.session.rollback()
+            if getattr(e.orig, 'pgcode', None) != LOCK_NOT_AVAILABLE:
+                raise
+    add_to_error_log('drop_partition', f'{name}: lock not available after {DROP_ATTEMPTS} attempts')
+    return False
+
+
+def drop_expired_partitions(today: date, default_days):
+    """
+    Drop the day partitions older than every feed's horizon. A feed kept forever keeps every partition, nothing is
+    dropped then. In the partitions older than a feed's horizon that are not dropped, the feed's rows are deleted,
+    one partition at a time, skipping the partitions it has no rows in. The feed's trip segments older than its
+    horizon are deleted. Each drop and each partition's deletes are committed on their own, outside the maintenance
+    lock, so writers creating a partition do not wait on the whole sweep, along with the feed versions they change.
+    Canceled trip records have no vehicle, so no feed: they are not swept, and are only removed with their partition.
+    :return: number of partitions dropped, number of rows deleted
+    """
+    horizons = retention_horizons(default_days)
+    if not horizons:
+        return 0, 0
+    dropped = 0
+    deleted = 0
+    if None not in horizons.values():
+        drop_before = today - timedelta(days=max(horizons.values()))
+        for table in PARTITIONED_TABLES:
+            for day, name in sorted(existing_partitions(table).items()):
+                if day < drop_before and drop_partition(table, name):
+                    dropped += 1
+    for feed_id, days in horizons.items():
+        if days is None:
+            continue
+        expire_before = today - timedelta(days=days)
+        segments = db.session.execute(text('DELETE FROM trip_segment WHERE feed_id = :feed_id AND day < :day'),
+                                      {'feed_id': feed_id, 'day': expire_before}).rowcount
+        if segments:
+            bump_feed_versions([feed_id])
+        db.session.commit()
+        deleted += segments
+        vehicle_ids = 'SELECT id FROM gtfs_vehicles WHERE feed_id = :feed_id'
+        for day, name in sorted(existing_partitions('trip_record').items()):
+            if day >= expire_before or not has_feed_rows(name, vehicle_ids, feed_id):
+                continue
+            deleted += db.session.execute(text(
+                f'DELETE FROM {partition_name("stop_distance", day)} WHERE trip_record_id IN '
+                f'(SELECT id FROM {name} WHERE vehicle_id IN ({vehicle_ids}))'), {'feed_id': feed_id}).rowcount
+            deleted += db.session.execute(text(
+                f'DELETE FROM {name} WHERE vehicle_id IN ({vehicle_ids})'), {'feed_id': feed_id}).rowcount
+            bump_feed_versions([feed_id])
+            db.session.commit()
+        for day, name in sorted(existing_partitions('vehicle_position').items()):
+            if day >= expire_before or not has_feed_rows(name, vehicle_ids, feed_id):
+                continue
+            deleted += db.session.execute(text(
+                f'DELETE FROM {name} WHERE vehicle_id IN ({vehicle_ids})'), {'feed_id': feed_id}).rowcount
+            bump_feed_versions([feed_id])
+            db.session.commit()
+    return dropped, deleted
+
+
+def maintain_partitions(days_ahead: int = 7, default_retention_days=None):
+    """
+    Create the partitions of yesterday (UTC, for feeds behind UTC) to days_ahead days from now, then apply retention
+    :return: partitions created, partitions dropped, rows deleted
+    """
+    today = datetime.utcnow().date()
+    with _known_days_lock:
+        _known_days.clear()
+    try:
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+        created = create_partitions(today - timedelta(days=1), today + timedelta(days=days_ahead))
+        db.session.commit()
+        dropped, deleted = drop_expired_partitions(today, default_retention_days)
+    except BaseException as e:
+        db.session.rollback()
+        add_to_error_log('maintain_partitions', f'{e}')
+        return 0, 0, 0
+    return created, dropped, deleted
@@ -0,0 +1,254 @@
+import queue
+import threading
+from datetime import datetime
+from functools import partial
+from time import perf_counter
+
+from .archive import archive_snapshot
+from .extensions import db
+from .feed_kinds import VEHICLE_POSITIONS, TRIP_UPDATES
+from .gtfs_update import feed_key, fetch_feed, parse_feed, is_feed_processed, mark_feed_processed, \
+    write_vehicle_positions, write_trip_updates
+from .logs import add_to_error_log
+from .metrics import commit_timer
+from .models import Feed
+
+# stages
+FETCH = 'fetch'
+PARSE = 'parse'
+WRITE = 'write'
+STAGES = (FETCH, PARSE, WRITE)
+
+_STOP = object()
+
+
+class FeedJob:
+    """
+    One feed url moving through the fetch -> parse -> write pipeline
+    """
+
+    def __init__(self, feed_data: Feed, kind: str, url: str, time_recorded: datetime):
+        self.feed_data = feed_data
+        self.kind = kind
+        self.url = url
+        self.time_recorded = time_recorded
+        self.fetched = None
+        self.content = None
+        self.payload_bytes = None
+        self.feed = None
+        self.entities = None
+        self.header_timestamp = None
+        self.rows_added = None
+        self.error = None
+        self.timings = {}  # stage: seconds spent in stage, stage_wait: seconds blocked on the next stage's queue
+
+    @property
+    def feed_id(self):
+        return self.feed_data.id
+
+    @property
+    def key(self):
+        return feed_key(self.feed_data.id, self.kind)
+
+    @property
+    def error_source(self):
+        return f'{self.feed_data.company_name}({self.feed_data.id})'
+
+
+class StageStats:
+    """
+    Totals for one stage over a cycle. busy: time spent working, blocked: time spent waiting on a full queue
+    """
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.jobs = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def add(self, busy: float, blocked: float, queue_depth: int):
+        with self._lock:
+            self.jobs += 1
+            self.busy += busy
+            self.blocked += blocked
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def to_dict(self):
+        return {'stage': self.name,
+                'workers': self.workers,
+                'jobs': self.jobs,
+                'busy': self.busy,
+                'blocked': self.blocked,
+                'max_queue_depth': self.max_queue_depth}
+
+
+def feed_jobs(feeds, time_recorded: datetime):
+    """
+    :return: a vehicle position and a trip update FeedJob for each feed that has the url set
+    """
+    jobs = []
+    for feed_data in feeds:
+        if feed_data.vehicle_position_url:
+            jobs.append(FeedJob(feed_data, VEHICLE_POSITIONS, feed_data.vehicle_position_url, time_recorded))
+        if feed_data.trip_update_url:
+            jobs.append(FeedJob(feed_data, TRIP_UPDATES, feed_data.trip_update_url, time_recorded))
+    return jobs
+
+
+def fetch_job(job: FeedJob, read_timeout: float = 30):
+    job.fetched = datetime.utcnow()
+    job.content, job.error = fetch_feed(job.key, job.url, read_timeout)
+    if job.error:
+        add_to_error_log(f'pipeline {job.kind}', f'Failed to retrieve feed for {job.error_source}\n{job.error}')
+        return False
+    if job.content is None:
+        # 304 not modified
+        job.rows_added = 0
+        return False
+    job.payload_bytes = len(job.content)
+    return True
+
+
+def parse_job(job: FeedJob, app=None):
+    job.feed, job.error = parse_feed(job.content)
+    if job.error:
+        job.content = None
+        add_to_error_log(f'pipeline {job.kind}', f'Failed to parse feed for {job.error_source}\n{job.error}')
+        return False
+    job.entities = len(job.feed.entity)
+    job.header_timestamp = job.feed.header.timestamp
+    if is_feed_processed(job.key, job.feed):
+        mark_feed_processed(job.key, job.feed)
+        job.rows_added = 0
+        job.content = None
+        job.feed = None
+        return False
+    if app is not None and app.config.get('ARCHIVE_ENABLED', False):
+        try:
+            archive_snapshot(app, job.feed_id, job.kind, job.fetched, job.feed.header.timestamp, job.content)
+        except BaseException as e:
+            add_to_error_log(f'pipeline {job.kind}', f'Failed to archive feed for {job.error_source}\n{e}')
+    job.content = None
+    return True
+
+
+def write_job(job: FeedJob):
+    commit_timer.take()
+    try:
+        if job.kind == VEHICLE_POSITIONS:
+            job.rows_added = write_vehicle_positions(job.feed_data, job.feed, job.time_recorded)
+        else:
+            job.rows_added = write_trip_updates(job.feed_data, job.feed, job.time_recorded)
+        mark_feed_processed(job.key, job.feed)
+    except BaseException as e:
+        db.session.rollback()
+        job.error = f'write_job Error: {e}'
+        add_to_error_log(f'pipeline {job.kind}', f'Failed to write feed for {job.error_source}\n{job.error}')
+    job.timings['commit'] = commit_timer.take()
+    job.feed = None
+    return False
+
+
+def _run_stage(stage: str, handler, in_queue: queue.Queue, out_queue, stats: StageStats, finish, app=None):
+    """
+    :param finish: function(job) called with each job that does not go on to the next stage
+    """
+    if app is not None:
+        with app.app_context():
+            return _run_stage(stage, handler, in_queue, out_queue, stats, finish)
+    while True:
+        job = in_queue.get()
+        if job is _STOP:
+            return
+        time_start = perf_counter()
+        try:
+            forward = handler(job)
+        except BaseException as e:
+            job.error = f'{stage} Error: {e}'
+            add_to_error_log(f'pipeline {job.kind}', f'{job.error_source}\n{job.error}')
+            forward = False
+        job.timings[stage] = perf_counter() - time_start
+        blocked = 0.0
+        if forward:
+            time_wait = perf_counter()
+            out_queue.put(job)
+            blocked = perf_counter() - time_wait
+            job.timings[f'{stage}_wait'] = blocked
+        else:
+            try:
+                finish(job)
+            except BaseException as e:
+                add_to_error_log(f'pipeline {job.kind}', f'{job.error_source}\nfinish Error: {e}')
+        stats.add(job.timings[stage], blocked, in_queue.qsize())
+
+
+class FeedPipeline:
+    """
+    Fetcher, parser and db writer threads connected by bounded queues, so network and db latency overlap.
+    A full queue blocks the stage feeding it (backpressure). Writer threads each have their own app context and
+    db session. When ARCHIVE_ENABLED, parser threads archive the raw content of new snapshots.
+    A fetch that receives nothing for read_timeout seconds fails, so a stalled server only holds one fetcher.
+    Jobs can be submitted while others are in flight, on_finished(job) is called by the thread that finished a job.
+    """
+
+    def __init__(self, app, on_finished, fetch_workers: int = 4, parse_workers: int = 1, write_workers: int = 2,
+                 queue_size: int = 8, read_timeout: float = 30):
+        self.stats = {FETCH: StageStats(FETCH, fetch_workers),
+                      PARSE: StageStats(PARSE, parse_workers),
+                      WRITE: StageStats(WRITE, write_workers)}
+        fetch_queue = queue.Queue()
+        parse_queue = queue.Queue(maxsize=queue_size)
+        write_queue = queue.Queue(maxsize=queue_size)
+        self._stages = [
+            (FETCH, partial(fetch_job, read_timeout=read_timeout), fetch_queue, parse_queue, fetch_workers, None),
+            (PARSE, partial(parse_job, app=app), parse_queue, write_queue, parse_workers, None),
+            (WRITE, write_job, write_queue, None, write_workers, app),
+        ]
+        self._on_finished = on_finished
+        self._threads = []  # (in_queue, threads) of each stage
+
+    def start(self):
+        for stage, handler, in_queue, out_queue, workers, stage_app in self._stages:
+            stage_threads = [threading.Thread(target=_run_stage, name=f'pipeline_{stage}_{i}', daemon=True,
+                                              args=(stage, handler, in_queue, out_queue, self.stats[stage],
+                                                    self._on_finished, stage_app))
+                             for i in range(max(1, workers))]
+            for thread in stage_threads:
+                thread.start()
+            self._threads.append((in_queue, stage_threads))
+
+    def submit(self, job: FeedJob):
+        """
+        Queue a job for the fetchers, never blocks
+        """
+        self._stages[0][2].put(job)
+
+    def stop(self):
+        """
+        Finish the submitted jobs and stop the threads, each stage once the stage before it has drained
+        """
+        for in_queue, stage_threads in self._threads:
+            for _ in stage_threads:
+                in_queue.put(_STOP)
+            for thread in stage_threads:
+                thread.join()
+        self._threads = []
+
+
+def run_pipeline(app, jobs, fetch_workers: int = 4, parse_workers: int = 1, write_workers: int = 2,
+                 queue_size: int = 8, read_timeout: float = 30):
+    """
+    Run a batch of jobs through a FeedPipeline and wait for all of them
+    :return: list of finished FeedJobs, dict of stage: StageStats
+    """
+    finished = []
+    pipeline = FeedPipeline(app, finished.append, fetch_workers=fetch_workers, parse_workers=parse_workers,
+                            write_workers=write_workers, queue_size=queue_size, read_timeout=read_timeout)
+    pipeline.start()
+    for job in jobs:
+        pipeline.submit(job)
+    pipeline.stop()
+    return finished, pipeline.stats
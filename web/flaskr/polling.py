@@ -0,0 +1,128 @@
+import threading
+
+from .feed_kinds import TRIP_UPDATES
+from .metrics import registry, Gauge, job_result
+
+PHI = 0.6180339887  # golden ratio fraction, spreads feed ids evenly over an interval
+# weight of the newest header timestamp interval in the cadence estimate
+CADENCE_WEIGHT = 0.3
+# a feed that changed on every poll may publish faster than it is polled: try polling this much sooner
+PROBE_FACTOR = 0.8
+# seconds after the expected publish time to poll, so the agency is done publishing
+PUBLISH_LAG = 2
+# polls at a quarter of the cadence while a publish is late, before backing off
+LATE_RETRIES = 3
+MAX_BACKOFF_EXPONENT = 10
+
+poll_interval = registry.register(Gauge(
+    'gtfs_feed_poll_interval_seconds', 'Estimated publish cadence of a feed, the base of its poll interval',
+    ('feed_id', 'company', 'kind')))
+
+
+class FeedSchedule:
+    __slots__ = ('url', 'cadence', 'next_poll', 'last_header_timestamp', 'changed_last_poll', 'unchanged',
+                 'failures', 'in_flight')
+
+    def __init__(self, url: str, cadence: float, next_poll: float):
+        self.url = url
+        self.cadence = cadence
+        self.next_poll = next_poll
+        self.last_header_timestamp = None
+        self.changed_last_poll = False
+        self.unchanged = 0  # polls since the last new snapshot
+        self.failures = 0  # consecutive failed polls
+        self.in_flight = False  # returned by due() and not finished yet
+
+
+class PollSchedule:
+    """
+    When to poll each feed url, learned from the header timestamps of successive snapshots.
+    New urls are staggered over the default cadence. A url is polled shortly after its next publish is expected,
+    a few times more while the publish is late, then less and less often while it stays unchanged or keeps failing.
+    A url is not due again until its job is finished with update() or given back with release().
+    """
+
+    def __init__(self, default_seconds: float = 60, min_seconds: float = 10, max_seconds: float = 600):
+        self.default_seconds = default_seconds
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self._feeds = {}  # (feed_id, kind): FeedSchedule
+        self._lock = threading.Lock()
+
+    def _clamp(self, seconds: float):
+        return min(max(seconds, self.min_seconds), self.max_seconds)
+
+    def due(self, jobs, now: float):
+        """
+        :param jobs: FeedJobs of every feed url
+        :param now: unix time
+        :return: the jobs whose url is due to be polled and not in flight, they are in flight from then on
+        """
+        due_jobs = []
+        with self._lock:
+            keys = set()
+            for job in jobs:
+                keys.add(job.key)
+                schedule = self._feeds.get(job.key, None)
+                if schedule is None or schedule.url != job.url:
+                    # new feed url, or its url changed
+                    stagger = (job.feed_id * PHI + (job.kind == TRIP_UPDATES) * 0.5) % 1 * self.default_seconds
+                    schedule = self._feeds[job.key] = FeedSchedule(job.url, self.default_seconds, now + stagger)
+                if schedule.next_poll <= now and not schedule.in_flight:
+                    schedule.in_flight = True
+                    due_jobs.append(job)
+            for key in set(self._feeds) - keys:
+                del self._feeds[key]  # feed removed
+        return due_jobs
+
+    def update(self, job, now: float):
+        """
+        Schedule the next poll of a finished FeedJob
+        :param now: unix time the job finished
+        """
+        result = job_result(job)
+        with self._lock:
+            schedule = self._feeds.get(job.key, None)
+            if schedule is None or schedule.url != job.url:
+                return
+            schedule.in_flight = False
+            if result == 'error':
+                schedule.failures += 1
+                interval = schedule.cadence * 2 ** min(schedule.failures, MAX_BACKOFF_EXPONENT)
+            elif result == 'written':
+                schedule.failures = 0
+                if schedule.last_header_timestamp and job.header_timestamp > schedule.last_header_timestamp:
+                    delta = job.header_timestamp - schedule.last_header_timestamp
+                    cadence = CADENCE_WEIGHT * delta + (1 - CADENCE_WEIGHT) * schedule.cadence
+                    if schedule.changed_last_poll:
+                        # every poll finds a new snapshot, the feed may publish faster than that
+                        cadence = min(cadence, delta) * PROBE_FACTOR
+                    schedule.cadence = self._clamp(cadence)
+                schedule.last_header_timestamp = job.header_timestamp
+                schedule.changed_last_poll = True
+                schedule.unchanged = 0
+                interval = job.header_timestamp + schedule.cadence + PUBLISH_LAG - now
+                if not 0 < interval <= schedule.cadence + PUBLISH_LAG:
+                    # header timestamp is off from our clock, keep the phase we found the change at
+                    interval = schedule.cadence
+            else:
+                # not modified or same header timestamp, the next publish is late
+                schedule.failures = 0
+                schedule.changed_last_poll = False
+                schedule.unchanged += 1
+                if schedule.unchanged <= LATE_RETRIES:
+                    interval = schedule.cadence / 4
+                else:
+                    interval = schedule.cadence * 2 ** min(schedule.unchanged - LATE_RETRIES, MAX_BACKOFF_EXPONENT)
+            schedule.next_poll = now + self._clamp(interval)
+            cadence = schedule.cadence
+        poll_interval.set(job.feed_id, job.feed_data.company_name, job.kind, value=cadence)
+
+    def release(self, job):
+        """
+        Give back a job returned by due() that was not run, its url is due again at the next dispatch
+        """
+        with self._lock:
+            schedule = self._feeds.get(job.key, None)
+            if schedule is not None and schedule.url == job.url:
+                schedule.in_flight = False
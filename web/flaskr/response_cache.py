@@ -0,0 +1,94 @@
+import functools
+import threading
+from collections import OrderedDict
+
+from flask import request, make_response, Response
+
+from .feed_versions import get_feed_version
+from .latest_state import latest_state
+from .request_utils import FEED_ID
+
+
+class ResponseCache:
+    """
+    Bodies of API responses by endpoint and query parameters, valid while the version of their feed does not change. Least recently used responses are evicted over API_CACHE_SIZE entries or
+    API_CACHE_MAX_BYTES of bodies.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._responses = OrderedDict()  # key: (version, body, mimetype)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        with self._lock:
+            self.max_entries = app.config.get('API_CACHE_SIZE', 1024)
+            self.max_bytes = app.config.get('API_CACHE_MAX_BYTES', 64 * 2 ** 20)
+            self._responses.clear()
+            self._bytes = 0
+
+    def get(self, key, version):
+        """
+        :return: (body, mimetype) cached for key at version, None if not cached
+        """
+        with self._lock:
+            cached = self._responses.get(key, None)
+            if cached is None or cached[0] != version:
+                return None
+            self._responses.move_to_end(key)
+            return cached[1], cached[2]
+
+    def put(self, key, version, body: bytes, mimetype: str):
+        if len(body) > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            previous = self._responses.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            self._responses[key] = (version, body, mimetype)
+            self._bytes += len(body)
+            while len(self._responses) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted, _) = self._responses.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+response_cache = ResponseCache()
+
+
+def feed_versioned(view):
+    """
+    Decorator of a GET endpoint whose answer depends only on its query parameters and the records of the feed_id
+    parameter: the response carries the feed's version as ETag, If-None-Match of the current version is answered
+    304 Not Modified, and successful responses are reused until the version changes.
+    The version is the feed's FeedVersion, increased by every write and deletion of its records (ingestion, replay,
+    retention) so it works without a shared latest state, and the version of its published latest state if any.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        feed_id = request.args.get(FEED_ID, type=int)
+        if feed_id is None:
+            return view(*args, **kwargs)
+        # both are read before the view, whose answer is then never older than the version it is cached under
+        state = latest_state.get(feed_id)
+        version = (get_feed_version(feed_id), state['version'] if state is not None else 0)
+        etag = f'{feed_id}-{version[0]}-{version[1]}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            key = (request.endpoint, tuple(sorted(request.args.items(multi=True))))
+            cached = response_cache.get(key, version)
+            if cached is not None:
+                response = Response(cached[0], status=200, mimetype=cached[1])
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response_cache.put(key, version, response.get_data(), response.mimetype)
+        response.set_etag(etag)
+        # clients revalidate every time, the version changes with every ingest cycle
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return wrapper
@@ -0,0 +1,116 @@
+import math
+import threading
+from datetime import timedelta
+
+from sqlalchemy import select
+
+from .extensions import db
+from .models import Feed, VehiclePosition, LatestRecords
+
+EARTH_RADIUS_METERS = 6371000
+
+
+def distance_meters(lat1: float, lon1: float, lat2: float, lon2: float):
+    """
+    Haversine distance between two points
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+class WrittenPosition:
+    """
+    The last vehicle_position row written for a vehicle
+    """
+    __slots__ = ('id', 'lat', 'lon', 'occupancy_status', 'timestamp', 'day')
+
+    def __init__(self, position_id, lat, lon, occupancy_status, timestamp, day):
+        self.id = position_id
+        self.lat = lat
+        self.lon = lon
+        self.occupancy_status = occupancy_status
+        self.timestamp = timestamp
+        self.day = day
+
+
+class StationaryFilter:
+    """
+    Process wide cache of the last position written for each vehicle by feed, used to skip writing positions
+    of vehicles that have not moved. Vehicles not in the cache are loaded from LatestRecords.
+    """
+
+    def __init__(self):
+        self._positions = {}  # feed_id: {vehicle_id: WrittenPosition}
+        self._lock = threading.Lock()
+
+    def forget_feed(self, feed_id: int):
+        """
+        Drop the cached positions of a feed, they are loaded again from LatestRecords
+        """
+        with self._lock:
+            self._positions.pop(feed_id, None)
+
+    def _load(self, feed_id: int, vehicle_ids):
+        with self._lock:
+            feed_positions = self._positions.setdefault(feed_id, {})
+            missing = [vehicle_id for vehicle_id in vehicle_ids if vehicle_id not in feed_positions]
+        if not missing:
+            return
+        rows = db.session.execute(
+            select(LatestRecords.vehicle_id, VehiclePosition.id, VehiclePosition.lat, VehiclePosition.lon,
+                   VehiclePosition.occupancy_status, VehiclePosition.timestamp, VehiclePosition.day)
+            .join(VehiclePosition, (VehiclePosition.id == LatestRecords.vehicle_position_id)
+                  & (VehiclePosition.day == LatestRecords.vehicle_position_day))
+            .where(LatestRecords.vehicle_id.in_(missing))).all()
+        with self._lock:
+            feed_positions = self._positions.setdefault(feed_id, {})
+            for row in rows:
+                feed_positions.setdefault(row.vehicle_id, WrittenPosition(row.id, row.lat, row.lon,
+                                                                          row.occupancy_status, row.timestamp,
+                                                                          row.day))
+
+    def split(self, feed_data: Feed, positions: list):
+        """
+        :param positions: list of vehicle_position row dicts of a snapshot
+        :return: positions to write, ids of the written positions that the stationary vehicles are still at
+        """
+        self._load(feed_data.id, [position['vehicle_id'] for position in positions])
+        heartbeat = timedelta(minutes=feed_data.heartbeat_minutes)
+        to_write = []
+        stationary_ids = []
+        with self._lock:
+            feed_positions = self._positions.setdefault(feed_data.id, {})
+            for position in positions:
+                last = feed_positions.get(position['vehicle_id'], None)
+                # an older snapshot (replay) is written as is, and each day starts with a new row in its partition
+                if last is not None \
+                        and position['day'] == last.day \
+                        and position['occupancy_status'] == last.occupancy_status \
+                        and timedelta(0) <= position['timestamp'] - last.timestamp < heartbeat \
+                        and distance_meters(last.lat, last.lon, position['lat'], position['lon']) \
+                        < feed_data.stationary_distance:
+                    stationary_ids.append(last.id)
+                else:
+                    to_write.append(position)
+        return to_write, stationary_ids
+
+    def update(self, feed_id: int, positions: list, position_ids: dict):
+        """
+        Remember committed positions, unless a newer position of the vehicle is already remembered
+        :param positions: list of vehicle_position row dicts
+        :param position_ids: dict of vehicle_id: vehicle_position_id
+        """
+        with self._lock:
+            feed_positions = self._positions.setdefault(feed_id, {})
+            for position in positions:
+                vehicle_id = position['vehicle_id']
+                last = feed_positions.get(vehicle_id, None)
+                if last is not None and last.timestamp > position['timestamp']:
+                    continue
+                feed_positions[vehicle_id] = WrittenPosition(position_ids[vehicle_id], position['lat'],
+                                                             position['lon'], position['occupancy_status'],
+                                                             position['timestamp'], position['day'])
+
+
+stationary_filter = StationaryFilter()
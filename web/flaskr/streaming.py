@@ -0,0 +1,68 @@
+import json
+import zlib
+
+from flask import Response, request, stream_with_context
+
+# rows fetched per round trip of a server-side cursor, and serialized rows sent per chunk
+STREAM_BATCH_ROWS = 1000
+NDJSON = 'ndjson'
+
+
+def json_chunks(header: dict, rows, footer_key: str = 'count'):
+    """
+    Stream {**header, "data": [rows...], footer_key: number of rows} in chunks of STREAM_BATCH_ROWS rows
+    :param rows: iterable of json serializable rows
+    """
+    head = json.dumps(header)
+    yield head[:-1] + (', ' if header else '') + '"data": ['
+    count = 0
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row))
+        count += 1
+        if len(chunk) >= STREAM_BATCH_ROWS:
+            yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+            chunk = []
+    if chunk:
+        yield (', ' if count > len(chunk) else '') + ', '.join(chunk)
+    yield f'], "{footer_key}": {count}}}'
+
+
+def ndjson_chunks(rows):
+    """
+    Stream one json row per line, in chunks of STREAM_BATCH_ROWS rows
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row) + '\n')
+        if len(chunk) >= STREAM_BATCH_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_rows(header: dict, rows):
+    """
+    Response streaming rows as they are fetched: NDJSON if the request has format=ndjson, otherwise a json object of
+    header, data and count. Gzipped when the client accepts it.
+    :param rows: iterable of json serializable rows, read from the db while the response is sent
+    """
+    if request.values.get('format', '') == NDJSON:
+        chunks, mimetype = ndjson_chunks(rows), 'application/x-ndjson'
+    else:
+        chunks, mimetype = json_chunks(header, rows), 'application/json'
+    headers = {'X-Accel-Buffering': 'no', 'Vary': 'Accept-Encoding'}  # nginx sends chunks as they come
+    if 'gzip' in request.accept_encodings:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
@@ -0,0 +1,169 @@
+import json
+import queue
+import threading
+from time import sleep
+
+from .latest_state import latest_state
+from .logs import add_to_error_log
+
+
+def changed(previous: dict, current: dict):
+    """
+    :return: dict of the entries of current that are not in previous or differ
+    """
+    updates = {}
+    for gtfs_id, record in current.items():
+        last = previous.get(gtfs_id, None)
+        # unchanged records of a state published by this process are the same objects
+        if last is not record and last != record:
+            updates[gtfs_id] = record
+    return updates
+
+
+def filtered(state: dict, gtfs_ids):
+    """
+    :param gtfs_ids: set of gtfs_id (str), None for all
+    :return: positions and trips of state of the vehicles in gtfs_ids
+    """
+    if gtfs_ids is None:
+        return state['positions'], state['trips']
+    return ({gtfs_id: p for gtfs_id, p in state['positions'].items() if gtfs_id in gtfs_ids},
+            {gtfs_id: t for gtfs_id, t in state['trips'].items() if gtfs_id in gtfs_ids})
+
+
+def server_sent_event(event: str, version: int, positions: dict, trips: dict):
+    data = json.dumps({'version': version, 'positions': positions, 'trips': trips}, separators=(',', ':'))
+    return f'event: {event}\nid: {version}\ndata: {data}\n\n'
+
+
+class Subscriber:
+    """
+    A client of the updates of a feed, or of some of its vehicles. Events wait in a bounded queue; a subscriber that
+    does not keep up loses its queued events and gets a new snapshot instead.
+    """
+
+    def __init__(self, feed_id: int, gtfs_ids, queue_size: int):
+        self.feed_id = feed_id
+        self.gtfs_ids = gtfs_ids
+        self.events = queue.Queue(maxsize=queue_size)
+        self.lagged = False
+
+    def send(self, event: str):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.lagged = True
+
+    def receive(self, timeout: float):
+        """
+        :return: next event, None if there was none for timeout seconds
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def snapshot(self, state: dict):
+        """
+        Replace the queued events by the whole state
+        """
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                break
+        self.lagged = False
+        positions, trips = filtered(state, self.gtfs_ids)
+        self.send(server_sent_event('snapshot', state['version'], positions, trips))
+
+
+class FeedWatcher:
+    """
+    One thread per process watches the latest state of the feeds that have subscribers, and after each publish sends
+    the vehicles whose position or trip changed to every subscriber of the feed. The event of the whole feed is
+    encoded once for all its subscribers.
+    """
+
+    def __init__(self):
+        self.poll_seconds = 1
+        self.queue_size = 16
+        self.max_subscribers = 8
+        self._subscribers = {}  # feed_id: set of Subscriber
+        self._states = {}  # feed_id: last state sent
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.poll_seconds = app.config.get('SSE_POLL_SECONDS', 1)
+        self.queue_size = app.config.get('SSE_QUEUE_SIZE', 16)
+        self.max_subscribers = app.config.get('SSE_MAX_SUBSCRIBERS', 8)
+
+    def subscribe(self, feed_id: int, gtfs_ids, state: dict):
+        """
+        :param gtfs_ids: set of gtfs_id (str) to follow, None for all the vehicles of the feed
+        :param state: the current state of the feed, sent first unless the feed is already watched
+        :return: Subscriber, None if OK. None, error if this process has too many subscribers
+        """
+        with self._lock:
+            if sum(len(subscribers) for subscribers in self._subscribers.values()) >= self.max_subscribers:
+                return None, 'too many subscribers'
+            subscriber = Subscriber(feed_id, gtfs_ids, self.queue_size)
+            # the next update is the difference from the watched state, the snapshot must be that state
+            state = self._states.setdefault(feed_id, state)
+            subscriber.snapshot(state)
+            self._subscribers.setdefault(feed_id, set()).add(subscriber)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._watch, name='feed-watcher', daemon=True)
+                self._thread.start()
+        return subscriber, None
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.feed_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(subscriber.feed_id, None)
+                self._states.pop(subscriber.feed_id, None)
+
+    def _watch(self):
+        while True:
+            sleep(self.poll_seconds)
+            with self._lock:
+                feed_ids = list(self._subscribers)
+            for feed_id in feed_ids:
+                try:
+                    self._update(feed_id)
+                except BaseException as e:
+                    add_to_error_log('feed watcher', f'Cannot send the updates of feed {feed_id}\n{e}')
+
+    def _update(self, feed_id: int):
+        state = latest_state.get(feed_id)
+        with self._lock:
+            previous = self._states.get(feed_id, None)
+            subscribers = list(self._subscribers.get(feed_id, ()))
+        if state is None or previous is None or state['version'] == previous['version']:
+            return
+        positions = changed(previous['positions'], state['positions'])
+        trips = changed(previous['trips'], state['trips'])
+        with self._lock:
+            if feed_id in self._states:
+                self._states[feed_id] = state
+        if not positions and not trips:
+            return
+        event = None
+        for subscriber in subscribers:
+            if subscriber.gtfs_ids is None:
+                if event is None:
+                    event = server_sent_event('update', state['version'], positions, trips)
+                subscriber.send(event)
+            else:
+                subscriber_positions, subscriber_trips = filtered(
+                    {'positions': positions, 'trips': trips}, subscriber.gtfs_ids)
+                if subscriber_positions or subscriber_trips:
+                    subscriber.send(server_sent_event('update', state['version'], subscriber_positions,
+                                                      subscriber_trips))
+            if subscriber.lagged:
+                subscriber.snapshot(state)
+
+
+feed_watcher = FeedWatcher()
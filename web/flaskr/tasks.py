@@ -1,18 +1,164 @@
-from .gtfs_update import update_vehicle_position, update_trip_updates
+import time
+from functools import partial
+from time import perf_counter
+
+from . import partitions
 from .extensions import scheduler, db
+from .feed_kinds import VEHICLE_POSITIONS
+from .leases import lease_manager
+from .metrics import record_cycle, record_polled_job
 from .models import Feed
-from datetime import datetime
+from .pipeline import FeedPipeline, run_pipeline, feed_jobs, STAGES
+from .polling import PollSchedule
+from datetime import datetime, timezone
+
+
+def job_report(job):
+    """
+    :return: the result and stage timings of a finished FeedJob
+    """
+    name = 'positions' if job.kind == VEHICLE_POSITIONS else 'trips/stops'
+    timings = ' '.join(f'{stage} {job.timings[stage]:.2f}s' for stage in STAGES if stage in job.timings)
+    return f'{name}: {job.error if job.error else job.rows_added} ({timings})'
+
+
+def report_cycle(jobs, stats):
+    """
+    Print the result of each feed and the totals of each pipeline stage
+    """
+    feeds = {}
+    for job in jobs:
+        feeds.setdefault(job.feed_id, []).append(job)
+    for feed_id in sorted(feeds):
+        print(f'Feed {feed_id} | ' + ' | '.join(job_report(job) for job in feeds[feed_id]))
+    for stage in STAGES:
+        s = stats[stage]
+        print(f'Stage {s.name}: {s.jobs} jobs | {s.workers} workers | busy {s.busy:.2f}s | '
+              f'blocked {s.blocked:.2f}s | max queue {s.max_queue_depth}')
+
+
+def load_feeds():
+    """
+    :return: the Feeds ingested by this process, all of them or only the leased ones when FEED_LEASES_ENABLED
+    """
+    query = db.session.query(Feed).order_by(Feed.id)
+    if lease_manager.active:
+        query = query.filter(Feed.id.in_(lease_manager.owned()))
+    return query.all()
+
+
+def run_cycle(app, jobs):
+    """
+    Run FeedJobs through the pipeline, report and record metrics.
+    With leases, jobs of feeds no longer leased are dropped, and the others are not released while running.
+    :return: list of finished FeedJobs
+    """
+    cycle_start = perf_counter()
+    if lease_manager.active:
+        feed_ids = lease_manager.acquire({job.feed_id for job in jobs})
+        jobs = [job for job in jobs if job.feed_id in feed_ids]
+        if not jobs:
+            return []
+    try:
+        finished, stats = run_pipeline(app, jobs,
+                                       fetch_workers=app.config.get('FEED_UPDATE_MAX_WORKERS', 1),
+                                       parse_workers=app.config.get('FEED_PARSE_WORKERS', 1),
+                                       write_workers=app.config.get('FEED_WRITE_WORKERS', 1),
+                                       queue_size=app.config.get('FEED_QUEUE_SIZE', 8),
+                                       read_timeout=app.config.get('FEED_READ_TIMEOUT', 30))
+    finally:
+        if lease_manager.active:
+            lease_manager.done({job.feed_id for job in jobs})
+    cycle_seconds = perf_counter() - cycle_start
+    report_cycle(finished, stats)
+    record_cycle(finished, cycle_seconds)
+    time_end = datetime.utcnow().replace(microsecond=0)
+    print(f'Feeds updated {time_end.isoformat()} ({len(jobs)} urls, {cycle_seconds:.2f}s)\n')
+    return finished
 
 
-@scheduler.task('cron', id='update_feed_all', second=0, misfire_grace_time=10)
 def update_feeds():
-    with scheduler.app.app_context():
+    """
+    Update every feed
+    """
+    app = scheduler.app
+    with app.app_context():
         time_start = datetime.utcnow().replace(microsecond=0)
-        feeds = db.session.query(Feed).all()
-        for feed in feeds:
-            print(f'Updating Feed {feed.id}')
-            update_vehicle_position(feed.id, time_start)
-            update_trip_updates(feed.id, time_start)
-        time_end = datetime.utcnow().replace(microsecond=0)
-        print(f'All feeds updated {time_end.isoformat()}\n')
+        feeds = load_feeds()
+        jobs = feed_jobs(feeds, time_start)
+    run_cycle(app, jobs)
+
+
+def finish_polled_job(schedule: PollSchedule, job):
+    """
+    Schedule the next poll of a feed url as soon as its job finished, report it and record its metrics
+    """
+    schedule.update(job, time.time())
+    if lease_manager.active:
+        lease_manager.done([job.feed_id])
+    print(f'Feed {job.feed_id} | {job_report(job)}')
+    record_polled_job(job)
+
+
+def poll_feeds(schedule: PollSchedule, pipeline: FeedPipeline):
+    """
+    Submit the feed urls that are due in the poll schedule to the pipeline without waiting for them, so a slow feed
+    does not hold up the others. Urls still in flight are not due, the pipeline schedules each url again when done.
+    With leases, jobs of feeds no longer leased are given back, and the others are not released while in flight.
+    """
+    app = scheduler.app
+    with app.app_context():
+        time_start = datetime.utcnow().replace(microsecond=0)
+        feeds = load_feeds()
+        jobs = schedule.due(feed_jobs(feeds, time_start), time.time())
+    if lease_manager.active and jobs:
+        # one acquire per job, each is done when its job finishes
+        feed_ids = set(lease_manager.acquire([job.feed_id for job in jobs]))
+        for job in jobs:
+            if job.feed_id not in feed_ids:
+                schedule.release(job)
+        jobs = [job for job in jobs if job.feed_id in feed_ids]
+    for job in jobs:
+        pipeline.submit(job)
+
+
+def maintain_partitions():
+    """
+    Create the coming day partitions and drop or sweep the expired ones
+    """
+    app = scheduler.app
+    with app.app_context():
+        created, dropped, deleted = partitions.maintain_partitions(
+            days_ahead=app.config.get('PARTITION_DAYS_AHEAD', 7),
+            default_retention_days=app.config.get('RETENTION_DAYS', None))
+        db.session.remove()
+    print(f'Partitions: {created} created | {dropped} dropped | {deleted} expired rows deleted')
+
 
+def init_jobs(app):
+    """
+    Schedule the feed updates: every feed every minute, or each feed url on its own learned cadence
+    when FEED_POLL_ADAPTIVE, through a pipeline that runs as long as the app. With FEED_LEASES_ENABLED, only the feeds
+    leased by this process are updated.
+    """
+    if app.config.get('FEED_LEASES_ENABLED', False):
+        lease_manager.start(app)
+    if app.config.get('FEED_POLL_ADAPTIVE', False):
+        schedule = PollSchedule(default_seconds=app.config.get('FEED_POLL_DEFAULT_SECONDS', 60),
+                                min_seconds=app.config.get('FEED_POLL_MIN_SECONDS', 10),
+                                max_seconds=app.config.get('FEED_POLL_MAX_SECONDS', 600))
+        pipeline = FeedPipeline(app, partial(finish_polled_job, schedule),
+                                fetch_workers=app.config.get('FEED_UPDATE_MAX_WORKERS', 1),
+                                parse_workers=app.config.get('FEED_PARSE_WORKERS', 1),
+                                write_workers=app.config.get('FEED_WRITE_WORKERS', 1),
+                                queue_size=app.config.get('FEED_QUEUE_SIZE', 8),
+                                read_timeout=app.config.get('FEED_READ_TIMEOUT', 30))
+        pipeline.start()
+        scheduler.add_job('poll_feeds', poll_feeds, kwargs={'schedule': schedule, 'pipeline': pipeline},
+                          trigger='interval', seconds=app.config.get('FEED_POLL_DISPATCH_SECONDS', 5),
+                          misfire_grace_time=5)
+    else:
+        scheduler.add_job('update_feed_all', update_feeds, trigger='cron', second=0, misfire_grace_time=10)
+    # once at start, so the partitions exist before the first write
+    scheduler.add_job('maintain_partitions', maintain_partitions, trigger='cron', minute=30,
+                      next_run_time=datetime.now(timezone.utc), misfire_grace_time=600)
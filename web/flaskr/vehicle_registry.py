@@ -0,0 +1,81 @@
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from .extensions import db
+from .models import Vehicles
+
+
+class VehicleRegistry:
+    """
+    Process wide gtfs_id -> vehicle_id map for each feed.
+    A feed is loaded once, then refreshed with only the vehicles added since (vehicle ids only increase); vehicles
+    missed by a refresh because they committed after a higher id are found when they are registered.
+    """
+
+    def __init__(self):
+        self._vehicles = {}  # feed_id: {gtfs_id: vehicle_id}
+        self._max_vehicle_ids = {}  # feed_id: highest vehicle id loaded
+        self._lock = threading.Lock()
+
+    def _add(self, feed_id: int, rows):
+        with self._lock:
+            vehicles = self._vehicles.setdefault(feed_id, {})
+            max_vehicle_id = self._max_vehicle_ids.get(feed_id, 0)
+            for vehicle_id, gtfs_id in rows:
+                vehicles[gtfs_id] = vehicle_id
+                max_vehicle_id = max(max_vehicle_id, vehicle_id)
+            self._max_vehicle_ids[feed_id] = max_vehicle_id
+
+    def refresh(self, feed_id: int):
+        """
+        Load vehicles added to the feed since the last refresh
+        """
+        max_vehicle_id = self._max_vehicle_ids.get(feed_id, 0)
+        rows = db.session.execute(
+            select(Vehicles.id, Vehicles.vehicle_gtfs_id)
+            .where(Vehicles.feed_id == feed_id, Vehicles.id > max_vehicle_id)).all()
+        self._add(feed_id, rows)
+
+    def register(self, feed_id: int, gtfs_ids):
+        """
+        Add vehicles with one INSERT ... ON CONFLICT DO NOTHING RETURNING, committed on its own connection
+        so the caller's transaction is untouched. Vehicles added concurrently by another writer conflict and are
+        selected by gtfs_id: their ids may be lower than the highest id loaded if they committed later.
+        """
+        gtfs_ids = sorted(gtfs_ids)
+        stmt = pg_insert(Vehicles).values([{'feed_id': feed_id, 'vehicle_gtfs_id': gtfs_id} for gtfs_id in gtfs_ids])
+        stmt = stmt.on_conflict_do_nothing(index_elements=[Vehicles.feed_id, Vehicles.vehicle_gtfs_id]) \
+            .returning(Vehicles.id, Vehicles.vehicle_gtfs_id)
+        with db.engine.begin() as connection:
+            rows = connection.execute(stmt).all()
+            if len(rows) < len(gtfs_ids):
+                inserted = {gtfs_id for _, gtfs_id in rows}
+                rows += connection.execute(
+                    select(Vehicles.id, Vehicles.vehicle_gtfs_id)
+                    .where(Vehicles.feed_id == feed_id,
+                           Vehicles.vehicle_gtfs_id.in_([gtfs_id for gtfs_id in gtfs_ids
+                                                         if gtfs_id not in inserted]))).all()
+        self._add(feed_id, rows)
+
+    def get_vehicle_ids(self, feed_id: int, gtfs_ids=()):
+        """
+        :param gtfs_ids: gtfs_ids seen in a snapshot, any that are not registered yet are added
+        :return: dict of gtfs_id: vehicle_id for the feed, None, if OK. Known vehicles, error if registering failed
+        """
+        self.refresh(feed_id)
+        error = None
+        with self._lock:
+            vehicles = self._vehicles.setdefault(feed_id, {})
+            new_gtfs_ids = {gtfs_id for gtfs_id in gtfs_ids if gtfs_id not in vehicles}
+        if new_gtfs_ids:
+            try:
+                self.register(feed_id, new_gtfs_ids)
+            except BaseException as e:
+                error = f'VehicleRegistry Error: cannot add vehicles for feed {feed_id}: {e}'
+        with self._lock:
+            return dict(self._vehicles[feed_id]), error
+
+
+vehicle_registry = VehicleRegistry()
@@ -0,0 +1,40 @@
+"""trip segment rollup
+
+Revision ID: 5a2f86c1d93e
+Revises: e41c9b07d2a5
+Create Date: 2026-10-18 17:25:37.119842
+
+Filled from the existing trip records, ingestion keeps it up to date afterwards.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a2f86c1d93e'
+down_revision = 'e41c9b07d2a5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('trip_segment',
+                    sa.Column('feed_id', sa.Integer(), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('trip_id', sa.String(), nullable=False),
+                    sa.Column('vehicle_id', sa.Integer(), nullable=False),
+                    sa.Column('first_timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('record_count', sa.Integer(), nullable=False),
+                    sa.ForeignKeyConstraint(['feed_id'], ['gtfs_feeds.id'], ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(['vehicle_id'], ['gtfs_vehicles.id'], ),
+                    sa.PrimaryKeyConstraint('feed_id', 'day', 'trip_id', 'vehicle_id'))
+    op.execute('INSERT INTO trip_segment '
+               '(feed_id, day, trip_id, vehicle_id, first_timestamp, last_timestamp, record_count) '
+               'SELECT v.feed_id, t.day, t.trip_id, t.vehicle_id, min(t.timestamp), max(t.timestamp), count(*) '
+               'FROM trip_record t JOIN gtfs_vehicles v ON v.id = t.vehicle_id '
+               'GROUP BY v.feed_id, t.day, t.trip_id, t.vehicle_id')
+
+
+def downgrade():
+    op.drop_table('trip_segment')
@@ -0,0 +1,58 @@
+"""vehicle gtfs id unique per feed
+
+Revision ID: 935b5ed69086
+Revises: 6e7afda9b4f1
+Create Date: 2026-10-18 14:59:21.167845
+
+Vehicles registered twice for a feed are merged into the one with the lowest id before the constraint is added:
+their positions and trip records are repointed, and their latest records are merged keeping the newest ids.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '935b5ed69086'
+down_revision = '6e7afda9b4f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE TEMPORARY TABLE vehicle_duplicates AS '
+               'SELECT v.id AS duplicate_id, k.keep_id FROM gtfs_vehicles v '
+               'JOIN (SELECT feed_id, vehicle_gtfs_id, min(id) AS keep_id FROM gtfs_vehicles '
+               '      GROUP BY feed_id, vehicle_gtfs_id HAVING count(*) > 1) k '
+               'ON k.feed_id = v.feed_id AND k.vehicle_gtfs_id = v.vehicle_gtfs_id WHERE v.id <> k.keep_id')
+    for table in ('vehicle_position', 'trip_record'):
+        op.execute(f'UPDATE {table} r SET vehicle_id = d.keep_id FROM vehicle_duplicates d '
+                   f'WHERE r.vehicle_id = d.duplicate_id')
+    # record ids only increase, the highest id of the merged vehicles is their latest record
+    op.execute('INSERT INTO latest_records (vehicle_id) SELECT DISTINCT d.keep_id FROM vehicle_duplicates d '
+               'JOIN latest_records l ON l.vehicle_id = d.duplicate_id '
+               'WHERE NOT EXISTS (SELECT 1 FROM latest_records k WHERE k.vehicle_id = d.keep_id)')
+    op.execute('UPDATE latest_records l '
+               'SET vehicle_position_id = greatest(l.vehicle_position_id, m.vehicle_position_id), '
+               '    trip_record_id = greatest(l.trip_record_id, m.trip_record_id) '
+               'FROM (SELECT d.keep_id, max(r.vehicle_position_id) AS vehicle_position_id, '
+               '             max(r.trip_record_id) AS trip_record_id '
+               '      FROM vehicle_duplicates d JOIN latest_records r ON r.vehicle_id = d.duplicate_id '
+               '      GROUP BY d.keep_id) m '
+               'WHERE l.vehicle_id = m.keep_id')
+    op.execute('DELETE FROM latest_records WHERE vehicle_id IN (SELECT duplicate_id FROM vehicle_duplicates)')
+    op.execute('DELETE FROM gtfs_vehicles WHERE id IN (SELECT duplicate_id FROM vehicle_duplicates)')
+    op.execute('DROP TABLE vehicle_duplicates')
+
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('gtfs_vehicles', schema=None) as batch_op:
+        batch_op.create_unique_constraint('gtfs_vehicles_feed_id_vehicle_gtfs_id_key', ['feed_id', 'vehicle_gtfs_id'])
+
+    # ### end Alembic commands ###
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    with op.batch_alter_table('gtfs_vehicles', schema=None) as batch_op:
+        batch_op.drop_constraint('gtfs_vehicles_feed_id_vehicle_gtfs_id_key', type_='unique')
+
+    # ### end Alembic commands ###
@@ -0,0 +1,29 @@
+"""feed version
+
+Revision ID: a6d4e19f3c52
+Revises: c3f1a9d27e64
+Create Date: 2026-10-18 20:41:07.512306
+
+Feeds without a row are at version 0, ingestion adds it with the next write.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d4e19f3c52'
+down_revision = 'c3f1a9d27e64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('feed_version',
+                    sa.Column('feed_id', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.BigInteger(), nullable=False),
+                    sa.ForeignKeyConstraint(['feed_id'], ['gtfs_feeds.id'], ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('feed_id'))
+
+
+def downgrade():
+    op.drop_table('feed_version')
@@ -0,0 +1,166 @@
+"""day partitioned records
+
+Revision ID: b8e2d41c7a90
+Revises: 3d35161a3856
+Create Date: 2026-10-18 15:20:41.310254
+
+Converts vehicle_position, trip_record and stop_distance to tables partitioned by day (Postgres 12+).
+stop_distance gets the day of its trip record. Foreign keys to these tables are dropped, a foreign key has to
+reference the whole primary key (id, day) of a partitioned table. Existing rows are copied, which takes a while
+on large tables.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e2d41c7a90'
+down_revision = '3d35161a3856'
+branch_labels = None
+depends_on = None
+
+PARTITION_DAYS_AHEAD = 7
+OLD_INDEXES = {
+    'vehicle_position': ['ix_vehicle_position_day', 'ix_vehicle_position_time_recorded',
+                         'ix_vehicle_position_timestamp'],
+    'trip_record': ['ix_trip_record_day', 'ix_trip_record_time_recorded', 'ix_trip_record_timestamp',
+                    'ix_trip_record_canceled_day_trip_id'],
+    'stop_distance': [],
+}
+
+
+def id_column(table):
+    return sa.Column('id', sa.Integer(), server_default=sa.text(f"nextval('{table}_id_seq'::regclass)"),
+                     nullable=False)
+
+
+def create_day_partitions(table, days_table):
+    """
+    Create a partition of table for every day from the oldest day in days_table to PARTITION_DAYS_AHEAD from today
+    """
+    op.execute(f"""
+DO $$
+DECLARE
+    d date;
+BEGIN
+    FOR d IN SELECT generate_series(
+            LEAST(COALESCE((SELECT min(day) FROM {days_table}), current_date), current_date) - 1,
+            GREATEST(COALESCE((SELECT max(day) FROM {days_table}), current_date), current_date)
+                + {PARTITION_DAYS_AHEAD},
+            interval '1 day')::date
+    LOOP
+        EXECUTE format('CREATE TABLE %I PARTITION OF {table} FOR VALUES FROM (%L) TO (%L)',
+                       '{table}_' || to_char(d, 'YYYYMMDD'), d, d + 1);
+    END LOOP;
+END $$""")
+
+
+def upgrade():
+    op.add_column('gtfs_feeds', sa.Column('retention_days', sa.Integer(), nullable=True))
+
+    op.drop_constraint('latest_records_vehicle_position_id_fkey', 'latest_records', type_='foreignkey')
+    op.drop_constraint('latest_records_trip_record_id_fkey', 'latest_records', type_='foreignkey')
+    op.drop_constraint('stop_distance_trip_record_id_fkey', 'stop_distance', type_='foreignkey')
+
+    for table, indexes in OLD_INDEXES.items():
+        op.rename_table(table, f'{table}_old')
+        op.execute(f'ALTER INDEX {table}_pkey RENAME TO {table}_old_pkey')
+        for index in indexes:
+            op.drop_index(index, table_name=f'{table}_old')
+        # the id sequences carry over to the new tables
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY NONE')
+
+    op.create_table('vehicle_position',
+                    id_column('vehicle_position'),
+                    sa.Column('vehicle_id', sa.Integer(), nullable=False),
+                    sa.Column('lat', sa.Float(), nullable=False),
+                    sa.Column('lon', sa.Float(), nullable=False),
+                    sa.Column('occupancy_status', sa.Integer(), nullable=True),
+                    sa.Column('time_recorded', sa.DateTime(), nullable=False),
+                    sa.Column('timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('last_timestamp', sa.DateTime(), nullable=True),
+                    sa.ForeignKeyConstraint(['vehicle_id'], ['gtfs_vehicles.id'],
+                                            name='vehicle_position_vehicle_id_fkey'),
+                    sa.PrimaryKeyConstraint('id', 'day'),
+                    postgresql_partition_by='RANGE (day)')
+    op.create_table('trip_record',
+                    id_column('trip_record'),
+                    sa.Column('vehicle_id', sa.Integer(), nullable=True),
+                    sa.Column('trip_id', sa.String(), nullable=False),
+                    sa.Column('time_recorded', sa.DateTime(), nullable=False),
+                    sa.Column('timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.ForeignKeyConstraint(['vehicle_id'], ['gtfs_vehicles.id'], name='trip_record_vehicle_id_fkey'),
+                    sa.PrimaryKeyConstraint('id', 'day'),
+                    postgresql_partition_by='RANGE (day)')
+    op.create_table('stop_distance',
+                    id_column('stop_distance'),
+                    sa.Column('trip_record_id', sa.Integer(), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('stop_id', sa.Integer(), nullable=False),
+                    sa.Column('time_till_arrive', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id', 'day'),
+                    postgresql_partition_by='RANGE (day)')
+
+    create_day_partitions('vehicle_position', 'vehicle_position_old')
+    create_day_partitions('trip_record', 'trip_record_old')
+    create_day_partitions('stop_distance', 'trip_record_old')
+
+    op.execute('INSERT INTO vehicle_position '
+               '(id, vehicle_id, lat, lon, occupancy_status, time_recorded, timestamp, day, last_timestamp) '
+               'SELECT id, vehicle_id, lat, lon, occupancy_status, time_recorded, timestamp, day, last_timestamp '
+               'FROM vehicle_position_old')
+    op.execute('INSERT INTO trip_record (id, vehicle_id, trip_id, time_recorded, timestamp, day) '
+               'SELECT id, vehicle_id, trip_id, time_recorded, timestamp, day FROM trip_record_old')
+    op.execute('INSERT INTO stop_distance (id, trip_record_id, day, stop_id, time_till_arrive) '
+               'SELECT s.id, s.trip_record_id, t.day, s.stop_id, s.time_till_arrive '
+               'FROM stop_distance_old s JOIN trip_record_old t ON t.id = s.trip_record_id')
+
+    # indexes after the copy, they are created on every partition
+    op.create_index('ix_vehicle_position_day', 'vehicle_position', ['day'], unique=False)
+    op.create_index('ix_vehicle_position_time_recorded', 'vehicle_position', ['time_recorded'], unique=False)
+    op.create_index('ix_vehicle_position_timestamp', 'vehicle_position', ['timestamp'], unique=False)
+    op.create_index('ix_trip_record_day', 'trip_record', ['day'], unique=False)
+    op.create_index('ix_trip_record_time_recorded', 'trip_record', ['time_recorded'], unique=False)
+    op.create_index('ix_trip_record_timestamp', 'trip_record', ['timestamp'], unique=False)
+    op.create_index('ix_trip_record_canceled_day_trip_id', 'trip_record', ['day', 'trip_id'], unique=False,
+                    postgresql_where=sa.text('vehicle_id IS NULL'))
+
+    for table in OLD_INDEXES:
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+        op.drop_table(f'{table}_old')
+
+
+def downgrade():
+    for table, indexes in OLD_INDEXES.items():
+        op.execute(f'CREATE TABLE {table}_plain (LIKE {table} INCLUDING DEFAULTS)')
+        op.execute(f'INSERT INTO {table}_plain SELECT * FROM {table}')
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY NONE')
+        op.drop_table(table)
+        op.rename_table(f'{table}_plain', table)
+        op.create_primary_key(f'{table}_pkey', table, ['id'])
+        op.execute(f'ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id')
+    op.drop_column('stop_distance', 'day')
+
+    op.create_index('ix_vehicle_position_day', 'vehicle_position', ['day'], unique=False)
+    op.create_index('ix_vehicle_position_time_recorded', 'vehicle_position', ['time_recorded'], unique=False)
+    op.create_index('ix_vehicle_position_timestamp', 'vehicle_position', ['timestamp'], unique=False)
+    op.create_index('ix_trip_record_day', 'trip_record', ['day'], unique=False)
+    op.create_index('ix_trip_record_time_recorded', 'trip_record', ['time_recorded'], unique=False)
+    op.create_index('ix_trip_record_timestamp', 'trip_record', ['timestamp'], unique=False)
+    op.create_index('ix_trip_record_canceled_day_trip_id', 'trip_record', ['day', 'trip_id'], unique=False,
+                    postgresql_where=sa.text('vehicle_id IS NULL'))
+
+    op.create_foreign_key('vehicle_position_vehicle_id_fkey', 'vehicle_position', 'gtfs_vehicles',
+                          ['vehicle_id'], ['id'])
+    op.create_foreign_key('trip_record_vehicle_id_fkey', 'trip_record', 'gtfs_vehicles', ['vehicle_id'], ['id'])
+    # not validated: rows dropped by retention may still be referenced
+    op.execute('ALTER TABLE stop_distance ADD CONSTRAINT stop_distance_trip_record_id_fkey '
+               'FOREIGN KEY (trip_record_id) REFERENCES trip_record (id) NOT VALID')
+    op.execute('ALTER TABLE latest_records ADD CONSTRAINT latest_records_vehicle_position_id_fkey '
+               'FOREIGN KEY (vehicle_position_id) REFERENCES vehicle_position (id) NOT VALID')
+    op.execute('ALTER TABLE latest_records ADD CONSTRAINT latest_records_trip_record_id_fkey '
+               'FOREIGN KEY (trip_record_id) REFERENCES trip_record (id) NOT VALID')
+
+    op.drop_column('gtfs_feeds', 'retention_days')
@@ -0,0 +1,34 @@
+"""latest record days
+
+Revision ID: c3f1a9d27e64
+Revises: 5a2f86c1d93e
+Create Date: 2026-10-18 19:12:48.305127
+
+The day of the latest position and trip record of each vehicle, so they are looked up by primary key (id, day) in a
+single partition. Filled from the existing records, rows whose record was dropped with its partition keep no day.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f1a9d27e64'
+down_revision = '5a2f86c1d93e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('latest_records', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('vehicle_position_day', sa.Date(), nullable=True))
+        batch_op.add_column(sa.Column('trip_record_day', sa.Date(), nullable=True))
+    op.execute('UPDATE latest_records l SET vehicle_position_day = p.day '
+               'FROM vehicle_position p WHERE p.id = l.vehicle_position_id')
+    op.execute('UPDATE latest_records l SET trip_record_day = t.day '
+               'FROM trip_record t WHERE t.id = l.trip_record_id')
+
+
+def downgrade():
+    with op.batch_alter_table('latest_records', schema=None) as batch_op:
+        batch_op.drop_column('trip_record_day')
+        batch_op.drop_column('vehicle_position_day')
@@ -0,0 +1,51 @@
+"""api access path indexes
+
+Revision ID: e41c9b07d2a5
+Revises: b8e2d41c7a90
+Create Date: 2026-10-18 16:42:13.507311
+
+Composite indexes shaped to the queries of api.py and gtfs_routes.py, an index on stop_distance.trip_record_id for
+the stops of a trip, and BRIN instead of btree indexes on the time columns. The day indexes are dropped, every
+partition holds a single day. Indexes are built on every partition, which locks the tables while they build.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e41c9b07d2a5'
+down_revision = 'b8e2d41c7a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('vehicle_position', 'trip_record'):
+        op.drop_index(f'ix_{table}_day', table_name=table)
+        op.drop_index(f'ix_{table}_time_recorded', table_name=table)
+        op.drop_index(f'ix_{table}_timestamp', table_name=table)
+        op.create_index(f'ix_{table}_time_recorded_brin', table, ['time_recorded'], unique=False,
+                        postgresql_using='brin')
+        op.create_index(f'ix_{table}_timestamp_brin', table, ['timestamp'], unique=False, postgresql_using='brin')
+
+    op.create_index('ix_vehicle_position_vehicle_id_timestamp', 'vehicle_position', ['vehicle_id', 'timestamp'],
+                    unique=False)
+    op.create_index('ix_trip_record_vehicle_id_timestamp', 'trip_record', ['vehicle_id', 'timestamp'],
+                    unique=False, postgresql_include=['trip_id'])
+    op.create_index('ix_trip_record_trip_id_vehicle_id_timestamp', 'trip_record',
+                    ['trip_id', 'vehicle_id', 'timestamp'], unique=False)
+    op.create_index('ix_stop_distance_trip_record_id', 'stop_distance', ['trip_record_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_stop_distance_trip_record_id', table_name='stop_distance')
+    op.drop_index('ix_trip_record_trip_id_vehicle_id_timestamp', table_name='trip_record')
+    op.drop_index('ix_trip_record_vehicle_id_timestamp', table_name='trip_record')
+    op.drop_index('ix_vehicle_position_vehicle_id_timestamp', table_name='vehicle_position')
+
+    for table in ('vehicle_position', 'trip_record'):
+        op.drop_index(f'ix_{table}_timestamp_brin', table_name=table)
+        op.drop_index(f'ix_{table}_time_recorded_brin', table_name=table)
+        op.create_index(f'ix_{table}_timestamp', table, ['timestamp'], unique=False)
+        op.create_index(f'ix_{table}_time_recorded', table, ['time_recorded'], unique=False)
+        op.create_index(f'ix_{table}_day', table, ['day'], unique=False)
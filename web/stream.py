@@ -0,0 +1,14 @@
+# server-sent events of /api/vehicle_positions/stream on gevent: each subscriber waits in a greenlet instead of
+# holding a thread, so one process holds thousands of them. docker-compose runs it as the stream service:
+# gunicorn -w 1 --worker-class gevent --worker-connections 10000 stream:gunicorn_app
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg
+# db queries yield to the other greenlets instead of blocking the process
+patch_psycopg()
+
+from flaskr import create_app
+import config
+
+gunicorn_app = create_app(config.ProductionConfig)
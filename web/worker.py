@@ -0,0 +1,25 @@
+import signal
+import sys
+
+from werkzeug.serving import make_server
+
+from flaskr import create_worker
+from flaskr.extensions import scheduler
+import config
+
+
+def stop(signum, frame):
+    # exit through atexit, so the feed leases are released
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    # standalone ingestion: run the web app with SCHEDULER_ENABLE=false (or WEB_READ_ONLY=true) next to it
+    app = create_worker(config=config.ProductionConfig)
+    signal.signal(signal.SIGTERM, stop)
+    scheduler.start()
+    server = make_server('0.0.0.0', app.config.get('WORKER_METRICS_PORT', 9100), app, threaded=True)
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.shutdown()